@@ -0,0 +1,161 @@
+"""
+Admission control, requests are rejected before doing any database work when
+    - their client ip (the one the handlers see, after the proxy headers that
+      custom_worker.py enables) has no token left in its bucket, refilled at
+      ADMISSION_RATE per second up to ADMISSION_BURST: 429
+    - the worker already runs ADMISSION_MAX_CONCURRENCY requests, by default
+      the connections its database pool can give (DB_POOL_SIZE + DB_MAX_OVERFLOW),
+      so a flood fails fast instead of waiting for a connection: 503
+both with a Retry-After header. GET /health, /ready and /metrics are never
+limited. Buckets are kept in process (the ADMISSION_MAX_CLIENTS most recent
+clients of the worker), or with ADMISSION_BACKEND=redis in the Redis of
+REDIS_URL, shared by every worker.
+"""
+from collections import OrderedDict
+import math
+import os
+import time
+
+import database
+import response_cache
+import serializers
+
+ADMISSION_BACKEND = os.environ.get('ADMISSION_BACKEND', 'memory')
+# clients behind a carrier NAT share an ip, 0 disables the buckets
+ADMISSION_RATE = float(os.environ.get('ADMISSION_RATE', 20))
+ADMISSION_BURST = float(os.environ.get('ADMISSION_BURST', 100))
+ADMISSION_MAX_CLIENTS = int(os.environ.get('ADMISSION_MAX_CLIENTS', 100000))
+# 0 disables the limit
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get('ADMISSION_MAX_CONCURRENCY', database.DB_POOL_SIZE + database.DB_MAX_OVERFLOW))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.environ.get('ADMISSION_RETRY_AFTER_SECONDS', 1))
+
+EXEMPT_PATHS = {"/health", "/ready", "/metrics"}
+
+
+class MemoryBuckets:
+    blocking = False
+
+    def __init__(self, rate=ADMISSION_RATE, burst=ADMISSION_BURST, max_clients=ADMISSION_MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+
+    def take(self, client):
+        """
+        0 when the client had a token, otherwise the seconds until it has one
+        """
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+        self._buckets[client] = (tokens - 1 if tokens >= 1 else tokens, now)
+        # a client that was not seen for a while has a full bucket anyway
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+TAKE_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisBuckets:
+    """
+    the bucket of a client is a hash updated by a script, so the workers share it
+    """
+    blocking = True
+
+    def __init__(self, client, rate=ADMISSION_RATE, burst=ADMISSION_BURST):
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    def take(self, client):
+        return float(self._take(keys=["admission:%s" % client], args=[self.rate, self.burst, time.time()]))
+
+
+def create_buckets(name=ADMISSION_BACKEND):
+    if ADMISSION_RATE <= 0:
+        return None
+    if name == 'memory':
+        return MemoryBuckets()
+    if name == 'redis':
+        import redis
+        return RedisBuckets(redis.Redis.from_url(response_cache.REDIS_URL))
+    return None
+
+
+class Admission:
+
+    def __init__(self, buckets, max_concurrency=ADMISSION_MAX_CONCURRENCY):
+        self.buckets = buckets
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.rate_limited = 0
+        self.shed = 0
+
+    def stats(self):
+        stats = {"in_flight": self.in_flight, "max_concurrency": self.max_concurrency,
+                 "rate_limited": self.rate_limited, "shed": self.shed}
+        if isinstance(self.buckets, MemoryBuckets):
+            stats["clients"] = len(self.buckets)
+        return stats
+
+
+admission = Admission(create_buckets())
+
+
+def admission_rejected():
+    # stands for the endpoint of a rejected request in the metrics
+    pass
+
+
+async def reject(scope, send, status_code, message, retry_after):
+    scope["endpoint"] = admission_rejected
+    response = serializers.JSONResponse(status_code=status_code, content={"message": message},
+                                        headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+    await response(scope, None, send)
+
+
+class AdmissionMiddleware:
+
+    def __init__(self, app, controller=None):
+        self.app = app
+        self.controller = controller or admission
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+        controller = self.controller
+        if controller.buckets is not None:
+            client = scope.get("client")
+            wait = await response_cache.run(controller.buckets, controller.buckets.take, client[0] if client else "")
+            if wait:
+                controller.rate_limited += 1
+                await reject(scope, send, 429, "Too Many Requests", wait)
+                return
+        if controller.max_concurrency and controller.in_flight >= controller.max_concurrency:
+            controller.shed += 1
+            await reject(scope, send, 503, "Service Unavailable", ADMISSION_RETRY_AFTER_SECONDS)
+            return
+        controller.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.in_flight -= 1
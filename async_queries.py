@@ -0,0 +1,105 @@
+"""
+Async versions of the functions in queries.py, ingest.py, latest_results.py and rollups.py.
+With an AsyncSession the sync implementation runs through run_sync, so its
+statements go through asyncpg without blocking the event loop and both modes
+share the same query code. With a sync Session it runs in the threadpool.
+"""
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+import database
+import ingest
+import latest_results
+import queries
+import rollups
+
+
+async def run(db, function, *args):
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(function, *args)
+    return await run_in_threadpool(function, db, *args)
+
+
+def next_items(db, iterator, count):
+    return [item for _, item in zip(range(count), iterator)]
+
+
+def close(db, iterator):
+    iterator.close()
+
+
+async def iterate(db, function, *args, batch_size=100):
+    """
+    the items of the sync generator function(db, *args), read in batches of
+    batch_size through run, so a streamed response does not block the event loop
+    """
+    iterator = function(db.sync_session if isinstance(db, AsyncSession) else db, *args)
+    try:
+        while True:
+            items = await run(db, next_items, iterator, batch_size)
+            for item in items:
+                yield item
+            if len(items) < batch_size:
+                return
+    finally:
+        await run(db, close, iterator)
+
+
+async def get_asn_by_ip(db, ip):
+    return await run(db, queries.get_asn_by_ip, ip)
+
+
+async def get_manuf_entries(db, devices_tests):
+    return await run(db, queries.get_manuf_entries, devices_tests)
+
+
+async def get_manufs(db, devices_tests):
+    return await run(db, queries.get_manufs, devices_tests)
+
+
+async def get_only_manufs(db, devices_tests):
+    return await run(db, queries.get_only_manufs, devices_tests)
+
+
+async def get_manuf(db, devices_test):
+    return await run(db, queries.get_manuf, devices_test)
+
+
+async def get_only_manuf(db, devices_test):
+    return await run(db, queries.get_only_manuf, devices_test)
+
+
+async def get_tests_with_list(db, ip, model_test):
+    return await run(db, queries.get_tests_with_list, ip, model_test)
+
+
+async def get_devices_tests(db, ip):
+    return await run(db, queries.get_devices_tests, ip)
+
+
+async def get_tests(db, ip, model_test):
+    return await run(db, queries.get_tests, ip, model_test)
+
+
+async def get_latest_test(db, ip):
+    return await run(db, queries.get_latest_test, ip)
+
+
+async def get_ndt_test(db, ip, model_test):
+    return await run(db, queries.get_ndt_test, ip, model_test)
+
+
+async def read_latest_results(db, ip, type_test=None):
+    return await run(db, latest_results.read, ip, type_test)
+
+
+async def get_latest_results(db, ip, type_test=None, rendered=None):
+    return await run(db, latest_results.get, ip, type_test, rendered)
+
+
+async def insert_submissions(db, submissions, batch_size=database.BULK_INSERT_BATCH_SIZE):
+    return await run(db, ingest.insert_submissions, submissions, batch_size)
+
+
+async def get_asn_stats(db, asn_id, since):
+    return await run(db, rollups.get_asn_stats, asn_id, since)
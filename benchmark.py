@@ -0,0 +1,439 @@
+"""
+Load test of every endpoint against a seeded database:
+    python benchmark.py run [--throwaway | --database-url URL] [--seed] [--tests 1000000]
+                            [--concurrency 16] [--duration 60] [--output results.json]
+    python benchmark.py compare baseline.json results.json [--tolerance 0.1]
+--throwaway initdb's a PostgreSQL cluster in a temporary directory (initdb and
+pg_ctl must be in the PATH) and removes it afterwards. --seed creates the schema
+and fills the reference tables and the history of tests with generate_series,
+then computes the rollups, the ndt distributions and the latest results as
+their refresh jobs do, so the handlers reading them are measured with data.
+Unless --url points to an app already running, the app is started with uvicorn
+against the database, the environment of the benchmark (DATABASE_ASYNC, ...) is
+passed to it. Requests come from the seeded clients through X-Forwarded-For.
+The traffic is a weighted mix of the SCENARIOS, or the lines of --traffic, each
+one {"name": ..., "method": ..., "path": ..., "body": ..., "weight": ...}.
+For every scenario the results have the throughput, p50/p95/p99 latency, the
+bytes of the response bodies as sent (compressed with --accept-encoding gzip or
+br) and the SQL statements per request of its handler, read from GET /metrics
+(with one worker, /metrics only sees the worker answering it).
+get_tests_unchanged repeats the last GET /tests/ of the thread with the ETag it
+got in If-None-Match, as the app opening the same screen again, which is
+answered 304 unless the client posted meanwhile.
+"""
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SEED = [
+    "INSERT INTO asns (id, name) SELECT i, 'AS' || i FROM generate_series(1, :asns) i",
+    # a /24 for each client, and a /16 covering every 256 of them
+    "INSERT INTO latest_subnet_asns (asn_id, subnet) SELECT 1 + i % :asns, "
+    "network(set_masklen('1.0.0.0'::inet + i::bigint * 256, 24)) FROM generate_series(0, :prefixes - 1) i",
+    "INSERT INTO latest_subnet_asns (asn_id, subnet) SELECT 1 + (i * 7) % :asns, "
+    "network(set_masklen('1.0.0.0'::inet + i::bigint * 65536, 16)) FROM generate_series(0, (:prefixes - 1) / 256) i",
+    "INSERT INTO macs_manuf (mac, mask, manuf, comment) SELECT (lpad(to_hex(i), 6, '0') || '000000')::macaddr, 24, "
+    "'Manuf' || i, 'Manufacturer ' || i FROM generate_series(0, :manufs - 1) i",
+    "INSERT INTO tests (public_ip, timestamp, asn_id) SELECT '1.0.0.1'::inet + (i % :clients)::bigint * 256, "
+    "now() - (i * interval '1 second'), 1 + (i % :clients) % :asns FROM generate_series(1, :tests) i",
+    "INSERT INTO protocol_tests (test_id, test_timestamp, protocol_name, key_management, cipher) SELECT id, timestamp, "
+    "(ARRAY['WPA2', 'WPA3', 'WPA'])[1 + id % 3], 'PSK', 'CCMP' FROM tests WHERE id % 5 = 0",
+    "INSERT INTO devices_tests (test_id, test_timestamp, mac, mask, router, private_ip) SELECT id, timestamp, "
+    "(lpad(to_hex((id * 7 + k) % :manufs), 6, '0') || lpad(to_hex(k), 6, '0'))::macaddr, 24, k = 0, "
+    "('192.168.0.' || (k + 1))::inet FROM tests, generate_series(0, 2) k WHERE id % 5 = 1",
+    "INSERT INTO dns_tests (test_id, test_timestamp, dns1_android, do_flag, ad_flag, rrsig, resolver_ip_oarc, rating_source_port, "
+    "std_source_port, bits_of_entropy_source_port) SELECT id, timestamp, '8.8.8.8', true, id % 2 = 0, id % 2 = 0, '8.8.4.4', "
+    "(ARRAY['GREAT', 'GOOD', 'POOR'])[1 + id % 3]::ratingoarcenum, 18000, 15.5 FROM tests WHERE id % 5 = 2",
+    "INSERT INTO ndt_tests_ooni (test_id, test_timestamp, report_id, avg_rtt, download, upload, mss, max_rtt, min_rtt, ping, "
+    "retransmit_rate) SELECT id, timestamp, 'report' || id, 20 + id % 300, 0.5 + id % 200, 0.2 + id % 50, 1460, 400, 10, 25, 0.01 "
+    "FROM tests WHERE id % 5 = 3",
+    "INSERT INTO web_tests_ooni (test_id, test_timestamp, report_id, url, resolver_asn, resolver_ip, resolver_network_name, "
+    "client_resolver, dns_consistency, accessible, blocking) SELECT id, timestamp, 'report' || id, 'https://example.org/' || id % 1000, "
+    "'AS15169', '8.8.8.8', 'Google LLC', '8.8.8.8', 'consistent', id % 10 <> 0, "
+    "(CASE WHEN id % 10 = 0 THEN 'dns' ELSE 'not_blocking' END)::blockingenum FROM tests WHERE id % 5 = 4",
+    "INSERT INTO tcp_connect_web_tests_ooni (test_id, test_timestamp, ip, port, status_blocked, status_success) "
+    "SELECT id, test_timestamp, '93.184.216.34', 443, false, true FROM web_tests_ooni",
+]
+
+
+def client_ip(rng, clients):
+    # the address ending in .1 of the /24 of the client, as seeded
+    client = rng.randrange(clients)
+    return "%d.%d.%d.1" % (1 + client // 65536, client // 256 % 256, client % 256)
+
+
+def random_mac(rng, manufs):
+    manuf = rng.randrange(manufs)
+    return ":".join("%02x" % byte for byte in manuf.to_bytes(3, "big") + bytes(rng.randrange(256) for _ in range(3)))
+
+
+def ndt_test(rng):
+    return {"report_id": "bench%d" % rng.randrange(10 ** 9), "download": rng.uniform(0.5, 300),
+            "upload": rng.uniform(0.2, 80), "avg_rtt": rng.uniform(5, 400), "mss": 1460}
+
+
+def web_test(rng):
+    blocking = rng.choice(["not_blocking"] * 9 + ["dns"])
+    return {"report_id": "bench%d" % rng.randrange(10 ** 9), "url": "https://example.org/%d" % rng.randrange(1000),
+            "resolver_asn": "AS15169", "resolver_ip": "8.8.8.8", "resolver_network_name": "Google LLC",
+            "client_resolver": "8.8.8.8", "dns_consistency": "consistent", "accessible": blocking == "not_blocking",
+            "blocking": blocking}
+
+
+"""
+name: (handler in main.py, weight, function of (rng, options) returning (method, path, body))
+"""
+SCENARIOS = {
+    "get_asn": ("get_asn", 10, lambda rng, options: ("GET", "/asn", None)),
+    "add_protocol_test": ("add_protocol_test", 10, lambda rng, options: ("POST", "/tests/protocol", {
+        "test": [{"protocol_name": rng.choice(["WPA2", "WPA3"]), "key_management": "PSK", "cipher": "CCMP"}]})),
+    "add_devices_tests": ("add_devices_tests", 10, lambda rng, options: ("POST", "/tests/devices", {
+        "test": [{"mac": random_mac(rng, options.manufs), "mask": 24, "router": position == 0,
+                  "private_ip": "192.168.0.%d" % (position + 1)} for position in range(rng.randint(1, 8))]})),
+    "add_dns_test": ("add_dns_test", 10, lambda rng, options: ("POST", "/tests/dns", {
+        "dns_test": {"dns1_android": "8.8.8.8", "do_flag": True, "ad_flag": rng.random() < 0.5, "rrsig": True}})),
+    "add_ndt_test": ("add_ndt_test", 10, lambda rng, options: ("POST", "/tests/ooni/ndt", {"test": ndt_test(rng)})),
+    "add_web_test_ooni": ("add_web_test_ooni", 10, lambda rng, options: ("POST", "/tests/ooni/web", {
+        "web_test_ooni": web_test(rng),
+        "tcp_connect_web_tests_ooni": [{"ip": "93.184.216.34", "port": 443, "status_success": True}]})),
+    "get_tests": ("get_tests", 15, lambda rng, options: ("GET", "/tests/", None)),
+    "get_tests_basic": ("get_tests", 5, lambda rng, options: ("GET", "/tests/?type_test=basic_tests", None)),
+    "get_tests_devices": ("get_tests", 5, lambda rng, options: ("GET", "/tests/?type_test=devices_tests", None)),
+    "get_tests_ndt": ("get_tests", 5, lambda rng, options: ("GET", "/tests/?type_test=ndt_tests_ooni", None)),
+    "get_tests_web": ("get_tests", 5, lambda rng, options: ("GET", "/tests/?type_test=web_tests_ooni", None)),
+    "get_tests_unchanged": ("get_tests", 10, lambda rng, options: ("GET", "/tests/", None)),
+    "get_asn_stats": ("get_asn_stats", 5, lambda rng, options: (
+        "GET", "/stats/asn/%d" % rng.randint(1, options.asns), None)),
+    "get_tests_history": ("get_tests_history", 5, lambda rng, options: ("GET", "/tests/history", None)),
+    "get_tests_history_ndt": ("get_tests_history", 2, lambda rng, options: (
+        "GET", "/tests/history?type_test=ndt_tests_ooni&limit=1000", None)),
+    "get_health": ("get_health", 1, lambda rng, options: ("GET", "/health", None)),
+    "get_ready": ("get_ready", 1, lambda rng, options: ("GET", "/ready", None)),
+    "get_metrics": ("get_metrics", 1, lambda rng, options: ("GET", "/metrics", None)),
+    # only with --admin-token
+    "import_tests": ("import_tests", 1, lambda rng, options: ("POST", "/tests/import", "".join(
+        json.dumps({"type": "ndt_tests_ooni", "public_ip": client_ip(rng, options.clients), "test": ndt_test(rng)}) + "\n"
+        for _ in range(100)))),
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ThrowawayPostgres:
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix="wifiadvisor-benchmark-")
+        self.data = os.path.join(self.directory, "data")
+        self.port = free_port()
+        self.url = "postgresql://postgres@/wifiadvisor?host=%s&port=%d" % (self.directory, self.port)
+
+    def start(self):
+        quiet = dict(check=True, stdout=subprocess.DEVNULL)
+        subprocess.run(["initdb", "-D", self.data, "-U", "postgres", "--auth=trust", "-E", "UTF8"], **quiet)
+        subprocess.run(["pg_ctl", "-D", self.data, "-l", os.path.join(self.directory, "postgres.log"), "-w",
+                        "-o", "-p %d -k %s -c listen_addresses='' -c fsync=off" % (self.port, self.directory),
+                        "start"], **quiet)
+        subprocess.run(["createdb", "-h", self.directory, "-p", str(self.port), "-U", "postgres", "wifiadvisor"], **quiet)
+
+    def stop(self):
+        subprocess.run(["pg_ctl", "-D", self.data, "-m", "fast", "-w", "stop"], stdout=subprocess.DEVNULL)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def seed(database_url, options):
+    # database.py reads the url when it is imported
+    os.environ["SQLALCHEMY_DATABASE_URL"] = database_url
+    from sqlalchemy import create_engine, text
+    import migrations
+    engine = create_engine(database_url)
+    migrations.upgrade(engine)
+    import partitions
+    # the seeded tests are one second apart, going back from now
+    with engine.begin() as connection:
+        partitions.create_partitions(connection, partitions.months_between(
+            datetime.now(timezone.utc) - timedelta(seconds=options.tests), datetime.now(timezone.utc)))
+    parameters = {name: getattr(options, name) for name in ("asns", "prefixes", "manufs", "clients", "tests")}
+    with engine.begin() as connection:
+        for statement in SEED:
+            start = time.perf_counter()
+            connection.execute(text(statement), parameters)
+            print("seeded in %.1fs: %s..." % (time.perf_counter() - start, statement[:60]), file=sys.stderr)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("ANALYZE"))
+    # the tables of the refresh jobs, the ndt distributions before the latest results rendered with them
+    from sqlalchemy.orm import Session
+    import latest_results
+    import percentiles
+    import rollups
+    for name, job in (("rollups", rollups.refresh), ("ndt distributions", percentiles.refresh),
+                      ("latest results", lambda db: latest_results.refresh_changed(engine))):
+        start = time.perf_counter()
+        db = Session(bind=engine)
+        try:
+            job(db)
+        finally:
+            db.close()
+        print("refreshed %s in %.1fs" % (name, time.perf_counter() - start), file=sys.stderr)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("ANALYZE"))
+    engine.dispose()
+
+
+def start_app(database_url, options):
+    port = free_port()
+    environment = dict(os.environ, SQLALCHEMY_DATABASE_URL=database_url)
+    if options.admin_token:
+        environment["ADMIN_TOKEN"] = options.admin_token
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(options.workers), "--proxy-headers", "--forwarded-allow-ips", "*", "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=environment)
+    url = "http://127.0.0.1:%d" % port
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit("the app exited with %s" % process.returncode)
+        try:
+            if request(url, "GET", "/health")[0] == 200:
+                return process, url
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    sys.exit("the app did not start")
+
+
+def request(url, method, path, body=None, headers=None, connection=None):
+    parts = urlsplit(url)
+    connection = connection or http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+    headers = dict(headers or {})
+    if body is not None and not isinstance(body, str):
+        body = json.dumps(body)
+        headers["Content-Type"] = "application/json"
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    # http.client does not decode the body, its length is the one on the wire
+    return response.status, response.read(), response.headers
+
+
+def statements_by_handler(url):
+    """
+    sum and count of http_request_db_statements of each handler
+    """
+    totals = {}
+    for line in request(url, "GET", "/metrics")[1].decode().splitlines():
+        match = re.match(r'http_request_db_statements_(sum|count)\{handler="(\w+)"\} (\S+)', line)
+        if match:
+            totals.setdefault(match.group(2), [0.0, 0.0])[match.group(1) == "count"] += float(match.group(3))
+    return totals
+
+
+def load_traffic(options):
+    if options.traffic:
+        with open(options.traffic) as lines:
+            entries = [json.loads(line) for line in lines if line.strip()]
+        return [(entry.get("name", entry["path"]), entry.get("handler", entry.get("name", entry["path"])),
+                 entry.get("weight", 1), lambda rng, options, entry=entry: (entry["method"], entry["path"], entry.get("body")))
+                for entry in entries]
+    return [(name, handler, weight, build) for name, (handler, weight, build) in SCENARIOS.items()
+            if name != "import_tests" or options.admin_token]
+
+
+def percentile(latencies, fraction):
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+def replay(url, options):
+    traffic = load_traffic(options)
+    weights = [weight for _, _, weight, _ in traffic]
+    latencies = {name: [] for name, _, _, _ in traffic}
+    errors = {name: 0 for name, _, _, _ in traffic}
+    sizes = {name: 0 for name, _, _, _ in traffic}
+    lock = threading.Lock()
+    warmup_end = time.monotonic() + options.warmup
+    end = warmup_end + options.duration
+
+    def worker(number):
+        rng = random.Random(options.random_seed * 1000 + number)
+        parts = urlsplit(url)
+        connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+        # client and ETag of the last GET /tests/ of the thread
+        last_tests = None
+        while time.monotonic() < end:
+            name, _, _, build = rng.choices(traffic, weights)[0]
+            method, path, body = build(rng, options)
+            headers = {"X-Forwarded-For": client_ip(rng, options.clients)}
+            if options.accept_encoding:
+                headers["Accept-Encoding"] = options.accept_encoding
+            if name == "get_tests_unchanged" and last_tests is not None:
+                headers["X-Forwarded-For"], headers["If-None-Match"] = last_tests
+            if method == "POST":
+                # every request is a new submission, not a retry the app would answer from idempotency.py
+                headers["Idempotency-Key"] = "%032x" % rng.getrandbits(128)
+            if options.admin_token:
+                headers["X-Admin-Token"] = options.admin_token
+            start = time.monotonic()
+            try:
+                status, response_body, response_headers = request(url, method, path, body, headers, connection)
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                status, response_body, response_headers = None, b"", {}
+            seconds = time.monotonic() - start
+            if path == "/tests/" and status == 200 and response_headers.get("ETag"):
+                last_tests = headers["X-Forwarded-For"], response_headers["ETag"]
+            if start >= warmup_end:
+                with lock:
+                    latencies[name].append(seconds)
+                    sizes[name] += len(response_body)
+                    if status is None or status >= 400:
+                        errors[name] += 1
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(options.concurrency)]
+    for thread in threads:
+        thread.start()
+    time.sleep(max(0, warmup_end - time.monotonic()))
+    statements_before = statements_by_handler(url)
+    for thread in threads:
+        thread.join()
+    statements_after = statements_by_handler(url)
+
+    results = {}
+    for name, handler, _, _ in traffic:
+        before, after = statements_before.get(handler, [0, 0]), statements_after.get(handler, [0, 0])
+        requests = after[1] - before[1]
+        ordered = sorted(latencies[name])
+        results[name] = {
+            "handler": handler,
+            "requests": len(ordered),
+            "errors": errors[name],
+            "throughput": round(len(ordered) / options.duration, 2),
+            "p50_ms": round(percentile(ordered, 0.50) * 1000, 3) if ordered else None,
+            "p95_ms": round(percentile(ordered, 0.95) * 1000, 3) if ordered else None,
+            "p99_ms": round(percentile(ordered, 0.99) * 1000, 3) if ordered else None,
+            "bytes_per_request": round(sizes[name] / len(ordered), 1) if ordered else None,
+            "statements_per_request": round((after[0] - before[0]) / requests, 2) if requests else None,
+        }
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(options):
+    postgres = ThrowawayPostgres() if options.throwaway else None
+    app = None
+    try:
+        database_url = options.database_url or os.environ.get("SQLALCHEMY_DATABASE_URL")
+        if postgres is not None:
+            postgres.start()
+            database_url = postgres.url
+        if options.seed or postgres is not None:
+            seed(database_url, options)
+        url = options.url
+        if url is None:
+            app, url = start_app(database_url, options)
+        endpoints = replay(url, options)
+    finally:
+        if app is not None:
+            app.terminate()
+            app.wait()
+        if postgres is not None:
+            postgres.stop()
+    results = {
+        "commit": git_commit(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "options": {name: value for name, value in vars(options).items() if name not in ("admin_token", "command")},
+        "environment": {name: os.environ[name] for name in ("DATABASE_ASYNC", "WRITE_BEHIND", "RESPONSE_CACHE_BACKEND",
+                                                             "ROLLUP_MODE", "DB_POOL_SIZE", "LATEST_RESULTS_MODE",
+                                                             "COMPRESSION_MIN_BYTES") if name in os.environ},
+        "endpoints": endpoints,
+    }
+    output = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            output_file.write(output)
+    print(output)
+
+
+def compare(options):
+    with open(options.baseline) as baseline_file, open(options.results) as results_file:
+        baseline, results = json.load(baseline_file)["endpoints"], json.load(results_file)["endpoints"]
+    regressions = 0
+    print("%-20s %12s %12s %12s %12s %10s %10s" % ("endpoint", "req/s", "p50 ms", "p95 ms", "p99 ms", "stmts/req", "bytes/req"))
+    for name in sorted(set(baseline) & set(results)):
+        old, new = baseline[name], results[name]
+        cells = []
+        for metric, higher_is_better in (("throughput", True), ("p50_ms", False), ("p95_ms", False),
+                                         ("p99_ms", False), ("statements_per_request", False), ("bytes_per_request", False)):
+            # results saved before bytes_per_request was measured do not have it
+            if old.get(metric) is None or new.get(metric) is None or not old[metric]:
+                cells.append("-")
+                continue
+            change = (new[metric] - old[metric]) / old[metric]
+            worse = -change if higher_is_better else change
+            # p99 is too noisy to fail on
+            if metric != "p99_ms" and worse > options.tolerance:
+                regressions += 1
+            cells.append("%+.0f%%%s" % (change * 100, "!" if worse > options.tolerance else ""))
+        print("%-20s %12s %12s %12s %12s %10s %10s" % (name, *cells))
+    sys.exit(1 if regressions else 0)
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description="wifiadvisor-backend benchmark")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--throwaway", action="store_true", help="run against a temporary postgres cluster")
+    run_parser.add_argument("--database-url", help="default SQLALCHEMY_DATABASE_URL")
+    run_parser.add_argument("--url", help="benchmark an app already running instead of starting one")
+    run_parser.add_argument("--seed", action="store_true", help="create and fill the tables (always with --throwaway)")
+    run_parser.add_argument("--asns", type=int, default=70000)
+    run_parser.add_argument("--prefixes", type=int, default=500000)
+    run_parser.add_argument("--manufs", type=int, default=40000)
+    run_parser.add_argument("--clients", type=int, default=100000)
+    run_parser.add_argument("--tests", type=int, default=1000000)
+    run_parser.add_argument("--workers", type=int, default=1)
+    run_parser.add_argument("--concurrency", type=int, default=16)
+    run_parser.add_argument("--duration", type=float, default=60)
+    run_parser.add_argument("--warmup", type=float, default=5)
+    run_parser.add_argument("--traffic", help="jsonl file of requests to replay instead of SCENARIOS")
+    run_parser.add_argument("--admin-token", help="also benchmark POST /tests/import")
+    run_parser.add_argument("--accept-encoding", help="Accept-Encoding of the requests, like gzip or br, none by default")
+    run_parser.add_argument("--random-seed", type=int, default=0)
+    run_parser.add_argument("--output", help="file to save the results as json")
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--tolerance", type=float, default=0.1,
+                                help="relative change counted as a regression")
+    return parser.parse_args(arguments)
+
+
+if __name__ == "__main__":
+    options = parse_arguments(sys.argv[1:])
+    if options.command == "run":
+        run(options)
+    else:
+        compare(options)
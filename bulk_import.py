@@ -0,0 +1,226 @@
+"""
+Bulk import of backfilled test results from NDJSON, one test per line:
+    {"type": "ndt_tests_ooni", "public_ip": "200.1.2.3", "timestamp": "...",
+     "test_base": {...}, "test": {...}, "tcp_connect": [...]}
+type is the table of the test, test is a list for protocol_tests and
+devices_tests, tcp_connect is only used by web_tests_ooni.
+Lines are validated with the schemas models and written in chunks through
+ingest.insert_submissions, so memory does not grow with the input. The
+partitions of the months a chunk backfills are created before inserting it. A
+line that can not be parsed or written is reported without aborting the import,
+as is a line longer than IMPORT_MAX_LINE_BYTES, which is skipped without being
+kept in memory.
+    python bulk_import.py results.ndjson [more.ndjson | -]
+"""
+from pydantic import ValidationError
+from sqlalchemy.exc import DBAPIError
+import json
+import logging
+import os
+import sys
+import time
+
+import database
+import ingest
+import models
+import partitions
+import response_cache
+import schemas
+
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 1000))
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', 1000))
+IMPORT_MAX_LINE_BYTES = int(os.environ.get('IMPORT_MAX_LINE_BYTES', 1024 * 1024))
+IMPORT_READ_BYTES = 64 * 1024
+
+TEST_TYPES = {
+    models.ProtocolTest.__tablename__: (schemas.ProtocolTest, models.ProtocolTest, True),
+    models.DevicesTest.__tablename__: (schemas.DevicesTest, models.DevicesTest, True),
+    models.DnsTest.__tablename__: (schemas.DnsTest, models.DnsTest, False),
+    models.NdtTestOoni.__tablename__: (schemas.NdtTestOoni, models.NdtTestOoni, False),
+    models.WebTestOoni.__tablename__: (schemas.WebTestOoni, models.WebTestOoni, False),
+}
+
+
+class ImportReport:
+
+    def __init__(self):
+        self.lines = 0
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.start = time.perf_counter()
+
+    def add_error(self, line_number, error):
+        self.failed += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({"line": line_number, "error": error})
+
+    def dict(self):
+        seconds = time.perf_counter() - self.start
+        return {
+            "lines": self.lines,
+            "imported": self.imported,
+            "failed": self.failed,
+            "seconds": round(seconds, 3),
+            "tests_per_second": round(self.imported / seconds, 1) if seconds else None,
+            "errors": self.errors,
+        }
+
+
+def parse_line(line):
+    record = schemas.ImportRecord.parse_raw(line)
+    if record.type not in TEST_TYPES:
+        raise ValueError("unknown test type %s" % record.type)
+    schema_test, model_test, many = TEST_TYPES[record.type]
+    if many:
+        tests = [schema_test.parse_obj(test) for test in record.test]
+    else:
+        tests = [schema_test.parse_obj(record.test)]
+    tcp_connect = [record.tcp_connect] if model_test is models.WebTestOoni else None
+    return ingest.Submission(str(record.public_ip), record.test_base, model_test, tests, tcp_connect, record.timestamp)
+
+
+def describe(error):
+    if isinstance(error, ValidationError):
+        return error.errors()
+    if isinstance(error, DBAPIError):
+        return str(error.orig).strip().splitlines()[0]
+    return str(error)
+
+
+class LineTooLong(ValueError):
+
+    def __init__(self, max_bytes):
+        super().__init__("line longer than %d bytes" % max_bytes)
+
+
+class LineSplitter:
+    """
+    splits a stream of bytes in lines of at most max_bytes, a longer line is
+    given as a LineTooLong error and its bytes are dropped as they arrive
+    """
+
+    def __init__(self, max_bytes=IMPORT_MAX_LINE_BYTES):
+        self.max_bytes = max_bytes
+        self._buffer = bytearray()
+        # the bytes of the buffer already searched for a newline
+        self._searched = 0
+        self._skipping = False
+
+    def feed(self, data):
+        self._buffer += data
+        lines = []
+        start = 0
+        while True:
+            end = self._buffer.find(b"\n", max(start, self._searched))
+            if end < 0:
+                break
+            if self._skipping:
+                self._skipping = False
+            elif end - start > self.max_bytes:
+                lines.append(LineTooLong(self.max_bytes))
+            else:
+                lines.append(bytes(self._buffer[start:end]))
+            start = end + 1
+        del self._buffer[:start]
+        self._searched = len(self._buffer)
+        if len(self._buffer) > self.max_bytes:
+            if not self._skipping:
+                lines.append(LineTooLong(self.max_bytes))
+                self._skipping = True
+            self._buffer.clear()
+            self._searched = 0
+        return lines
+
+    def end(self):
+        line = bytes(self._buffer)
+        self._buffer.clear()
+        self._searched = 0
+        return [line] if line and not self._skipping else []
+
+
+def add_line(report, chunk, line_number, line):
+    if isinstance(line, LineTooLong):
+        report.lines += 1
+        report.add_error(line_number, describe(line))
+        return
+    if not line.strip():
+        return
+    report.lines += 1
+    try:
+        if isinstance(line, bytes):
+            line = line.decode()
+        chunk.append((line_number, parse_line(line)))
+    except (UnicodeDecodeError, ValidationError, ValueError, TypeError) as e:
+        report.add_error(line_number, describe(e))
+
+
+def insert_chunk(db, chunk, report):
+    try:
+        # backfilled months may have no partitions yet
+        partitions.ensure_partitions([submission.timestamp for _, submission in chunk if submission.timestamp],
+                                     db.get_bind())
+        ingest.insert_submissions(db, [submission for _, submission in chunk])
+        report.imported += len(chunk)
+    except Exception:
+        # retries line by line to isolate the ones the database rejects
+        for line_number, submission in chunk:
+            try:
+                ingest.insert_submissions(db, [submission])
+                report.imported += 1
+            except Exception as e:
+                report.add_error(line_number, describe(e))
+    for ip in {submission.ip for _, submission in chunk}:
+        response_cache.cache.invalidate(ip)
+
+
+async def iter_lines(chunks, max_bytes=IMPORT_MAX_LINE_BYTES):
+    splitter = LineSplitter(max_bytes)
+    async for chunk in chunks:
+        for line in splitter.feed(chunk):
+            yield line
+    for line in splitter.end():
+        yield line
+
+
+def read_lines(file, max_bytes=IMPORT_MAX_LINE_BYTES):
+    """
+    the lines of a binary file, as iter_lines
+    """
+    splitter = LineSplitter(max_bytes)
+    while True:
+        data = file.read(IMPORT_READ_BYTES)
+        if not data:
+            break
+        yield from splitter.feed(data)
+    yield from splitter.end()
+
+
+def import_lines(db, lines, report=None, chunk_size=IMPORT_CHUNK_SIZE):
+    report = report or ImportReport()
+    chunk = []
+    for line_number, line in enumerate(lines, 1):
+        add_line(report, chunk, line_number, line)
+        if len(chunk) >= chunk_size:
+            insert_chunk(db, chunk, report)
+            chunk = []
+    if chunk:
+        insert_chunk(db, chunk, report)
+    return report
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2:
+        sys.exit("usage: python bulk_import.py file.ndjson [file.ndjson | -] ...")
+    for path in sys.argv[1:]:
+        db = database.SessionLocal()
+        try:
+            if path == "-":
+                report = import_lines(db, read_lines(sys.stdin.buffer))
+            else:
+                with open(path, "rb") as file:
+                    report = import_lines(db, read_lines(file))
+        finally:
+            db.close()
+        print(json.dumps(dict(report.dict(), file=path), default=str))
@@ -0,0 +1,159 @@
+"""
+Compressed and conditional responses.
+CompressionMiddleware compresses the JSON and text responses of at least
+COMPRESSION_MIN_BYTES with brotli (pip install brotli) or gzip, the one the
+client prefers in its Accept-Encoding, brotli on a tie. Streamed responses, as
+GET /tests/history, are compressed as they are sent, every chunk flushed.
+A compressed response is another representation of the resource, so its strong
+ETag gets the suffix of its encoding ("...-gzip", "...-br"), which
+if_none_match ignores when comparing the tags of If-None-Match, and a 304
+answers with the tag the client sent.
+"""
+from starlette.datastructures import Headers, MutableHeaders
+import hashlib
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# below it the compressed body and its headers are not much smaller, -1 disables the middleware
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+# 0 to 11, the higher ones are meant for static content
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 4))
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+# conditional responses are revalidated every time, and never stored by shared caches
+CACHE_HEADERS = {"Cache-Control": "private, no-cache"}
+
+
+class GzipEncoder:
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def encode(self, chunk, last):
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class BrotliEncoder:
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+
+    def encode(self, chunk, last):
+        return self._compressor.process(chunk) + (self._compressor.finish() if last else self._compressor.flush())
+
+
+# in order of preference
+ENCODERS = {"br": BrotliEncoder, "gzip": GzipEncoder} if brotli is not None else {"gzip": GzipEncoder}
+
+
+def negotiate(accept_encoding):
+    """
+    the encoding of ENCODERS with the highest q in accept_encoding, None for identity
+    """
+    weights = {}
+    for entry in accept_encoding.split(","):
+        name, _, parameters = entry.strip().partition(";")
+        weight = 1.0
+        parameter, _, value = parameters.strip().partition("=")
+        if parameter.strip() == "q":
+            try:
+                weight = float(value)
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for encoding in ENCODERS:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def etag(*parts):
+    """
+    a strong ETag of the version of a resource given by parts
+    """
+    return '"%s"' % hashlib.blake2b("\0".join(str(part) for part in parts).encode(), digest_size=12).hexdigest()
+
+
+def if_none_match(header, current):
+    """
+    the tag of the If-None-Match header matching the ETag current, whatever its
+    encoding suffix, None when no tag does
+    """
+    if not header:
+        return None
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return current
+        # If-None-Match uses the weak comparison
+        opaque = tag[2:] if tag.startswith("W/") else tag
+        for encoding in ENCODERS:
+            if opaque.endswith('-%s"' % encoding):
+                opaque = opaque[:-len(encoding) - 2] + '"'
+        if opaque == current:
+            return tag
+    return None
+
+
+def compressible(headers):
+    return "content-encoding" not in headers and headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+
+
+class CompressionMiddleware:
+
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", "")) \
+            if scope["type"] == "http" and self.minimum_size >= 0 else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        start = None
+        encoder = None
+
+        async def send_compressed(message):
+            nonlocal start, encoder
+            if message["type"] == "http.response.start":
+                # sent with the first chunk of the body, when it is known whether it is compressed
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                headers = MutableHeaders(raw=list(start.get("headers", [])))
+                if compressible(headers) and (more_body or len(body) >= self.minimum_size):
+                    encoder = ENCODERS[encoding]()
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    tag = headers.get("etag")
+                    if tag is not None and tag.endswith('"') and not tag.startswith("W/"):
+                        headers["ETag"] = '%s-%s"' % (tag[:-1], encoding)
+                    body = encoder.encode(body, not more_body)
+                    if more_body:
+                        del headers["Content-Length"]
+                    else:
+                        headers["Content-Length"] = str(len(body))
+                    message = dict(message, body=body)
+                await send(dict(start, headers=headers.raw))
+                start = None
+                await send(message)
+            elif encoder is not None:
+                await send(dict(message, body=encoder.encode(body, not more_body)))
+            else:
+                await send(message)
+
+        await self.app(scope, receive, send_compressed)
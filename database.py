@@ -1,14 +1,144 @@
 """
 the following code was obtained from the fast aspi tutorial
 https://fastapi.tiangolo.com/tutorial/sql-databases/#create-a-database-url-for-sqlalchemy
+adapt_pydantic_ip_address: Adapting types to fix SQLAlchemy's "can't adapt type" error "(https://gaganpreet.in/posts/sqlalchemy-cant-adapt-type/)
 """
-from sqlalchemy import create_engine
+from psycopg2.extensions import register_adapter, AsIs
+from pydantic.networks import IPv4Address, IPv6Address
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
 
+import metrics
+import profiling
+
 SQLALCHEMY_DATABASE_URL = os.environ.get('SQLALCHEMY_DATABASE_URL') 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=True)
+BULK_INSERT_BATCH_SIZE = int(os.environ.get('BULK_INSERT_BATCH_SIZE', 1000))
+# "1" serves requests with an asyncpg engine, the psycopg2 engine is still used
+# by background jobs and command line tools
+DATABASE_ASYNC = os.environ.get('DATABASE_ASYNC', '0') == '1'
+SQLALCHEMY_ASYNC_DATABASE_URL = os.environ.get('SQLALCHEMY_ASYNC_DATABASE_URL') or \
+    str(make_url(SQLALCHEMY_DATABASE_URL).set(drivername='postgresql+asyncpg'))
+# comma separated urls of read replicas of SQLALCHEMY_DATABASE_URL, see replicas.py
+DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+# logs every statement, see metrics.py for the sampled SQL_ECHO_SAMPLE_RATE
+SQL_ECHO = os.environ.get('SQL_ECHO', '0') == '1'
+
+# pool of each engine, per worker process
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+# "1" when connecting through PgBouncer in transaction pooling mode: keeps no
+# prepared statements in the server session (with asyncpg PgBouncer must
+# still track protocol level prepared statements, max_prepared_statements)
+DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', '0') == '1'
+# share of the pool in use from which GET /ready answers 503
+DB_READY_MAX_SATURATION = float(os.environ.get('DB_READY_MAX_SATURATION', 1.0))
+
+POOL_OPTIONS = dict(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                    pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=DB_POOL_PRE_PING, pool_use_lifo=True)
+
+
+async def _text_network_codecs(connection):
+    # return inet/cidr values as strings, like psycopg2 does
+    for typename in ('inet', 'cidr'):
+        await connection.set_type_codec(typename, encoder=str, decoder=str, schema='pg_catalog', format='text')
+
+
+def set_text_network_codecs(dbapi_connection, connection_record):
+    dbapi_connection.run_async(_text_network_codecs)
+
+
+def create_sync_engine(url=SQLALCHEMY_DATABASE_URL, name="sync"):
+    sync_engine = create_engine(url, echo=SQL_ECHO, poolclass=metrics.named_pool(metrics.TimedQueuePool, name),
+                                executemany_mode='values_only', executemany_values_page_size=BULK_INSERT_BATCH_SIZE,
+                                **POOL_OPTIONS)
+    metrics.instrument(sync_engine, name)
+    profiling.instrument(sync_engine)
+    return sync_engine
+
+
+def create_asyncpg_engine(url=SQLALCHEMY_ASYNC_DATABASE_URL, name="async"):
+    connect_args = {"statement_cache_size": 0, "prepared_statement_cache_size": 0} if DB_PGBOUNCER else {}
+    asyncpg_engine = create_async_engine(url, echo=SQL_ECHO, connect_args=connect_args,
+                                         poolclass=metrics.named_pool(metrics.TimedAsyncAdaptedQueuePool, name),
+                                         **POOL_OPTIONS)
+    metrics.instrument(asyncpg_engine.sync_engine, name)
+    profiling.instrument(asyncpg_engine.sync_engine)
+    event.listen(asyncpg_engine.sync_engine, "connect", set_text_network_codecs)
+    return asyncpg_engine
+
+
+engine = create_sync_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+async_engine = create_asyncpg_engine() if DATABASE_ASYNC else None
+AsyncSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False,
+                                 bind=async_engine, class_=AsyncSession)
+
+# the engines and sessions of the replicas, in the order of DATABASE_REPLICA_URLS
+replica_engines = [create_sync_engine(url, "replica_%d" % number) for number, url in enumerate(DATABASE_REPLICA_URLS)]
+ReplicaSessions = [sessionmaker(autocommit=False, autoflush=False, bind=replica_engine)
+                   for replica_engine in replica_engines]
+async_replica_engines = [
+    create_asyncpg_engine(str(make_url(url).set(drivername='postgresql+asyncpg')), "async_replica_%d" % number)
+    for number, url in enumerate(DATABASE_REPLICA_URLS)] if DATABASE_ASYNC else []
+AsyncReplicaSessions = [sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False,
+                                     bind=replica_engine, class_=AsyncSession)
+                        for replica_engine in async_replica_engines]
+
+
+def reset_pools_after_fork():
+    # a forked worker (gunicorn --preload) must not use the connections of its
+    # parent, it drops the inherited pools without closing them
+    engine.dispose(close=False)
+    if async_engine is not None:
+        async_engine.sync_engine.dispose(close=False)
+    for replica_engine in replica_engines:
+        replica_engine.dispose(close=False)
+    for replica_engine in async_replica_engines:
+        replica_engine.sync_engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=reset_pools_after_fork)
+
+
+def pools():
+    yield "db_pool", engine.pool
+    if async_engine is not None:
+        yield "db_async_pool", async_engine.sync_engine.pool
+    for number, replica_engine in enumerate(replica_engines):
+        yield "db_replica_%d_pool" % number, replica_engine.pool
+    for number, replica_engine in enumerate(async_replica_engines):
+        yield "db_async_replica_%d_pool" % number, replica_engine.sync_engine.pool
+
+
+def pool_stats(pool):
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "saturation": pool.checkedout() / (pool.size() + max(0, DB_MAX_OVERFLOW)),
+    }
+
+
+def ping():
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+
+Base = declarative_base()
+
+
+def adapt_pydantic_ip_address(ip):
+    return AsIs(repr(ip.exploded))
+
+
+register_adapter(IPv4Address, adapt_pydantic_ip_address)
+register_adapter(IPv6Address, adapt_pydantic_ip_address)
\ No newline at end of file
@@ -0,0 +1,139 @@
+"""
+Paginated history of the tests of a client, for GET /tests/history.
+Pages are keyset paginated on (timestamp, id), descending, the cursor of the
+next page being the position of the last test of the current one, so any page
+costs the same as the first one. Rows are read through server side cursors and
+each test is written as soon as it is complete, so memory does not depend on
+the size of the page:
+    {"items": [{"id": ..., "type": ..., "timestamp": ..., "test": ...}, ...], "next_cursor": ...}
+test is a list for protocol_tests and devices_tests, as in GET /tests/.
+"""
+from datetime import datetime
+from heapq import merge
+from sqlalchemy import and_, cast, exists, or_, tuple_
+from sqlalchemy.dialects.postgresql import INET
+from sqlalchemy.orm import Session
+import base64
+import json
+import logging
+import os
+
+import models
+import percentiles
+import queries
+import serializers
+
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', 100))
+HISTORY_MAX_PAGE_SIZE = int(os.environ.get('HISTORY_MAX_PAGE_SIZE', 10000))
+HISTORY_FETCH_SIZE = int(os.environ.get('HISTORY_FETCH_SIZE', 500))
+
+TYPE_MODELS = {
+    models.TestsName.basic_tests: (models.ProtocolTest, models.DnsTest),
+    models.TestsName.devices_tests: (models.DevicesTest,),
+    models.TestsName.ndt_tests_ooni: (models.NdtTestOoni,),
+    models.TestsName.web_tests_ooni: (models.WebTestOoni,),
+}
+LIST_MODELS = (models.ProtocolTest, models.DevicesTest)
+
+
+def encode_cursor(timestamp: datetime, test_id: int):
+    return base64.urlsafe_b64encode(json.dumps([timestamp.isoformat(), test_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """
+    raises ValueError when the cursor was not made by encode_cursor
+    """
+    try:
+        timestamp, test_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(timestamp), int(test_id)
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError("invalid cursor") from e
+
+
+def page(db: Session, ip, model_tests, since=None, until=None, position=None, limit=HISTORY_PAGE_SIZE):
+    """
+    the id, timestamp and asn_id of the tests of the page, read once for the rows of every model
+    """
+    conditions = [models.Test.public_ip == cast(ip, INET),
+                  or_(*[exists().where(and_(model_test.test_id == models.Test.id, model_test.test_timestamp == models.Test.timestamp))
+                        for model_test in model_tests])]
+    if since is not None:
+        conditions.append(models.Test.timestamp >= since)
+    if until is not None:
+        conditions.append(models.Test.timestamp < until)
+    if position is not None:
+        conditions.append(tuple_(models.Test.timestamp, models.Test.id) < tuple_(*position))
+    return db.query(models.Test.id, models.Test.timestamp, models.Test.asn_id).filter(and_(*conditions)).\
+        order_by(models.Test.timestamp.desc(), models.Test.id.desc()).limit(limit).all()
+
+
+def page_rows(db: Session, model_test, tests):
+    """
+    the rows of model_test of the tests, with the id, timestamp and asn_id of their test
+    """
+    asn_ids = {(test_id, timestamp): asn_id for test_id, timestamp, asn_id in tests}
+    rows = db.query(model_test).filter(tuple_(model_test.test_id, model_test.test_timestamp).in_(list(asn_ids))).\
+        order_by(model_test.test_timestamp.desc(), model_test.test_id.desc(), model_test.id).\
+        execution_options(stream_results=True).yield_per(HISTORY_FETCH_SIZE)
+    for row in rows:
+        yield row, row.test_id, row.test_timestamp, asn_ids[(row.test_id, row.test_timestamp)]
+
+
+def tagged_rows(db: Session, model_test, tests):
+    if not tests:
+        return
+    for row in page_rows(db, model_test, tests):
+        yield model_test, row
+
+
+def item(db: Session, model_test, rows):
+    test_id, timestamp, asn_id = rows[0][1:]
+    result = {"id": test_id, "type": model_test.__tablename__, "timestamp": timestamp}
+    if model_test is models.DevicesTest:
+        manufs = queries.get_only_manufs(db, [row[0] for row in rows])
+        result["test"] = [dict(serializers.row(row[0], queries.DEVICES_OUT_FIELDS), manuf=manuf)
+                          for row, manuf in zip(rows, manufs)]
+    elif model_test in LIST_MODELS:
+        result["test"] = [serializers.row(row[0]) for row in rows]
+    else:
+        result["test"] = serializers.row(rows[0][0])
+    if model_test is models.NdtTestOoni:
+        result["mlab"] = percentiles.reference.rank([rows[0][0]], [asn_id])[0]
+    return result
+
+
+def iter_items(db: Session, ip, type_test: models.TestsName = None, since=None, until=None, position=None, limit=HISTORY_PAGE_SIZE):
+    model_tests = TYPE_MODELS[type_test] if type_test else tuple(
+        model_test for model_tests in TYPE_MODELS.values() for model_test in model_tests)
+    tests = page(db, ip, model_tests, since, until, position, limit)
+    streams = [tagged_rows(db, model_test, tests) for model_test in model_tests]
+    # every stream is ordered by (timestamp, id) descending, and a test only has rows of one model
+    current = []
+    for model_test, row in merge(*streams, key=lambda entry: (entry[1][2], entry[1][1]), reverse=True):
+        if current and current[0][1][1] != row[1]:
+            yield item(db, current[0][0], [entry[1] for entry in current])
+            current = []
+        current.append((model_test, row))
+    if current:
+        yield item(db, current[0][0], [entry[1] for entry in current])
+
+
+def stream(db: Session, ip, type_test: models.TestsName = None, since=None, until=None, position=None, limit=HISTORY_PAGE_SIZE):
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    last = None
+    count = 0
+    try:
+        yield b'{"items":['
+        for result in iter_items(db, ip, type_test, since, until, position, limit):
+            yield (b',' if count else b'') + serializers.dumps(result)
+            last = result
+            count += 1
+        next_cursor = encode_cursor(last["timestamp"], last["id"]) if count == limit else None
+        yield b'],"next_cursor":' + serializers.dumps(next_cursor) + b'}'
+    except Exception as e:
+        # the status was already sent, the client gets a truncated body
+        logging.error("Error streaming the history of %s" % ip, exc_info=e)
+        raise
+    finally:
+        db.rollback()
@@ -0,0 +1,170 @@
+"""
+Deduplication of retried test submissions. A POST to one of IDEMPOTENT_PATHS
+is identified by its Idempotency-Key header, scoped to the client ip and the
+path. Its successful response is kept in a bounded cache that expires entries
+after IDEMPOTENCY_TTL_SECONDS, in process or in Redis (the backends of
+response_cache.py), and a repeated submission gets that response back, with
+Idempotent-Replayed: true, before anything reaches the database. Identical
+submissions arriving while the first one runs wait for it. A key reused with
+another body is answered 422.
+With IDEMPOTENCY_FINGERPRINT_SECONDS > 0 the requests without a key are also
+identified by a fingerprint of their body (the test_base and the tests), kept
+only that many seconds: two identical tests are a retry within a few seconds,
+but they are legitimately taken again later.
+"""
+import asyncio
+import hashlib
+import json
+import os
+
+import response_cache
+import serializers
+
+IDEMPOTENCY_BACKEND = os.environ.get('IDEMPOTENCY_BACKEND', 'memory')
+IDEMPOTENCY_TTL_SECONDS = float(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 300))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get('IDEMPOTENCY_MAX_ENTRIES', 100000))
+IDEMPOTENCY_MAX_BYTES = int(os.environ.get('IDEMPOTENCY_MAX_BYTES', 32 * 1024 * 1024))
+IDEMPOTENCY_FINGERPRINT_SECONDS = float(os.environ.get('IDEMPOTENCY_FINGERPRINT_SECONDS', 0))
+
+IDEMPOTENT_PATHS = {"/tests/protocol", "/tests/devices", "/tests/dns", "/tests/ooni/ndt", "/tests/ooni/web"}
+KEY_HEADER = b"idempotency-key"
+REPLAYED_HEADER = (b"idempotent-replayed", b"true")
+
+
+def request_key(scope, body):
+    """
+    the cache key of a submission, the digest of its body and the ttl of its
+    response, the key is None when it is not deduplicated
+    """
+    digest = hashlib.sha256(body).hexdigest()
+    client = scope.get("client")
+    scope_key = "%s:%s" % (client[0] if client else "", scope["path"])
+    for name, value in scope["headers"]:
+        if name == KEY_HEADER:
+            return "idempotency:key:%s:%s" % (scope_key, hashlib.sha256(value).hexdigest()), digest, None
+    if IDEMPOTENCY_FINGERPRINT_SECONDS > 0:
+        return "idempotency:body:%s:%s" % (scope_key, digest), digest, min(IDEMPOTENCY_FINGERPRINT_SECONDS, IDEMPOTENCY_TTL_SECONDS)
+    return None, digest, None
+
+
+def encode(digest, status_code, headers, body):
+    head = json.dumps([digest, status_code, [[name.decode("latin-1"), value.decode("latin-1")] for name, value in headers]])
+    return head.encode() + b"\n" + body
+
+
+def decode(value):
+    head, body = value.split(b"\n", 1)
+    digest, status_code, headers = json.loads(head)
+    return digest, status_code, [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers], body
+
+
+def idempotent_replay():
+    # stands for the endpoint of a replayed response in the metrics
+    pass
+
+
+class SubmissionCache:
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.replays = 0
+        self.stored = 0
+        self.conflicts = 0
+        self.in_progress = {}
+
+    def stats(self):
+        stats = {"replays": self.replays, "stored": self.stored, "conflicts": self.conflicts, "in_progress": len(self.in_progress)}
+        if isinstance(self.backend, response_cache.MemoryBackend):
+            stats.update(entries=len(self.backend), bytes=self.backend.size, evictions=self.backend.evictions)
+        return stats
+
+
+cache = SubmissionCache(response_cache.create_backend(
+    IDEMPOTENCY_BACKEND, IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_MAX_BYTES))
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+class IdempotencyMiddleware:
+
+    def __init__(self, app, submissions=None):
+        self.app = app
+        self.submissions = submissions or cache
+
+    async def __call__(self, scope, receive, send):
+        submissions = self.submissions
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in IDEMPOTENT_PATHS \
+                or submissions.backend is None:
+            await self.app(scope, receive, send)
+            return
+        body = await read_body(receive)
+        if body is None:
+            return
+        key, digest, ttl = request_key(scope, body)
+        if key is None:
+            await self.app(scope, self.replay_body(body, receive), send)
+            return
+        while True:
+            cached = await response_cache.run(submissions.backend, submissions.backend.get, key)
+            if cached is not None:
+                await self.replay(scope, send, digest, cached)
+                return
+            running = submissions.in_progress.get(key)
+            if running is None:
+                break
+            # the first one of a burst of retries, if it fails the next one runs
+            await asyncio.shield(running)
+        running = submissions.in_progress[key] = asyncio.get_event_loop().create_future()
+        try:
+            start = {}
+            chunks = []
+
+            async def send_and_keep(message):
+                if message["type"] == "http.response.start":
+                    start.update(message)
+                elif message["type"] == "http.response.body":
+                    chunks.append(message.get("body", b""))
+                await send(message)
+
+            await self.app(scope, self.replay_body(body, receive), send_and_keep)
+            if 200 <= start.get("status", 500) < 300:
+                await response_cache.run(submissions.backend, submissions.backend.set, key,
+                                         encode(digest, start["status"], start.get("headers", []), b"".join(chunks)), ttl)
+                submissions.stored += 1
+        finally:
+            del submissions.in_progress[key]
+            running.set_result(None)
+
+    @staticmethod
+    def replay_body(body, receive):
+        sent = False
+
+        async def replayed():
+            nonlocal sent
+            if sent:
+                return await receive()
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return replayed
+
+    async def replay(self, scope, send, digest, cached):
+        scope["endpoint"] = idempotent_replay
+        stored_digest, status_code, headers, body = decode(cached)
+        if stored_digest != digest:
+            self.submissions.conflicts += 1
+            response = serializers.JSONResponse(
+                status_code=422, content={"message": "Idempotency-Key already used with a different body"})
+            await response(scope, None, send)
+            return
+        self.submissions.replays += 1
+        await send({"type": "http.response.start", "status": status_code, "headers": headers + [REPLAYED_HEADER]})
+        await send({"type": "http.response.body", "body": body})
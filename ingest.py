@@ -0,0 +1,88 @@
+"""
+Bulk ingestion of test submissions. A submission is the tests row of a client
+plus its child rows, every submission given to insert_submissions is written in
+a single transaction with multi-row inserts, so the number of round trips does
+not depend on the number of rows and a failure never leaves an orphan tests row.
+The per asn rollups (see rollups.py) and the latest results of the clients (see
+latest_results.py) are updated in the same transaction when their mode is inline.
+"""
+from collections import namedtuple
+from datetime import datetime, timezone
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from typing import List
+
+import database
+import latest_results
+import models
+import partitions
+import queries
+import rollups
+import serializers
+
+"""
+tests: list of schemas of model_test, tcp_connect: for web tests, the list of
+TcpConnectWebTestOoni schemas of each one of the tests, timestamp: when the test
+was taken if it is not now, as for backfilled results
+"""
+Submission = namedtuple(
+    'Submission', ['ip', 'test_base', 'model_test', 'tests', 'tcp_connect', 'timestamp'], defaults=(None, None))
+
+RESERVE_IDS = text(
+    "SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)")
+
+
+def reserve_ids(db: Session, model: models.Base, count: int):
+    if count == 0:
+        return []
+    return [row[0] for row in db.execute(RESERVE_IDS, {"table": model.__tablename__, "count": count})]
+
+
+def insert_rows(db: Session, model: models.Base, rows: List[dict], batch_size: int):
+    for start in range(0, len(rows), batch_size):
+        db.execute(model.__table__.insert(), rows[start:start + batch_size])
+
+
+def insert_submissions(db: Session, submissions: List[Submission], batch_size: int = database.BULK_INSERT_BATCH_SIZE):
+    try:
+        now = datetime.now(timezone.utc)
+        partitions.check_partitions(db, [submission.timestamp or now for submission in submissions])
+        test_ids = reserve_ids(db, models.Test, len(submissions))
+        asn_ids = {}
+        test_rows = []
+        child_rows = {}
+        tcp_connects = []
+        for test_id, submission in zip(test_ids, submissions):
+            if submission.ip not in asn_ids:
+                asn = queries.get_asn_by_ip(db, submission.ip)
+                asn_ids[submission.ip] = asn.id if asn else None
+            # child rows reference their test by (id, timestamp), the partition key
+            timestamp = submission.timestamp or now
+            test_rows.append(dict(serializers.values(submission.test_base), id=test_id, timestamp=timestamp,
+                                  public_ip=submission.ip, asn_id=asn_ids[submission.ip]))
+            rows = child_rows.setdefault(submission.model_test, [])
+            for position, test in enumerate(submission.tests):
+                rows.append(dict(serializers.values(test), test_id=test_id, test_timestamp=timestamp))
+                if submission.tcp_connect is not None:
+                    tcp_connects.append((len(rows) - 1, submission.tcp_connect[position]))
+
+        insert_rows(db, models.Test, test_rows, batch_size)
+        if tcp_connects:
+            web_rows = child_rows[models.WebTestOoni]
+            for web_row, web_id in zip(web_rows, reserve_ids(db, models.WebTestOoni, len(web_rows))):
+                web_row["id"] = web_id
+            child_rows[models.TcpConnectWebTestOoni] = [
+                dict(serializers.values(tcp_connect), test_id=web_rows[position]["id"],
+                     test_timestamp=web_rows[position]["test_timestamp"])
+                for position, tcp_connect_list in tcp_connects for tcp_connect in tcp_connect_list]
+        for model_test, rows in child_rows.items():
+            insert_rows(db, model_test, rows, batch_size)
+        if rollups.ROLLUP_MODE == "inline":
+            rollups.update(db, test_rows, child_rows, now)
+        if latest_results.LATEST_RESULTS_MODE == "inline":
+            latest_results.update(db, submissions)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return test_ids
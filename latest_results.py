@@ -0,0 +1,261 @@
+"""
+Snapshot of the latest results of every client, so GET /tests/ reads one row of
+latest_results by primary key instead of querying every test table.
+A row holds, for its public_ip, the JSON of each section of the response
+(protocols_test, devices_test, dns_tests, ndt_tests_ooni, web_tests_ooni) as
+queries.py renders it, manufacturers and ndt percentiles included, and the
+response is the concatenation of the sections asked for. The row also has its
+version, incremented every time it is rendered, which with the version of the
+manufacturers and ndt distributions is the ETag of the response, and the
+version of those it was rendered with: its sections are read from the test
+tables while they are other, or while they were not rendered yet.
+With LATEST_RESULTS_MODE=inline (the default) ingest.insert_submissions renders
+again the sections of the tests it inserts, in the same transaction, after
+locking the rows of their clients so concurrent submissions of a client are
+applied one after the other. The write-behind flusher and the bulk import insert
+through it too, so the row of a client is current as soon as its tests are.
+With LATEST_RESULTS_MODE=deferred the rows are rendered by a single process running
+    python latest_results.py refresh [seconds]
+which renders again the clients of the tests inserted since its last refresh,
+and every client rendered with other manufacturers or ndt distributions once
+they change, every given seconds if any. GET /tests/ then answers the row as it
+was at the last refresh, up to those seconds behind the POSTs of the client.
+    python latest_results.py rebuild [ip ...]
+renders every section of every client (or of the given ones), as the clients
+that tested before the table existed have no row. The version of a client
+without a row is the one of its latest test. With LATEST_RESULTS_MODE=off the
+table is neither updated nor read.
+"""
+from sqlalchemy import cast, func, select, text
+from sqlalchemy.dialects.postgresql import INET, insert
+from sqlalchemy.orm import Session
+import ipaddress
+import logging
+import os
+import sys
+import time
+
+import database
+import lookups
+import models
+import percentiles
+import queries
+import serializers
+
+LATEST_RESULTS_MODE = os.environ.get('LATEST_RESULTS_MODE', 'inline')
+LATEST_RESULTS_BATCH_SIZE = int(os.environ.get('LATEST_RESULTS_BATCH_SIZE', 1000))
+# tests ids are reserved before their transaction commits, so a refresh also
+# goes back over the clients of this many tests before the watermark
+LATEST_RESULTS_WATERMARK_OVERLAP = int(os.environ.get('LATEST_RESULTS_WATERMARK_OVERLAP', 10000))
+
+WATERMARK = "latest_results"
+
+# the sections of the response, in their order, and the query rendering each one
+SECTIONS = {
+    "protocols_test": lambda db, ip: queries.get_tests_with_list(db, ip, models.ProtocolTest),
+    "devices_test": queries.get_devices_tests,
+    "dns_tests": lambda db, ip: queries.get_tests(db, ip, models.DnsTest),
+    "ndt_tests_ooni": lambda db, ip: queries.get_ndt_test(db, ip, models.NdtTestOoni),
+    "web_tests_ooni": lambda db, ip: queries.get_tests(db, ip, models.WebTestOoni),
+}
+TYPE_SECTIONS = {
+    None: tuple(SECTIONS),
+    models.TestsName.basic_tests: ("protocols_test", "dns_tests"),
+    models.TestsName.devices_tests: ("devices_test",),
+    models.TestsName.ndt_tests_ooni: ("ndt_tests_ooni",),
+    models.TestsName.web_tests_ooni: ("web_tests_ooni",),
+}
+MODEL_SECTIONS = {
+    models.ProtocolTest: "protocols_test",
+    models.DevicesTest: "devices_test",
+    models.DnsTest: "dns_tests",
+    models.NdtTestOoni: "ndt_tests_ooni",
+    models.WebTestOoni: "web_tests_ooni",
+}
+
+CLIENTS = text("SELECT DISTINCT public_ip FROM tests")
+# the clients of the tests between the ids whose row is not of their latest test
+CHANGED_CLIENTS = text("""
+SELECT clients.public_ip FROM (
+    SELECT DISTINCT public_ip FROM tests WHERE id > :after AND id <= :last AND public_ip IS NOT NULL
+) clients LEFT JOIN latest_results ON latest_results.public_ip = clients.public_ip
+WHERE latest_results.latest_test_id IS DISTINCT FROM (
+    SELECT id FROM tests WHERE public_ip = clients.public_ip ORDER BY timestamp DESC, id DESC LIMIT 1)
+""")
+OTHER_VERSION_CLIENTS = text("SELECT public_ip FROM latest_results WHERE references_version IS DISTINCT FROM :version")
+
+
+def ip_order(ip):
+    # the order of inet, ipv4 first
+    address = ipaddress.ip_address(ip)
+    return address.version, address
+
+
+def references_version():
+    """
+    the version of the manufacturers and ndt distributions the sections are rendered with
+    """
+    if lookups.manuf_index.version is None or percentiles.reference.version is None:
+        return None
+    return "%s:%s" % (lookups.manuf_index.version, percentiles.reference.version)
+
+
+def render_sections(db: Session, ip, names):
+    """
+    the sections as JSON and the timestamp of their oldest test
+    """
+    rendered = {}
+    oldest = None
+    for name in names:
+        content = SECTIONS[name](db, ip)
+        rendered[name] = serializers.dumps(content).decode("utf-8")
+        for result in content:
+            if oldest is None or result["timestamp"] < oldest:
+                oldest = result["timestamp"]
+    return rendered, oldest
+
+
+def refresh(db: Session, sections_by_ip):
+    """
+    renders again the given sections of every ip, and the ones it does not have
+    yet, all of them when the row was rendered with other references. Does not commit.
+    sections_by_ip: dict of ip to the names of its sections
+    """
+    if not sections_by_ip:
+        return
+    table = models.LatestResult.__table__
+    version = references_version()
+    ips = sorted(sections_by_ip, key=ip_order)
+    db.execute(insert(table).values([{"public_ip": ip} for ip in ips]).on_conflict_do_nothing())
+    # the rows are locked in the same order by every transaction
+    rows = db.execute(select(table).where(table.c.public_ip.in_([cast(ip, INET) for ip in ips])).
+                      order_by(table.c.public_ip).with_for_update())
+    missing = {}
+    for row in rows:
+        current = version is not None and row.references_version == version and row.latest_test_id is not None
+        missing[ipaddress.ip_address(row.public_ip)] = {
+            name for name in SECTIONS if not current or getattr(row, name) is None}
+    for ip in ips:
+        names = [name for name in SECTIONS
+                 if name in sections_by_ip[ip] or name in missing.get(ipaddress.ip_address(ip), ())]
+        rendered, oldest = render_sections(db, ip, names)
+        latest = queries.get_latest_test(db, ip)
+        db.execute(table.update().where(table.c.public_ip == cast(ip, INET)).values(
+            oldest_timestamp=func.least(table.c.oldest_timestamp, oldest), updated_at=func.now(),
+            version=table.c.version + 1, latest_test_id=latest.id if latest else None,
+            references_version=version, **rendered))
+
+
+def update(db: Session, submissions):
+    """
+    refreshes the sections of the tests of the submissions, in the transaction inserting them
+    """
+    sections_by_ip = {}
+    for submission in submissions:
+        sections_by_ip.setdefault(submission.ip, set()).add(MODEL_SECTIONS[submission.model_test])
+    refresh(db, sections_by_ip)
+
+
+def read(db: Session, ip, type_test: models.TestsName = None):
+    """
+    the version of the latest results of ip and the JSON of the sections of the
+    snapshot current for the manufacturers and ndt distributions, by name
+    """
+    if LATEST_RESULTS_MODE != "off":
+        names = TYPE_SECTIONS[type_test]
+        table = models.LatestResult.__table__
+        row = db.execute(select([table.c.version, table.c.references_version] + [table.c[name] for name in names]).
+                         where(table.c.public_ip == cast(ip, INET))).first()
+        if row is not None:
+            version, rendered_version, *sections = row
+            if rendered_version is None or rendered_version != references_version():
+                return "row:%s" % version, {}
+            return "row:%s" % version, {
+                name: value.encode("utf-8") for name, value in zip(names, sections) if value is not None}
+    latest = queries.get_latest_test(db, ip)
+    return ("test:%s:%s" % (latest.id, latest.timestamp.isoformat()) if latest else None), {}
+
+
+def get(db: Session, ip, type_test: models.TestsName = None, rendered=None):
+    """
+    the rendered GET /tests/ response of ip, the sections not in rendered are read from the test tables
+    rendered: the JSON of the sections read from the snapshot by read, by name
+    """
+    rendered = rendered or {}
+    parts = []
+    for name in TYPE_SECTIONS[type_test]:
+        body = rendered.get(name)
+        if body is None:
+            body = serializers.dumps(SECTIONS[name](db, ip))
+        parts.append(b'"%s":%s' % (name.encode(), body))
+    return b"{" + b",".join(parts) + b"}"
+
+
+def render(engine, ips):
+    """
+    renders every section of the given ips, one transaction per batch
+    """
+    for start in range(0, len(ips), LATEST_RESULTS_BATCH_SIZE):
+        db = Session(bind=engine)
+        try:
+            refresh(db, {ip: set(SECTIONS) for ip in ips[start:start + LATEST_RESULTS_BATCH_SIZE]})
+            db.commit()
+        finally:
+            db.close()
+
+
+def rebuild(engine=None, ips=None):
+    """
+    renders every section of the given ips, by default of every client, returns their count
+    """
+    engine = engine or database.engine
+    if ips is None:
+        with engine.connect() as connection:
+            ips = [row[0] for row in connection.execute(CLIENTS)]
+    render(engine, ips)
+    return len(ips)
+
+
+def refresh_changed(engine=None, version=None):
+    """
+    renders again the clients of the tests inserted since the last refresh, and
+    when the references are not of the given version anymore, the clients
+    rendered with other ones. Returns the count of clients and the version.
+    """
+    engine = engine or database.engine
+    lookups.manuf_index.reload()
+    percentiles.reference.reload()
+    current = references_version()
+    with engine.connect() as connection:
+        watermark = connection.execute(select([models.RollupWatermark.test_id]).where(
+            models.RollupWatermark.name == WATERMARK)).scalar() or 0
+        last_id = connection.execute(select([func.max(models.Test.id)])).scalar() or 0
+        ips = {row[0] for row in connection.execute(CHANGED_CLIENTS, {
+            "after": watermark - LATEST_RESULTS_WATERMARK_OVERLAP, "last": last_id})}
+        if current != version:
+            ips.update(row[0] for row in connection.execute(OTHER_VERSION_CLIENTS, {"version": current}))
+    render(engine, sorted(ips, key=ip_order))
+    with engine.begin() as connection:
+        table = models.RollupWatermark.__table__
+        statement = insert(table).values(name=WATERMARK, test_id=last_id)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.name], set_={"test_id": func.greatest(table.c.test_id, statement.excluded.test_id)}))
+    return len(ips), current
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "refresh":
+        seconds = float(sys.argv[2]) if len(sys.argv) > 2 else None
+        version = None
+        while True:
+            count, version = refresh_changed(version=version)
+            logging.info("latest results of %s clients refreshed", count)
+            if seconds is None:
+                break
+            time.sleep(seconds)
+    elif command == "rebuild":
+        logging.info("latest results of %s clients rebuilt", rebuild(ips=sys.argv[2:] or None))
+    else:
+        sys.exit("usage: python latest_results.py [refresh [seconds] | rebuild [ip ...]]")
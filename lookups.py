@@ -0,0 +1,240 @@
+"""
+In-memory indexes over the reference tables, so resolving the asn of a client
+or the manufacturer of a device does not need a database round trip.
+Each index keeps an immutable snapshot that a daemon thread rebuilds whenever
+the underlying tables change, requests only ever read the current snapshot.
+"""
+from array import array
+from bisect import bisect_right
+from sqlalchemy import bindparam, text
+import hashlib
+import ipaddress
+import logging
+import os
+import threading
+
+import database
+import models
+
+REFRESH_SECONDS = float(os.environ.get('REFERENCE_REFRESH_SECONDS', 300))
+
+MAC_BITS = 48
+NO_ASN = 0  # AS0 is reserved (RFC 7607), so it marks the gaps between prefixes
+
+# the rows of a partitioned table are counted in its partitions, which are added
+# up, with their number so that attaching or dropping one changes the signature
+TABLES_SIGNATURE = text(
+    "SELECT tables.relname, tables.relid, sum(stats.n_tup_ins), sum(stats.n_tup_upd), sum(stats.n_tup_del), count(*) "
+    "FROM pg_stat_user_tables tables JOIN pg_stat_user_tables stats ON stats.relid = tables.relid "
+    "OR stats.relid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = tables.relid) "
+    "WHERE tables.relname IN :tables GROUP BY tables.relname, tables.relid ORDER BY tables.relname"
+).bindparams(bindparam('tables', expanding=True))
+
+
+class ReferenceIndex:
+    tables = ()
+    refresh_seconds = REFRESH_SECONDS
+
+    def __init__(self):
+        self.snapshot = None
+        self.version = None
+        self._signature = None
+        self._reload_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def loaded(self):
+        return self.snapshot is not None
+
+    def signature(self, db):
+        return db.execute(TABLES_SIGNATURE, {'tables': list(self.tables)}).fetchall()
+
+    def build(self, db):
+        raise NotImplementedError
+
+    def digest(self, snapshot):
+        """
+        a digest of the content of a snapshot, the same in every process that
+        built it from the same rows, None when it is not needed
+        """
+        return None
+
+    def reload(self, force=False):
+        with self._reload_lock:
+            db = database.SessionLocal()
+            try:
+                signature = self.signature(db)
+                if force or signature != self._signature:
+                    snapshot = self.build(db)
+                    self.version = self.digest(snapshot)
+                    self.snapshot = snapshot
+                    self._signature = signature
+                    logging.info("%s reloaded", type(self).__name__)
+            finally:
+                db.close()
+
+    def _run(self):
+        while not self._stop.wait(self.refresh_seconds):
+            try:
+                self.reload()
+            except Exception as e:
+                logging.error("Error reloading %s" % type(self).__name__, exc_info=e)
+
+    def start(self):
+        try:
+            self.reload()
+        except Exception as e:
+            logging.error("Error loading %s" % type(self).__name__, exc_info=e)
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name=type(self).__name__, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+
+class PrefixTable:
+    """
+    Longest prefix match over a set of prefixes of one address family.
+    Nested prefixes are flattened into disjoint ranges, so a lookup is a single
+    binary search over a sorted array of range starts.
+    """
+
+    def __init__(self, prefixes, max_bits):
+        prefixes = sorted(prefixes, key=lambda p: (p[0], -p[1], p[2]))
+        # when every prefix is at most /64 all range boundaries are /64 aligned,
+        # so ipv6 ranges fit in 64 bit words instead of python ints
+        self.shift = 64 if max_bits == 128 and all(
+            length <= 64 for length in self._lengths(prefixes, max_bits)) else 0
+        starts, asns = self._flatten(prefixes, max_bits)
+        if max_bits == 32:
+            self.starts = array('I', starts)
+        elif self.shift:
+            self.starts = array('Q', (start >> self.shift for start in starts))
+        else:
+            self.starts = starts
+        self.asns = array('I', asns)
+
+    @staticmethod
+    def _lengths(prefixes, max_bits):
+        for start, end, _ in prefixes:
+            yield max_bits - (end - start + 1).bit_length() + 1
+
+    @staticmethod
+    def _flatten(prefixes, max_bits):
+        starts, asns = [], []
+        limit = 1 << max_bits
+
+        def emit(position, asn_id):
+            if position >= limit:
+                return
+            if starts and starts[-1] == position:
+                starts.pop()
+                asns.pop()
+            if asns and asns[-1] == asn_id:
+                return
+            starts.append(position)
+            asns.append(asn_id)
+
+        enclosing = []
+        for start, end, asn_id in prefixes:
+            while enclosing and enclosing[-1][0] < start:
+                inner_end, _ = enclosing.pop()
+                emit(inner_end + 1, enclosing[-1][1] if enclosing else NO_ASN)
+            emit(start, asn_id)
+            enclosing.append((end, asn_id))
+        while enclosing:
+            inner_end, _ = enclosing.pop()
+            emit(inner_end + 1, enclosing[-1][1] if enclosing else NO_ASN)
+        return starts, asns
+
+    def lookup(self, ip_int):
+        position = bisect_right(self.starts, ip_int >> self.shift) - 1
+        return self.asns[position] if position >= 0 else NO_ASN
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class AsnIndex(ReferenceIndex):
+    tables = (models.Asn.__tablename__, models.LatestSubnetAsns.__tablename__)
+
+    def build(self, db):
+        prefixes = {4: [], 6: []}
+        for asn_id, subnet in db.query(models.LatestSubnetAsns.asn_id, models.LatestSubnetAsns.subnet).yield_per(10000):
+            network = ipaddress.ip_network(subnet, strict=False)
+            prefixes[network.version].append(
+                (int(network.network_address), int(network.broadcast_address), asn_id))
+        names = dict(db.query(models.Asn.id, models.Asn.name))
+        return {
+            4: PrefixTable(prefixes[4], 32),
+            6: PrefixTable(prefixes[6], 128),
+            'names': names,
+        }
+
+    def lookup(self, ip):
+        snapshot = self.snapshot
+        address = ipaddress.ip_address(ip)
+        asn_id = snapshot[address.version].lookup(int(address))
+        if asn_id == NO_ASN or asn_id not in snapshot['names']:
+            return None
+        return models.Asn(id=asn_id, name=snapshot['names'][asn_id])
+
+
+def mac_to_int(mac):
+    return int(mac[:17].replace(':', ''), 16)
+
+
+def int_to_mac(mac_int):
+    digits = "%012x" % mac_int
+    return ":".join(digits[position:position + 2] for position in range(0, 12, 2))
+
+
+def manuf_snapshot(rows):
+    """
+    the entries of the (mac, mask, manuf, comment) rows by masked mac prefix, one dict per mask, longest first
+    """
+    by_mask = {}
+    for mac, mask, manuf, comment in rows:
+        if 0 < mask <= MAC_BITS:
+            by_mask.setdefault(mask, {})[mac_to_int(mac) >> (MAC_BITS - mask)] = (mask, manuf, comment)
+    return sorted(by_mask.items(), reverse=True)
+
+
+def lookup_manuf(snapshot, mac_int):
+    for mask, entries in snapshot:
+        entry = entries.get(mac_int >> (MAC_BITS - mask))
+        if entry is not None:
+            return entry
+    return None
+
+
+class ManufIndex(ReferenceIndex):
+    """
+    One dict per mask in macs_manuf keyed by the masked mac prefix, searched
+    from the longest mask down, so a device mac resolves to its most specific
+    manufacturer entry (/36, /28 or the /24 oui) in O(#masks).
+    """
+    tables = (models.MacManuf.__tablename__,)
+
+    def build(self, db):
+        return manuf_snapshot(db.query(models.MacManuf.mac, models.MacManuf.mask, models.MacManuf.manuf,
+                                       models.MacManuf.comment).yield_per(10000))
+
+    def digest(self, snapshot):
+        content = [(mask, sorted(entries.items())) for mask, entries in snapshot]
+        return hashlib.sha1(repr(content).encode()).hexdigest()[:16]
+
+    def lookup(self, mac):
+        return lookup_manuf(self.snapshot, mac_to_int(mac) if isinstance(mac, str) else mac)
+
+    def lookup_many(self, macs):
+        return [self.lookup(mac) for mac in macs]
+
+
+asn_index = AsnIndex()
+manuf_index = ManufIndex()
@@ -1,22 +1,43 @@
 """
 the code for the following functions was obtained from the following sources.
 get_db: FastApi tutorial (https://fastapi.tiangolo.com/tutorial/sql-databases/#main-fastapi-app)
-adapt_pydantic_ip_address: Adapting types to fix SQLAlchemy's "can't adapt type" error "(https://gaganpreet.in/posts/sqlalchemy-cant-adapt-type/)
 sudo uvicorn main:app --host 0.0.0.0 --port 80
 """
 from fastapi import Depends, FastAPI, HTTPException, Request, status
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from sqlalchemy.orm import Session
 from sqlalchemy.sql import operators
-from psycopg2.extensions import register_adapter, AsIs
-from pydantic.networks import IPv4Address, IPv6Address
 from typing import List
+from datetime import date, datetime, timedelta, timezone
+import hmac
 import logging
+import os
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.openapi.constants import REF_PREFIX
+from fastapi.openapi.utils import validation_error_definition, validation_error_response_definition
+from pydantic.schema import schema as models_schema
+from starlette.concurrency import run_in_threadpool
 import models
 import database
-import queries
 import schemas
+import lookups
+import ingest
+import async_queries
+import response_cache
+import write_behind
+import bulk_import
+import percentiles
+import metrics
+import serializers
+import validation
+import history
+import idempotency
+import admission
+import replicas
+import compression
+import partitions
+import profiling
+import latest_results
 from typing import Optional
 
 
@@ -28,16 +49,46 @@ def get_db():
         db.close()
 
 
-def adapt_pydantic_ip_address(ip):
-    return AsIs(repr(ip.exploded))
+async def get_async_db():
+    async with database.AsyncSessionLocal() as db:
+        yield db
+
+
+get_session = get_async_db if database.DATABASE_ASYNC else get_db
+
+
+def get_read_db(request: Request):
+    # a replica for the read only handlers, see replicas.py
+    db = replicas.router.session(request.client.host, request.cookies)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_read_db(request: Request):
+    async with await replicas.router.async_session(request.client.host, request.cookies) as db:
+        yield db
 
 
-models.Base.metadata.create_all(bind=database.engine)
-app = FastAPI()
+get_read_session = get_async_read_db if database.DATABASE_ASYNC else get_read_db
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+
+def is_admin(request: Request):
+    token = request.headers.get("X-Admin-Token")
+    return ADMIN_TOKEN is not None and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+app = FastAPI(default_response_class=serializers.JSONResponse)
 origins = [
     "0.0.0.0",
 ]
 
+app.add_middleware(idempotency.IdempotencyMiddleware)
+app.add_middleware(admission.AdmissionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -45,19 +96,146 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-register_adapter(IPv4Address, adapt_pydantic_ip_address)
-register_adapter(IPv6Address, adapt_pydantic_ip_address)
+
+app.add_middleware(compression.CompressionMiddleware)
+
+app.add_middleware(profiling.ProfilingMiddleware, is_admin=is_admin)
+
+app.add_middleware(metrics.MetricsMiddleware)
 
 responses = {
     404: {"description": "Error: Not Found"},
 }
 
 
+@app.exception_handler(validation.BatchError)
+async def batch_error_handler(request: Request, exc: validation.BatchError):
+    return exc.response()
+
+
+# the bodies read by validation.read_batch, which FastAPI does not see
+BATCH_BODIES = {
+    ("/tests/protocol", "post"): schemas.ProtocolTestsBody,
+    ("/tests/devices", "post"): schemas.DevicesTestsBody,
+}
+default_openapi = app.openapi
+
+
+def openapi():
+    """
+    the OpenAPI schema of FastAPI, with the request body and the 422 response of the BATCH_BODIES routes
+    """
+    if app.openapi_schema is not None:
+        return app.openapi_schema
+    schema = default_openapi()
+    components = schema.setdefault("components", {}).setdefault("schemas", {})
+    components.setdefault("ValidationError", validation_error_definition)
+    components.setdefault("HTTPValidationError", validation_error_response_definition)
+    for (path, method), model in BATCH_BODIES.items():
+        components.update(models_schema([model], ref_prefix=REF_PREFIX)["definitions"])
+        operation = schema["paths"][path][method]
+        operation["requestBody"] = {
+            "content": {"application/json": {"schema": {"$ref": REF_PREFIX + model.__name__}}}, "required": True}
+        operation["responses"].setdefault("422", {
+            "description": "Validation Error",
+            "content": {"application/json": {"schema": {"$ref": REF_PREFIX + "HTTPValidationError"}}}})
+    return schema
+
+
+app.openapi = openapi
+
+
+@app.on_event("startup")
+def start_reference_indexes():
+    lookups.asn_index.start()
+    lookups.manuf_index.start()
+    percentiles.reference.start()
+
+
+@app.on_event("shutdown")
+def stop_reference_indexes():
+    lookups.asn_index.stop()
+    lookups.manuf_index.stop()
+    percentiles.reference.stop()
+
+
+@app.on_event("startup")
+def start_replica_checks():
+    replicas.router.start()
+
+
+@app.on_event("shutdown")
+def stop_replica_checks():
+    replicas.router.stop()
+
+
+@app.on_event("startup")
+def start_write_behind():
+    if write_behind.pending is not None:
+        write_behind.pending.start()
+
+
+@app.on_event("shutdown")
+def flush_write_behind():
+    if write_behind.pending is not None:
+        write_behind.pending.stop()
+
+
+@app.on_event("shutdown")
+async def dispose_async_engine():
+    if database.async_engine is not None:
+        await database.async_engine.dispose()
+    for replica_engine in database.async_replica_engines:
+        await replica_engine.dispose()
+
+
+async def save_submission(db, response: Response, submission: ingest.Submission):
+    if write_behind.pending is not None:
+        # stamped when received, not when flushed
+        write_behind.pending.put(submission._replace(timestamp=submission.timestamp or datetime.now(timezone.utc)))
+        response.status_code = status.HTTP_202_ACCEPTED
+        await replicas.router.async_stick(submission.ip, response, write_behind.WRITE_BEHIND_FLUSH_SECONDS)
+    else:
+        await async_queries.insert_submissions(db, [submission])
+        await response_cache.run(response_cache.cache.backend, response_cache.cache.invalidate, submission.ip)
+        await replicas.router.async_stick(submission.ip, response)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    gauges = {name: database.pool_stats(pool) for name, pool in database.pools()}
+    gauges["response_cache"] = response_cache.cache.stats()
+    gauges["idempotency"] = idempotency.cache.stats()
+    gauges["admission"] = admission.admission.stats()
+    gauges["replicas"] = replicas.router.stats()
+    if write_behind.pending is not None:
+        gauges["write_behind"] = write_behind.pending.stats()
+    return Response(content=metrics.render(gauges), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/health")
+async def get_health():
+    return {"status": "ok"}
+
+
+@app.get("/ready", responses={503: {"description": "Error: Service Unavailable"}})
+async def get_ready():
+    pools = {name: database.pool_stats(pool) for name, pool in database.pools()}
+    if any(stats["saturation"] >= database.DB_READY_MAX_SATURATION for stats in pools.values()):
+        return JSONResponse(status_code=503, content={"status": "saturated", "pools": pools})
+    try:
+        await run_in_threadpool(database.ping)
+    except Exception as e:
+        logging.error("Error connecting to the database", exc_info=e)
+        return JSONResponse(status_code=503, content={"status": "unavailable", "pools": pools})
+    return {"status": "ready", "pools": pools}
+
+
 @app.get("/asn", responses={**responses})
-def get_asn(request: Request, db: Session = Depends(get_db)):
+async def get_asn(request: Request, db: Session = Depends(get_read_session)):
     try:
         client_host = request.client.host
-        asn = queries.get_asn_by_ip(db, client_host)
+        asn = await async_queries.get_asn_by_ip(db, client_host)
         return {
             "client_host": client_host,
             "asn": asn
@@ -69,14 +247,17 @@ def get_asn(request: Request, db: Session = Depends(get_db)):
 
 
 @app.post("/tests/protocol", responses={**responses}, status_code=status.HTTP_201_CREATED)
-def add_protocol_test(request: Request, test: List[schemas.ProtocolTest], test_base: schemas.TestBase = schemas.TestBase(), db: Session = Depends(get_db)):
+async def add_protocol_test(request: Request, response: Response, db: Session = Depends(get_session)):
+    # body {"test": List[schemas.ProtocolTest], "test_base": schemas.TestBase}, validated in one pass
+    test_base, test = await validation.read_batch(request, validation.validate_protocol_tests)
     try:
         ip = request.client.host
-        db_test_base = queries.create_test_base(db, test_base, ip)
-        db_test_base_id = db_test_base.id
-        for protocol_test in test:
-            queries.create_specific_test(
-                db, protocol_test, models.ProtocolTest, db_test_base_id)
+        await save_submission(db, response, ingest.Submission(ip, test_base, models.ProtocolTest, test))
+    except write_behind.QueueFull:
+        return write_behind.queue_full_response()
+    except partitions.MissingPartition as e:
+        logging.error("Error adding results", exc_info=e)
+        return e.response()
     except Exception as e:
         message = "Error adding results to protocol tests table"
         logging.error(message, exc_info=e)
@@ -85,24 +266,30 @@ def add_protocol_test(request: Request, test: List[schemas.ProtocolTest], test_b
 
 """
 if no device has a known mac then do not add the test base. Also, add only if mac exists to devices tests. 
+Each device is answered with its own mac and mask, and the manufacturer of its
+most specific entry of macs_manuf (/36, /28 or the /24 oui).
 """
 
 
 @app.post("/tests/devices", responses={**responses}, status_code=status.HTTP_201_CREATED, response_model=List[schemas.MacManufOut])
-def add_devices_tests(request: Request, test: List[schemas.DevicesTest], test_base: schemas.TestBase = schemas.TestBase(), db: Session = Depends(get_db)):
+async def add_devices_tests(request: Request, response: Response, db: Session = Depends(get_session)):
+    # body {"test": List[schemas.DevicesTest], "test_base": schemas.TestBase}, validated in one pass
+    test_base, test = await validation.read_batch(request, validation.validate_devices_tests)
     try:
         ip = request.client.host
-        db_test_base_id = None
-        manuf_devices = []
-        for devices_test in test:
-            if db_test_base_id is None:
-                db_test_base_id = queries.create_test_base(
-                    db, test_base, ip).id
-            manuf_device = queries.get_manuf(db, devices_test)
-            queries.create_specific_test(
-                db, devices_test, models.DevicesTest, db_test_base_id)
-            manuf_devices.append(manuf_device)
-        return manuf_devices
+        if test:
+            await save_submission(db, response, ingest.Submission(ip, test_base, models.DevicesTest, test))
+        # already validated, skips validating them again against the response_model
+        manufs = serializers.JSONResponse(content=await async_queries.get_manufs(db, test),
+                                          status_code=response.status_code or status.HTTP_201_CREATED)
+        # FastAPI only adds the headers of response, as the sticky cookie, to the responses it renders
+        manufs.headers.raw.extend(response.headers.raw)
+        return manufs
+    except write_behind.QueueFull:
+        return write_behind.queue_full_response()
+    except partitions.MissingPartition as e:
+        logging.error("Error adding results", exc_info=e)
+        return e.response()
     except Exception as e:
         message = "Error adding results to devices tests table"
         logging.error(message, exc_info=e)
@@ -110,12 +297,15 @@ def add_devices_tests(request: Request, test: List[schemas.DevicesTest], test_ba
 
 
 @app.post("/tests/dns", responses={**responses}, status_code=status.HTTP_201_CREATED)
-def add_dns_test(request: Request, dns_test: schemas.DnsTest, test_base: schemas.TestBase = schemas.TestBase(), db: Session = Depends(get_db)):
+async def add_dns_test(request: Request, response: Response, dns_test: schemas.DnsTest, test_base: schemas.TestBase = schemas.TestBase(), db: Session = Depends(get_session)):
     try:
         ip = request.client.host
-        db_test_base = queries.create_test_base(db, test_base, ip)
-        queries.create_specific_test(
-            db, dns_test, models.DnsTest, db_test_base.id)
+        await save_submission(db, response, ingest.Submission(ip, test_base, models.DnsTest, [dns_test]))
+    except write_behind.QueueFull:
+        return write_behind.queue_full_response()
+    except partitions.MissingPartition as e:
+        logging.error("Error adding results", exc_info=e)
+        return e.response()
     except Exception as e:
         message = "Error adding results to dns tests table"
         logging.error(message, exc_info=e)
@@ -123,12 +313,15 @@ def add_dns_test(request: Request, dns_test: schemas.DnsTest, test_base: schemas
 
 
 @app.post("/tests/ooni/ndt", responses={**responses}, status_code=status.HTTP_201_CREATED)
-def add_ndt_test(request: Request, test: schemas.NdtTestOoni, test_base: schemas.TestBase = schemas.TestBase(), db: Session = Depends(get_db)):
+async def add_ndt_test(request: Request, response: Response, test: schemas.NdtTestOoni, test_base: schemas.TestBase = schemas.TestBase(), db: Session = Depends(get_session)):
     try:
         ip = request.client.host
-        db_test_base = queries.create_test_base(db, test_base, ip)
-        queries.create_specific_test(
-            db, test, models.NdtTestOoni, db_test_base.id)
+        await save_submission(db, response, ingest.Submission(ip, test_base, models.NdtTestOoni, [test]))
+    except write_behind.QueueFull:
+        return write_behind.queue_full_response()
+    except partitions.MissingPartition as e:
+        logging.error("Error adding results", exc_info=e)
+        return e.response()
     except Exception as e:
         message = "Error adding results to ndt tests table"
         logging.error(message, exc_info=e)
@@ -136,46 +329,102 @@ def add_ndt_test(request: Request, test: schemas.NdtTestOoni, test_base: schemas
 
 
 @app.post("/tests/ooni/web", responses={**responses}, status_code=status.HTTP_201_CREATED)
-def add_web_test_ooni(request: Request, web_test_ooni: schemas.WebTestOoni, tcp_connect_web_tests_ooni: List[schemas.TcpConnectWebTestOoni] = [], test_base: schemas.TestBase = schemas.TestBase(), db: Session = Depends(get_db)):
+async def add_web_test_ooni(request: Request, response: Response, web_test_ooni: schemas.WebTestOoni, tcp_connect_web_tests_ooni: List[schemas.TcpConnectWebTestOoni] = [], test_base: schemas.TestBase = schemas.TestBase(), db: Session = Depends(get_session)):
     try:
         ip = request.client.host
-        db_test_base = queries.create_test_base(db, test_base, ip)
-        db_web_test_ooni_id = queries.create_specific_test(
-            db, web_test_ooni, models.WebTestOoni, db_test_base.id).id
-        for tcp_connect in tcp_connect_web_tests_ooni:
-            queries.create_specific_test(
-                db, tcp_connect, models.TcpConnectWebTestOoni, db_web_test_ooni_id)
+        await save_submission(db, response, ingest.Submission(
+            ip, test_base, models.WebTestOoni, [web_test_ooni], [tcp_connect_web_tests_ooni]))
+    except write_behind.QueueFull:
+        return write_behind.queue_full_response()
+    except partitions.MissingPartition as e:
+        logging.error("Error adding results", exc_info=e)
+        return e.response()
     except Exception as e:
         message = "Error adding results to web tests"
         logging.error(message, exc_info=e)
         return JSONResponse(status_code=404, content={"message": message})
 
 
-@app.get("/tests/", responses={**responses})
-def get_tests(request: Request, type_test: models.TestsName = None, db: Session = Depends(get_db)):
+"""
+bulk import of backfilled results as NDJSON, see bulk_import.py for the format of the lines.
+"""
+
+
+@app.post("/tests/import", responses={**responses, 403: {"description": "Error: Forbidden"}})
+async def import_tests(request: Request, db: Session = Depends(get_session)):
+    if not is_admin(request):
+        return JSONResponse(status_code=403, content={"message": "Forbidden"})
+    report = bulk_import.ImportReport()
+    chunk = []
+    line_number = 0
+    async for line in bulk_import.iter_lines(request.stream()):
+        line_number += 1
+        bulk_import.add_line(report, chunk, line_number, line)
+        if len(chunk) >= bulk_import.IMPORT_CHUNK_SIZE:
+            await async_queries.run(db, bulk_import.insert_chunk, chunk, report)
+            chunk = []
+    if chunk:
+        await async_queries.run(db, bulk_import.insert_chunk, chunk, report)
+    return report.dict()
+
+
+"""
+history of the tests of the client, newest first, in pages of limit tests. The
+next_cursor of a page gives the following one, null on the last page.
+"""
+
+
+@app.get("/tests/history", responses={**responses, 400: {"description": "Error: Bad Request"}})
+async def get_tests_history(request: Request, type_test: models.TestsName = None, since: datetime = None, until: datetime = None,
+                            cursor: str = None, limit: int = history.HISTORY_PAGE_SIZE, db: Session = Depends(get_read_session)):
     ip = request.client.host
-    if (type_test == None):
-        return {
-            "protocols_test": queries.get_tests_with_list(db, ip, models.ProtocolTest),
-            "devices_test": queries.get_devices_tests(db, ip),
-            "dns_tests": queries.get_tests(db, ip, models.DnsTest),
-            "ndt_tests_ooni": queries.get_ndt_test(db, ip, models.NdtTestOoni),
-            "web_tests_ooni": queries.get_tests(db, ip, models.WebTestOoni)
-        }
-    elif (type_test == models.TestsName.basic_tests):
-        return {
-            "protocols_test": queries.get_tests_with_list(db, ip, models.ProtocolTest),
-            "dns_tests": queries.get_tests(db, ip, models.DnsTest)
-        }
-    elif (type_test == models.TestsName.devices_tests):
-        return {
-            "devices_test": queries.get_devices_tests(db, ip),
-        }
-    elif (type_test == models.TestsName.ndt_tests_ooni):
-        return {
-            "ndt_tests_ooni": queries.get_ndt_test(db, ip, models.NdtTestOoni)
-        }
-    elif (type_test == models.TestsName.web_tests_ooni):
+    try:
+        position = history.decode_cursor(cursor) if cursor else None
+    except ValueError:
+        return JSONResponse(status_code=400, content={"message": "Invalid cursor"})
+    return StreamingResponse(async_queries.iterate(db, history.stream, ip, type_test, since, until, position, limit),
+                             media_type="application/json")
+
+
+"""
+stats of the tests of an asn over the last days, read from the rollups in rollups.py.
+"""
+
+
+@app.get("/stats/asn/{asn_id}", responses={**responses})
+async def get_asn_stats(asn_id: int, days: int = 30, db: Session = Depends(get_read_session)):
+    try:
+        since = date.today() - timedelta(days=max(1, days) - 1)
         return {
-            "web_tests_ooni": queries.get_tests(db, ip, models.WebTestOoni)
+            "asn_id": asn_id,
+            "since": since,
+            **await async_queries.get_asn_stats(db, asn_id, since)
         }
+    except Exception as e:
+        message = "Error getting asn stats"
+        logging.error(message, exc_info=e)
+        return JSONResponse(status_code=404, content={"message": message})
+
+
+"""
+latest results of the client, one row of the snapshot in latest_results.py read
+by primary key. Its ETag is the version of that row and of the manufacturers and
+ndt distributions, so If-None-Match is answered 304 after reading the row only,
+and a cached response is only served while it has that ETag.
+"""
+
+
+@app.get("/tests/", responses={**responses, 304: {"description": "Not Modified"}})
+async def get_tests(request: Request, type_test: models.TestsName = None, db: Session = Depends(get_read_session)):
+    ip = request.client.host
+    version, rendered = await async_queries.read_latest_results(db, ip, type_test)
+    etag = compression.etag(type_test, latest_results.references_version(), version)
+    matched = compression.if_none_match(request.headers.get("if-none-match"), etag)
+    if matched is not None:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": matched, **compression.CACHE_HEADERS})
+    cache = response_cache.cache
+    body = await response_cache.run(cache.backend, cache.get, ip, type_test, etag)
+    if body is None:
+        body = await async_queries.get_latest_results(db, ip, type_test, rendered)
+        await response_cache.run(cache.backend, cache.set_body, ip, type_test, body, etag)
+    return Response(content=body, media_type="application/json", headers={"ETag": etag, **compression.CACHE_HEADERS})
@@ -0,0 +1,234 @@
+"""
+Request and database instrumentation, exposed in the Prometheus text format by
+GET /metrics. Each worker process keeps and exposes its own numbers.
+MetricsMiddleware times every request and, through the engine events installed
+by instrument(), counts the statements and the database time spent on it. The
+pools of the engines are TimedQueuePool/TimedAsyncAdaptedQueuePool, which time
+how long a checkout waits for a connection.
+Statements slower than SLOW_QUERY_SECONDS are logged with their parameters, and
+SQL_ECHO_SAMPLE_RATE (0 to 1) logs that share of all the statements, instead of
+echoing every one of them.
+"""
+from bisect import bisect_left
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+import logging
+import os
+import random
+import threading
+import time
+
+SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS', 0.5))
+SQL_ECHO_SAMPLE_RATE = float(os.environ.get('SQL_ECHO_SAMPLE_RATE', 0))
+PARAMETERS_MAX_LENGTH = 1000
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+sql_logger = logging.getLogger("metrics.sql")
+if SQL_ECHO_SAMPLE_RATE > 0:
+    sql_logger.setLevel(logging.INFO)
+    sql_logger.addHandler(logging.StreamHandler())
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, escape(value)) for name, value in zip(names, values))
+
+
+class Counter:
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s counter" % self.name]
+        with self._lock:
+            for label_values, value in self._values.items():
+                lines.append("%s%s %s" % (self.name, format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # counts of each bucket (and +Inf), sum
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            for label_values, (counts, total) in self._series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append("%s_bucket%s %s" % (self.name, format_labels(
+                        self.labels + ("le",), label_values + (bound,)), cumulative))
+                lines.append("%s_sum%s %s" % (self.name, format_labels(self.labels, label_values), total))
+                lines.append("%s_count%s %s" % (self.name, format_labels(self.labels, label_values), cumulative))
+        return lines
+
+
+request_seconds = Histogram(
+    "http_request_duration_seconds", "Time to answer a request.", labels=("handler", "method", "status"))
+request_statements = Histogram(
+    "http_request_db_statements", "SQL statements executed by a request.", COUNT_BUCKETS, labels=("handler",))
+request_db_seconds = Histogram(
+    "http_request_db_seconds", "Time a request spent executing SQL statements.", labels=("handler",))
+statement_seconds = Histogram(
+    "db_statement_duration_seconds", "Time to execute a SQL statement.", labels=("engine",))
+checkout_seconds = Histogram(
+    "db_pool_checkout_seconds", "Time waiting to check out a connection from the pool.", labels=("engine",))
+slow_queries = Counter(
+    "db_slow_queries_total", "SQL statements slower than SLOW_QUERY_SECONDS.", labels=("engine",))
+
+METRICS = [request_seconds, request_statements, request_db_seconds, statement_seconds, checkout_seconds, slow_queries]
+
+
+class RequestStats:
+    __slots__ = ("statements", "db_seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_seconds = 0.0
+
+
+current_request = ContextVar("current_request", default=None)
+
+
+def truncate(parameters):
+    text = repr(parameters)
+    return text if len(text) <= PARAMETERS_MAX_LENGTH else text[:PARAMETERS_MAX_LENGTH] + "..."
+
+
+def instrument(engine, name):
+    """
+    engine: a sync Engine, for an AsyncEngine its sync_engine
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["statement_start"].pop()
+        statement_seconds.observe(seconds, name)
+        stats = current_request.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_seconds += seconds
+        if seconds >= SLOW_QUERY_SECONDS:
+            slow_queries.inc(1, name)
+            logging.warning("slow query (%.3fs): %s parameters: %s", seconds, statement, truncate(parameters))
+        elif SQL_ECHO_SAMPLE_RATE > 0 and random.random() < SQL_ECHO_SAMPLE_RATE:
+            sql_logger.info("(%.3fs) %s parameters: %s", seconds, statement, truncate(parameters))
+
+    @event.listens_for(engine, "handle_error")
+    def discard_statement(exception_context):
+        # after_cursor_execute is not called for a failed statement
+        starts = exception_context.connection.info.get("statement_start") if exception_context.connection else None
+        if starts:
+            starts.pop()
+
+
+class TimedPool:
+    engine_name = None
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            checkout_seconds.observe(time.perf_counter() - start, self.engine_name)
+
+
+class TimedQueuePool(TimedPool, QueuePool):
+    engine_name = "sync"
+
+
+class TimedAsyncAdaptedQueuePool(TimedPool, AsyncAdaptedQueuePool):
+    engine_name = "async"
+
+
+def named_pool(poolclass, engine_name):
+    """
+    poolclass timing its checkouts under engine_name, for the engines of the replicas
+    """
+    return type(poolclass.__name__, (poolclass,), {"engine_name": engine_name})
+
+
+class MetricsMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - start
+            current_request.reset(token)
+            # the router leaves the matched endpoint in the scope
+            handler = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            request_seconds.observe(seconds, handler, scope["method"], status_code)
+            request_statements.observe(stats.statements, handler)
+            request_db_seconds.observe(stats.db_seconds, handler)
+
+
+def render(gauges=None):
+    """
+    gauges: dict of prefix to a dict of gauge name to value, like the stats() of the caches and queues
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for prefix, values in (gauges or {}).items():
+        for name, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append("# TYPE %s_%s gauge" % (prefix, name))
+                lines.append("%s_%s %s" % (prefix, name, value))
+    return "\n".join(lines) + "\n"
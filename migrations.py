@@ -0,0 +1,546 @@
+"""
+Versioned schema migrations, run once out of band instead of on every worker boot:
+    python migrations.py upgrade
+    python migrations.py status
+Applied versions are recorded in the schema_migrations table. A migration is a
+list of sql statements, or a callable receiving a connection, run in one
+transaction. Migrations with concurrently=True run their statements outside of
+a transaction, as CREATE INDEX CONCURRENTLY requires, so they must be idempotent.
+Their operations can also be callables, like the ones of create_index and drop_index.
+"""
+from collections import namedtuple
+from sqlalchemy import text
+import logging
+import sys
+
+import database
+import partitions
+
+Migration = namedtuple(
+    'Migration', ['version', 'description', 'operations', 'concurrently'], defaults=(False,))
+
+MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version integer PRIMARY KEY,
+    description varchar NOT NULL,
+    applied_at timestamp with time zone NOT NULL DEFAULT now()
+)
+"""
+
+
+def create_index(name, table_name, definition):
+    """
+    CREATE INDEX CONCURRENTLY, except on partitioned tables that do not support
+    it, their index is built on every partition at once
+    """
+    def operation(connection):
+        concurrently = "" if partitions.is_partitioned(connection, table_name) else "CONCURRENTLY "
+        connection.execute(text("CREATE INDEX %sIF NOT EXISTS %s ON %s %s" % (concurrently, name, table_name, definition)))
+    return operation
+
+
+def drop_index(name, table_name):
+    def operation(connection):
+        concurrently = "" if partitions.is_partitioned(connection, table_name) else "CONCURRENTLY "
+        connection.execute(text("DROP INDEX %sIF EXISTS %s" % (concurrently, name)))
+    return operation
+
+
+# the schema of each migration is frozen here as it was when the migration was
+# written, the models only describe the latest schema. Databases created before
+# the migrations already have the tables of the first one, so it is idempotent.
+ENUM_TYPES = [
+    "DO $$ BEGIN CREATE TYPE %s AS ENUM (%s); EXCEPTION WHEN duplicate_object THEN NULL; END $$" % (name, values)
+    for name, values in [
+        ("ratingoarcenum", "'GREAT', 'GOOD', 'POOR'"),
+        ("dnsconsistencyenum", "'consistent', 'reverse_match', 'inconsistent'"),
+        ("blockingenum", "'tcp_ip', 'dns', 'http_diff', 'http_failure', 'not_blocking'"),
+    ]
+]
+
+TABLES = ENUM_TYPES + [
+    """
+    CREATE TABLE IF NOT EXISTS asns (
+        id INTEGER NOT NULL,
+        name VARCHAR,
+        PRIMARY KEY (id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS latest_subnet_asns (
+        asn_id INTEGER NOT NULL,
+        subnet CIDR NOT NULL,
+        PRIMARY KEY (asn_id, subnet)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS macs_manuf (
+        mac MACADDR NOT NULL,
+        mask INTEGER NOT NULL,
+        manuf VARCHAR,
+        comment VARCHAR,
+        PRIMARY KEY (mac, mask)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tests (
+        id SERIAL NOT NULL,
+        public_ip INET,
+        timestamp TIMESTAMP WITH TIME ZONE DEFAULT now(),
+        asn_id INTEGER,
+        device_android VARCHAR,
+        mac MACADDR,
+        mask INTEGER,
+        place VARCHAR,
+        username VARCHAR,
+        PRIMARY KEY (id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_tests_id ON tests (id)",
+    """
+    CREATE TABLE IF NOT EXISTS protocol_tests (
+        id SERIAL NOT NULL,
+        test_id INTEGER NOT NULL,
+        protocol_name VARCHAR NOT NULL,
+        key_management VARCHAR,
+        cipher VARCHAR,
+        PRIMARY KEY (id),
+        FOREIGN KEY(test_id) REFERENCES tests (id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_protocol_tests_id ON protocol_tests (id)",
+    """
+    CREATE TABLE IF NOT EXISTS devices_tests (
+        id SERIAL NOT NULL,
+        test_id INTEGER,
+        mac MACADDR NOT NULL,
+        mask INTEGER NOT NULL,
+        router BOOLEAN,
+        private_ip INET,
+        PRIMARY KEY (id),
+        FOREIGN KEY(test_id) REFERENCES tests (id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_devices_tests_id ON devices_tests (id)",
+    """
+    CREATE TABLE IF NOT EXISTS dns_tests (
+        id SERIAL NOT NULL,
+        test_id INTEGER,
+        dns1_android VARCHAR(50),
+        dns2_android VARCHAR(50),
+        ns_akamai VARCHAR(50),
+        ecs_akamai VARCHAR(50),
+        ip_akamai VARCHAR(50),
+        do_flag BOOLEAN,
+        ad_flag BOOLEAN,
+        rrsig BOOLEAN,
+        resolver_ip_oarc VARCHAR(50),
+        rating_source_port ratingoarcenum,
+        rating_transaction_id ratingoarcenum,
+        std_source_port INTEGER,
+        std_transaction_id INTEGER,
+        bits_of_entropy_source_port FLOAT,
+        bits_of_entropy_transaction_id FLOAT,
+        PRIMARY KEY (id),
+        FOREIGN KEY(test_id) REFERENCES tests (id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_dns_tests_id ON dns_tests (id)",
+    """
+    CREATE TABLE IF NOT EXISTS ndt_tests_ooni (
+        id SERIAL NOT NULL,
+        test_id INTEGER NOT NULL,
+        report_id VARCHAR NOT NULL,
+        avg_rtt FLOAT,
+        download FLOAT NOT NULL,
+        mss INTEGER,
+        max_rtt FLOAT,
+        min_rtt FLOAT,
+        ping FLOAT,
+        retransmit_rate FLOAT,
+        upload FLOAT NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(test_id) REFERENCES tests (id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_ndt_tests_ooni_id ON ndt_tests_ooni (id)",
+    """
+    CREATE TABLE IF NOT EXISTS web_tests_ooni (
+        id SERIAL NOT NULL,
+        test_id INTEGER NOT NULL,
+        report_id VARCHAR NOT NULL,
+        url VARCHAR NOT NULL,
+        resolver_asn VARCHAR,
+        resolver_ip INET,
+        resolver_network_name VARCHAR,
+        client_resolver INET NOT NULL,
+        dns_experiment_failure VARCHAR,
+        control_failure VARCHAR,
+        http_experiment_failure VARCHAR,
+        dns_consistency dnsconsistencyenum,
+        body_length_match BOOLEAN,
+        headers_match BOOLEAN,
+        status_code_match BOOLEAN,
+        title_match BOOLEAN,
+        accessible BOOLEAN,
+        blocking blockingenum,
+        PRIMARY KEY (id),
+        FOREIGN KEY(test_id) REFERENCES tests (id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_web_tests_ooni_id ON web_tests_ooni (id)",
+    """
+    CREATE TABLE IF NOT EXISTS tcp_connect_web_tests_ooni (
+        id SERIAL NOT NULL,
+        ip INET,
+        port INTEGER,
+        status_blocked BOOLEAN,
+        status_failure_string VARCHAR,
+        status_success BOOLEAN NOT NULL,
+        test_id INTEGER NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(test_id) REFERENCES web_tests_ooni (id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_tcp_connect_web_tests_ooni_id ON tcp_connect_web_tests_ooni (id)",
+]
+
+ROLLUP_TABLES = [
+    """
+    CREATE TABLE asn_rollups (
+        asn_id INTEGER NOT NULL,
+        day DATE NOT NULL,
+        name VARCHAR NOT NULL,
+        count BIGINT NOT NULL,
+        PRIMARY KEY (asn_id, day, name)
+    )
+    """,
+    """
+    CREATE TABLE asn_sketches (
+        asn_id INTEGER NOT NULL,
+        day DATE NOT NULL,
+        metric VARCHAR NOT NULL,
+        bucket INTEGER NOT NULL,
+        count BIGINT NOT NULL,
+        PRIMARY KEY (asn_id, day, metric, bucket)
+    )
+    """,
+    """
+    CREATE TABLE rollup_watermarks (
+        name VARCHAR NOT NULL,
+        test_id INTEGER NOT NULL,
+        PRIMARY KEY (name)
+    )
+    """,
+]
+
+# filled by the next submission of each client, or by python latest_results.py rebuild
+LATEST_RESULTS_TABLE = [
+    """
+    CREATE TABLE latest_results (
+        public_ip INET NOT NULL,
+        protocols_test TEXT,
+        devices_test TEXT,
+        dns_tests TEXT,
+        ndt_tests_ooni TEXT,
+        web_tests_ooni TEXT,
+        oldest_timestamp TIMESTAMP WITH TIME ZONE,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL,
+        PRIMARY KEY (public_ip)
+    )
+    """,
+]
+
+
+PARTITIONED_INDEXES = [
+    ("ix_tests_public_ip_timestamp_id", "tests", "(public_ip, timestamp DESC, id DESC)"),
+    ("ix_protocol_tests_test_id", "protocol_tests", "(test_id)"),
+    ("ix_devices_tests_test_id", "devices_tests", "(test_id)"),
+    ("ix_dns_tests_test_id", "dns_tests", "(test_id)"),
+    ("ix_ndt_tests_ooni_test_id", "ndt_tests_ooni", "(test_id)"),
+    ("ix_web_tests_ooni_test_id", "web_tests_ooni", "(test_id)"),
+    ("ix_tcp_connect_web_tests_ooni_test_id", "tcp_connect_web_tests_ooni", "(test_id)"),
+    ("ix_devices_tests_mac_mask", "devices_tests", "(mac, mask)"),
+]
+
+
+# (table, the table its test_id references, its columns but test_timestamp, its partitioned table)
+PARTITIONED_TABLES = [
+    ("tests", None, ["id", "public_ip", "timestamp", "asn_id", "device_android", "mac", "mask", "place", "username"], """
+    CREATE TABLE tests (
+        id SERIAL NOT NULL,
+        public_ip INET,
+        timestamp TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL,
+        asn_id INTEGER,
+        device_android VARCHAR,
+        mac MACADDR,
+        mask INTEGER,
+        place VARCHAR,
+        username VARCHAR,
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp)
+    """),
+    ("protocol_tests", "tests", ["id", "test_id", "protocol_name", "key_management", "cipher"], """
+    CREATE TABLE protocol_tests (
+        id SERIAL NOT NULL,
+        test_id INTEGER NOT NULL,
+        test_timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+        protocol_name VARCHAR NOT NULL,
+        key_management VARCHAR,
+        cipher VARCHAR,
+        PRIMARY KEY (id, test_timestamp),
+        FOREIGN KEY(test_id, test_timestamp) REFERENCES tests (id, timestamp)
+    ) PARTITION BY RANGE (test_timestamp)
+    """),
+    ("devices_tests", "tests", ["id", "test_id", "mac", "mask", "router", "private_ip"], """
+    CREATE TABLE devices_tests (
+        id SERIAL NOT NULL,
+        test_id INTEGER,
+        test_timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+        mac MACADDR NOT NULL,
+        mask INTEGER NOT NULL,
+        router BOOLEAN,
+        private_ip INET,
+        PRIMARY KEY (id, test_timestamp),
+        FOREIGN KEY(test_id, test_timestamp) REFERENCES tests (id, timestamp)
+    ) PARTITION BY RANGE (test_timestamp)
+    """),
+    ("dns_tests", "tests", [
+        "id", "test_id", "dns1_android", "dns2_android", "ns_akamai", "ecs_akamai", "ip_akamai", "do_flag", "ad_flag",
+        "rrsig", "resolver_ip_oarc", "rating_source_port", "rating_transaction_id", "std_source_port",
+        "std_transaction_id", "bits_of_entropy_source_port", "bits_of_entropy_transaction_id"], """
+    CREATE TABLE dns_tests (
+        id SERIAL NOT NULL,
+        test_id INTEGER,
+        test_timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+        dns1_android VARCHAR(50),
+        dns2_android VARCHAR(50),
+        ns_akamai VARCHAR(50),
+        ecs_akamai VARCHAR(50),
+        ip_akamai VARCHAR(50),
+        do_flag BOOLEAN,
+        ad_flag BOOLEAN,
+        rrsig BOOLEAN,
+        resolver_ip_oarc VARCHAR(50),
+        rating_source_port ratingoarcenum,
+        rating_transaction_id ratingoarcenum,
+        std_source_port INTEGER,
+        std_transaction_id INTEGER,
+        bits_of_entropy_source_port FLOAT,
+        bits_of_entropy_transaction_id FLOAT,
+        PRIMARY KEY (id, test_timestamp),
+        FOREIGN KEY(test_id, test_timestamp) REFERENCES tests (id, timestamp)
+    ) PARTITION BY RANGE (test_timestamp)
+    """),
+    ("ndt_tests_ooni", "tests", [
+        "id", "test_id", "report_id", "avg_rtt", "download", "mss", "max_rtt", "min_rtt", "ping", "retransmit_rate",
+        "upload"], """
+    CREATE TABLE ndt_tests_ooni (
+        id SERIAL NOT NULL,
+        test_id INTEGER NOT NULL,
+        test_timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+        report_id VARCHAR NOT NULL,
+        avg_rtt FLOAT,
+        download FLOAT NOT NULL,
+        mss INTEGER,
+        max_rtt FLOAT,
+        min_rtt FLOAT,
+        ping FLOAT,
+        retransmit_rate FLOAT,
+        upload FLOAT NOT NULL,
+        PRIMARY KEY (id, test_timestamp),
+        FOREIGN KEY(test_id, test_timestamp) REFERENCES tests (id, timestamp)
+    ) PARTITION BY RANGE (test_timestamp)
+    """),
+    ("web_tests_ooni", "tests", [
+        "id", "test_id", "report_id", "url", "resolver_asn", "resolver_ip", "resolver_network_name", "client_resolver",
+        "dns_experiment_failure", "control_failure", "http_experiment_failure", "dns_consistency", "body_length_match",
+        "headers_match", "status_code_match", "title_match", "accessible", "blocking"], """
+    CREATE TABLE web_tests_ooni (
+        id SERIAL NOT NULL,
+        test_id INTEGER NOT NULL,
+        test_timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+        report_id VARCHAR NOT NULL,
+        url VARCHAR NOT NULL,
+        resolver_asn VARCHAR,
+        resolver_ip INET,
+        resolver_network_name VARCHAR,
+        client_resolver INET NOT NULL,
+        dns_experiment_failure VARCHAR,
+        control_failure VARCHAR,
+        http_experiment_failure VARCHAR,
+        dns_consistency dnsconsistencyenum,
+        body_length_match BOOLEAN,
+        headers_match BOOLEAN,
+        status_code_match BOOLEAN,
+        title_match BOOLEAN,
+        accessible BOOLEAN,
+        blocking blockingenum,
+        PRIMARY KEY (id, test_timestamp),
+        FOREIGN KEY(test_id, test_timestamp) REFERENCES tests (id, timestamp)
+    ) PARTITION BY RANGE (test_timestamp)
+    """),
+    ("tcp_connect_web_tests_ooni", "web_tests_ooni", [
+        "id", "ip", "port", "status_blocked", "status_failure_string", "status_success", "test_id"], """
+    CREATE TABLE tcp_connect_web_tests_ooni (
+        id SERIAL NOT NULL,
+        ip INET,
+        port INTEGER,
+        status_blocked BOOLEAN,
+        status_failure_string VARCHAR,
+        status_success BOOLEAN NOT NULL,
+        test_id INTEGER NOT NULL,
+        test_timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+        PRIMARY KEY (id, test_timestamp),
+        FOREIGN KEY(test_id, test_timestamp) REFERENCES web_tests_ooni (id, test_timestamp)
+    ) PARTITION BY RANGE (test_timestamp)
+    """),
+]
+
+
+def partition_tests(connection):
+    """
+    moves tests and its child tables to partitioned tables, the tables are
+    locked while their rows are copied. Databases created after partitioning
+    already have partitioned tables and only get their partitions.
+    """
+    if partitions.is_partitioned(connection, "tests"):
+        partitions.create_partitions(connection, partitions.upcoming_months())
+        return
+    now = connection.execute(text("SELECT now()")).scalar()
+    for table, _, _, _ in PARTITIONED_TABLES:
+        old = table + "_unpartitioned"
+        sequence = connection.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": table}).scalar()
+        connection.execute(text("ALTER SEQUENCE %s RENAME TO %s_id_seq" % (sequence, old)))
+        for (index,) in connection.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = :table"), {"table": table}):
+            connection.execute(text("ALTER INDEX %s RENAME TO %s_unpartitioned" % (index, index)))
+        connection.execute(text("ALTER TABLE %s RENAME TO %s" % (table, old)))
+    for table, _, _, definition in PARTITIONED_TABLES:
+        connection.execute(text(definition))
+        connection.execute(text("CREATE INDEX ix_%s_id ON %s (id)" % (table, table)))
+    for name, table_name, definition in PARTITIONED_INDEXES:
+        create_index(name, table_name, definition)(connection)
+    first = connection.execute(text("SELECT min(timestamp) FROM tests_unpartitioned")).scalar() or now
+    partitions.create_partitions(connection, partitions.months_between(first, partitions.upcoming_months(now)[-1]))
+    for table, parent, columns, _ in PARTITIONED_TABLES:
+        if parent is None:
+            connection.execute(text("INSERT INTO tests (%s) SELECT %s FROM tests_unpartitioned" % (
+                ", ".join(columns), ", ".join("COALESCE(timestamp, :now)" if column == "timestamp" else column
+                                             for column in columns))), {"now": now})
+        else:
+            # the parent is copied first, child rows take the timestamp of their test
+            connection.execute(text(
+                "INSERT INTO %s (%s, test_timestamp) SELECT %s, COALESCE(parent.%s, :now) FROM %s_unpartitioned child "
+                "LEFT JOIN %s parent ON parent.id = child.test_id" % (
+                    table, ", ".join(columns), ", ".join("child." + column for column in columns),
+                    "timestamp" if parent == "tests" else "test_timestamp", table, parent)), {"now": now})
+        connection.execute(text(
+            "SELECT setval(pg_get_serial_sequence('{table}', 'id'), last_value, is_called) FROM {table}_unpartitioned_id_seq"
+            .format(table=table)))
+    for table, _, _, _ in reversed(PARTITIONED_TABLES):
+        connection.execute(text("DROP TABLE %s_unpartitioned" % table))
+
+
+MIGRATIONS = [
+    Migration(1, "create tables", TABLES),
+    Migration(2, "index hot predicates", [
+        create_index("ix_tests_public_ip_timestamp", "tests", "(public_ip, timestamp DESC)"),
+        create_index("ix_protocol_tests_test_id", "protocol_tests", "(test_id)"),
+        create_index("ix_devices_tests_test_id", "devices_tests", "(test_id)"),
+        create_index("ix_dns_tests_test_id", "dns_tests", "(test_id)"),
+        create_index("ix_ndt_tests_ooni_test_id", "ndt_tests_ooni", "(test_id)"),
+        create_index("ix_web_tests_ooni_test_id", "web_tests_ooni", "(test_id)"),
+        create_index("ix_tcp_connect_web_tests_ooni_test_id", "tcp_connect_web_tests_ooni", "(test_id)"),
+        create_index("ix_devices_tests_mac_mask", "devices_tests", "(mac, mask)"),
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_latest_subnet_asns_subnet ON latest_subnet_asns USING gist (subnet inet_ops)",
+    ], concurrently=True),
+    Migration(3, "per asn rollups", ROLLUP_TABLES),
+    Migration(4, "keyset index for the history of a client", [
+        create_index("ix_tests_public_ip_timestamp_id", "tests", "(public_ip, timestamp DESC, id DESC)"),
+        drop_index("ix_tests_public_ip_timestamp", "tests"),
+    ], concurrently=True),
+    Migration(5, "monthly partitions of tests and its child tables", partition_tests),
+    Migration(6, "latest results of each client", LATEST_RESULTS_TABLE),
+    Migration(7, "version of the latest results of each client", [
+        "ALTER TABLE latest_results ADD COLUMN latest_test_id INTEGER, ADD COLUMN references_version VARCHAR",
+    ]),
+    # filled by python percentiles.py refresh
+    Migration(8, "ndt distributions", [
+        """
+        CREATE TABLE ndt_distributions (
+            asn_id INTEGER NOT NULL,
+            download FLOAT[] NOT NULL,
+            upload FLOAT[] NOT NULL,
+            rtt FLOAT[] NOT NULL,
+            computed_at TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL,
+            PRIMARY KEY (asn_id)
+        )
+        """,
+    ]),
+    Migration(9, "version of the latest results rendered for the ETag", [
+        "ALTER TABLE latest_results ADD COLUMN version BIGINT DEFAULT 0 NOT NULL",
+    ]),
+]
+
+
+def applied_versions(connection):
+    connection.execute(text(MIGRATIONS_TABLE))
+    return {row[0] for row in connection.execute(text("SELECT version FROM schema_migrations"))}
+
+
+def run_operations(connection, operations):
+    if callable(operations):
+        operations(connection)
+    else:
+        for operation in operations:
+            if callable(operation):
+                operation(connection)
+            else:
+                connection.execute(text(operation))
+
+
+def record(connection, migration):
+    connection.execute(text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description) "
+                            "ON CONFLICT (version) DO NOTHING"),
+                       {"version": migration.version, "description": migration.description})
+
+
+def upgrade(engine=None, target=None):
+    engine = engine or database.engine
+    with engine.begin() as connection:
+        applied = applied_versions(connection)
+    for migration in MIGRATIONS:
+        if migration.version in applied or (target is not None and migration.version > target):
+            continue
+        logging.info("applying migration %s: %s", migration.version, migration.description)
+        if migration.concurrently:
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                run_operations(connection, migration.operations)
+                record(connection, migration)
+        else:
+            with engine.begin() as connection:
+                # serializes concurrent upgrades, the first one applies the migration
+                connection.execute(text("LOCK TABLE schema_migrations IN EXCLUSIVE MODE"))
+                if migration.version in applied_versions(connection):
+                    continue
+                run_operations(connection, migration.operations)
+                record(connection, migration)
+
+
+def status(engine=None):
+    engine = engine or database.engine
+    with engine.begin() as connection:
+        applied = applied_versions(connection)
+    return [(migration.version, migration.description, migration.version in applied) for migration in MIGRATIONS]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "upgrade"
+    if command == "upgrade":
+        upgrade(target=int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    elif command == "status":
+        for version, description, applied in status():
+            print("%4d %-8s %s" % (version, "applied" if applied else "pending", description))
+    else:
+        sys.exit("usage: python migrations.py [upgrade [version] | status]")
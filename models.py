@@ -1,7 +1,7 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Enum, Float
+from sqlalchemy import BigInteger, Boolean, Column, Date, Integer, String, DateTime, Enum, Float, Text
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils import IPAddressType
-from sqlalchemy.dialects.postgresql import INET, CIDR, MACADDR
+from sqlalchemy.dialects.postgresql import ARRAY, INET, CIDR, MACADDR
 from sqlalchemy.sql import func
 from sqlalchemy.schema import ForeignKeyConstraint
 import enum
@@ -64,10 +64,13 @@ class MacManuf(Base):
 
 class Test(Base):
     __tablename__ = 'tests'
+    # partitions are created and archived by partitions.py
+    __table_args__ = {'postgresql_partition_by': 'RANGE (timestamp)'}
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
     public_ip = Column(INET)
-    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    # the partition key has to be part of the primary key
+    timestamp = Column(DateTime(timezone=True), primary_key=True, server_default=func.now())
     asn_id = Column(Integer)
     device_android = Column(String)
     mac = Column(MACADDR)
@@ -78,9 +81,15 @@ class Test(Base):
 
 class ProtocolTest(Base):
     __tablename__ = 'protocol_tests'
-
-    id = Column(Integer, primary_key=True, index=True)
-    test_id = Column(ForeignKey('tests.id'), nullable=False)
+    __table_args__ = (
+        ForeignKeyConstraint(['test_id', 'test_timestamp'], ['tests.id', 'tests.timestamp']),
+        {'postgresql_partition_by': 'RANGE (test_timestamp)'},
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    test_id = Column(Integer, nullable=False)
+    # the partition key, a copy of the timestamp of the test, not part of the results
+    test_timestamp = Column(DateTime(timezone=True), primary_key=True, info={'internal': True})
     protocol_name = Column(String, nullable=False)
     key_management = Column(String)
     cipher = Column(String)
@@ -89,9 +98,15 @@ class ProtocolTest(Base):
 class DevicesTest(Base):
 
     __tablename__ = 'devices_tests'
-
-    id = Column(Integer, primary_key=True, index=True)
-    test_id = Column(ForeignKey('tests.id'))
+    __table_args__ = (
+        ForeignKeyConstraint(['test_id', 'test_timestamp'], ['tests.id', 'tests.timestamp']),
+        {'postgresql_partition_by': 'RANGE (test_timestamp)'},
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    test_id = Column(Integer)
+    # the partition key, a copy of the timestamp of the test, not part of the results
+    test_timestamp = Column(DateTime(timezone=True), primary_key=True, info={'internal': True})
     mac = Column(MACADDR,  nullable=False)
     mask = Column(Integer,  nullable=False)
     router = Column(Boolean)
@@ -101,9 +116,15 @@ class DevicesTest(Base):
 class DnsTest(Base):
 
     __tablename__ = 'dns_tests'
-
-    id = Column(Integer, primary_key=True, index=True)
-    test_id = Column(ForeignKey('tests.id'))
+    __table_args__ = (
+        ForeignKeyConstraint(['test_id', 'test_timestamp'], ['tests.id', 'tests.timestamp']),
+        {'postgresql_partition_by': 'RANGE (test_timestamp)'},
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    test_id = Column(Integer)
+    # the partition key, a copy of the timestamp of the test, not part of the results
+    test_timestamp = Column(DateTime(timezone=True), primary_key=True, info={'internal': True})
     dns1_android = Column(IPAddressType)
     dns2_android = Column(IPAddressType)
     ns_akamai = Column(IPAddressType)
@@ -124,9 +145,15 @@ class DnsTest(Base):
 class NdtTestOoni(Base):
 
     __tablename__ = "ndt_tests_ooni"
-
-    id = Column(Integer, primary_key=True, index=True)
-    test_id = Column(ForeignKey('tests.id'), nullable=False)
+    __table_args__ = (
+        ForeignKeyConstraint(['test_id', 'test_timestamp'], ['tests.id', 'tests.timestamp']),
+        {'postgresql_partition_by': 'RANGE (test_timestamp)'},
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    test_id = Column(Integer, nullable=False)
+    # the partition key, a copy of the timestamp of the test, not part of the results
+    test_timestamp = Column(DateTime(timezone=True), primary_key=True, info={'internal': True})
     report_id = Column(String, nullable=False)
     avg_rtt = Column(Float)
     download = Column(Float, nullable=False)
@@ -141,9 +168,15 @@ class NdtTestOoni(Base):
 class WebTestOoni(Base):
 
     __tablename__ = 'web_tests_ooni'
-
-    id = Column(Integer, primary_key=True, index=True)
-    test_id = Column(ForeignKey('tests.id'), nullable=False)
+    __table_args__ = (
+        ForeignKeyConstraint(['test_id', 'test_timestamp'], ['tests.id', 'tests.timestamp']),
+        {'postgresql_partition_by': 'RANGE (test_timestamp)'},
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    test_id = Column(Integer, nullable=False)
+    # the partition key, a copy of the timestamp of the test, not part of the results
+    test_timestamp = Column(DateTime(timezone=True), primary_key=True, info={'internal': True})
     report_id = Column(String, nullable=False)
     url = Column(String, nullable=False)
     resolver_asn = Column(String)
@@ -164,13 +197,82 @@ class WebTestOoni(Base):
 
 class TcpConnectWebTestOoni(Base):
     __tablename__ = 'tcp_connect_web_tests_ooni'
+    __table_args__ = (
+        ForeignKeyConstraint(['test_id', 'test_timestamp'], ['web_tests_ooni.id', 'web_tests_ooni.test_timestamp']),
+        {'postgresql_partition_by': 'RANGE (test_timestamp)'},
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
     ip = Column(INET)
     port = Column(Integer)
     status_blocked = Column(Boolean)
     status_failure_string = Column(String)
     status_success = Column(Boolean, nullable=False)
-    test_id = Column(ForeignKey('web_tests_ooni.id'), nullable=False)
+    test_id = Column(Integer, nullable=False)
+    # the partition key, a copy of the timestamp of the test, not part of the results
+    test_timestamp = Column(DateTime(timezone=True), primary_key=True, info={'internal': True})
+
+
 
 
+class AsnRollup(Base):
+    __tablename__ = 'asn_rollups'
+
+    asn_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    name = Column(String, primary_key=True)
+    count = Column(BigInteger, nullable=False)
+
+
+class AsnSketch(Base):
+    __tablename__ = 'asn_sketches'
+
+    asn_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    metric = Column(String, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    count = Column(BigInteger, nullable=False)
+
+
+class RollupWatermark(Base):
+    __tablename__ = 'rollup_watermarks'
+
+    name = Column(String, primary_key=True)
+    test_id = Column(Integer, nullable=False)
+
+
+class LatestResult(Base):
+    """
+    the latest results of a client as rendered for GET /tests/, see latest_results.py
+    """
+    __tablename__ = 'latest_results'
+
+    public_ip = Column(INET, primary_key=True)
+    # the JSON of each section, null when it was not rendered yet
+    protocols_test = Column(Text)
+    devices_test = Column(Text)
+    dns_tests = Column(Text)
+    ndt_tests_ooni = Column(Text)
+    web_tests_ooni = Column(Text)
+    # no later than the timestamp of any rendered test
+    oldest_timestamp = Column(DateTime(timezone=True))
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    # the latest test of the client and the version of the manufacturers and ndt
+    # distributions when it was rendered, the row is only read while both are current
+    latest_test_id = Column(Integer)
+    references_version = Column(String)
+    # incremented every time the row is rendered, the ETag of the response
+    version = Column(BigInteger, nullable=False, server_default="0")
+
+
+class NdtDistribution(Base):
+    """
+    the quantiles of the ndt results of an asn, or of every result with asn_id 0, see percentiles.py
+    """
+    __tablename__ = 'ndt_distributions'
+
+    asn_id = Column(Integer, primary_key=True, autoincrement=False)
+    download = Column(ARRAY(Float), nullable=False)
+    upload = Column(ARRAY(Float), nullable=False)
+    rtt = Column(ARRAY(Float), nullable=False)
+    computed_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
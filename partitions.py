@@ -0,0 +1,304 @@
+"""
+Monthly partitions of tests and of its child tables, and their retention.
+tests is range partitioned on timestamp and every child table on test_timestamp,
+the timestamp of its test, with the same monthly bounds. Child rows reference
+their test by (test_id, test_timestamp), so a query on recent tests only reads
+the latest partitions of every table, and a month can be archived as a whole.
+    python partitions.py premake        creates the partitions of this month and of the next PARTITION_PREMAKE_MONTHS
+    python partitions.py archive [YYYY-MM ...]
+                                        archives the months older than PARTITION_RETENTION_MONTHS, or the given ones
+    python partitions.py maintain       both, meant to run daily
+Archiving a month writes every one of its partitions to
+PARTITION_ARCHIVE_DIRECTORY/<table>/<YYYY-MM>.parquet (columnar, compressed with
+PARTITION_ARCHIVE_COMPRESSION), then detaches and drops them, and clears the
+latest results (see latest_results.py) that may still show them. It needs
+pyarrow, which has no wheels for the alpine image and is not in
+requirements.txt: archive and maintain exit right away without it, unless
+PARTITION_RETENTION_MONTHS=0, so the retention job runs where it is installed
+(pip install pyarrow). There are no default partitions, they would keep the
+planner from reading the partitions of tests newest first and stopping at the
+LIMIT. prestart.sh runs premake, and maintain has to run at least once a month
+(cron) so the next months always exist. When it did not, the first submission
+of a month without partitions creates them, in their own transaction, so
+accepted results, as the ones of the write-behind queue, are not lost; it only
+fails with 503 when they can not be created. The bulk import creates the
+partitions of the months it backfills the same way.
+"""
+from datetime import date, datetime, timezone
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+import logging
+import os
+import re
+import sys
+
+import database
+import models
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+PARTITION_PREMAKE_MONTHS = int(os.environ.get('PARTITION_PREMAKE_MONTHS', 3))
+# 0 keeps every month
+PARTITION_RETENTION_MONTHS = int(os.environ.get('PARTITION_RETENTION_MONTHS', 24))
+PARTITION_ARCHIVE_DIRECTORY = os.environ.get('PARTITION_ARCHIVE_DIRECTORY', '/app/archive')
+PARTITION_ARCHIVE_COMPRESSION = os.environ.get('PARTITION_ARCHIVE_COMPRESSION', 'zstd')
+PARTITION_ARCHIVE_BATCH_SIZE = int(os.environ.get('PARTITION_ARCHIVE_BATCH_SIZE', 50000))
+
+# referenced tables before the tables referencing them
+PARTITIONED_MODELS = (models.Test, models.ProtocolTest, models.DevicesTest, models.DnsTest,
+                      models.NdtTestOoni, models.WebTestOoni, models.TcpConnectWebTestOoni)
+
+MONTH_PARTITION = re.compile(r"_(\d{4})_(\d{2})$")
+
+COLUMNS = text("SELECT column_name, data_type FROM information_schema.columns "
+               "WHERE table_schema = current_schema() AND table_name = :table ORDER BY ordinal_position")
+PARTITIONS = text("SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                  "WHERE pg_inherits.inhparent = to_regclass(:table)")
+
+
+def month_of(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(month: date, months: int):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def months_between(first, last):
+    """
+    the months from the one of first to the one of last, both included
+    """
+    months = [month_of(first)]
+    while months[-1] < month_of(last):
+        months.append(add_months(months[-1], 1))
+    return months
+
+
+def partition_name(table_name, month: date):
+    return "%s_%04d_%02d" % (table_name, month.year, month.month)
+
+
+def bound(month: date):
+    return "'%s'" % datetime(month.year, month.month, 1, tzinfo=timezone.utc).isoformat()
+
+
+def is_partitioned(connection, table_name):
+    return connection.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"),
+                              {"table": table_name}).scalar() == "p"
+
+
+def create_partitions(connection, months):
+    for model in PARTITIONED_MODELS:
+        table_name = model.__tablename__
+        for month in months:
+            connection.execute(text("CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM (%s) TO (%s)" % (
+                partition_name(table_name, month), table_name, bound(month), bound(add_months(month, 1)))))
+
+
+def retention_start(today=None):
+    if not PARTITION_RETENTION_MONTHS:
+        return None
+    return add_months(month_of(today or datetime.now(timezone.utc)), -PARTITION_RETENTION_MONTHS)
+
+
+def upcoming_months(today=None):
+    month = month_of(today or datetime.now(timezone.utc))
+    return [add_months(month, months) for months in range(PARTITION_PREMAKE_MONTHS + 1)]
+
+
+def premake(engine=None, today=None):
+    months = upcoming_months(today)
+    with (engine or database.engine).begin() as connection:
+        create_partitions(connection, months)
+    return months
+
+
+# error codes of a partition created at the same time by another process
+DUPLICATE_TABLE_CODES = {"42P07", "23505"}
+
+
+class MissingPartition(Exception):
+
+    def __init__(self, months):
+        self.months = months
+        super().__init__("no partition for %s, they are created by python partitions.py premake" % ", ".join(
+            month.strftime("%Y-%m") for month in months))
+
+    def response(self):
+        return JSONResponse(status_code=503, content={"message": "Results of this month can not be stored yet"})
+
+
+_existing_months = set()
+
+
+def months_of(timestamps):
+    return {month_of(timestamp.astimezone(timezone.utc) if timestamp.tzinfo else timestamp) for timestamp in timestamps}
+
+
+def remember(months):
+    # months that will not be archived yet keep their partitions, the others are looked up every time
+    oldest = retention_start()
+    _existing_months.update(month for month in months if oldest is None or month >= oldest)
+
+
+def check_partitions(db, timestamps):
+    """
+    creates the partitions missing for the months of the timestamps when premake
+    did not create them before the month started, in a transaction of their
+    own. Raises MissingPartition when they can not be created.
+    """
+    months = months_of(timestamps) - _existing_months
+    if not months:
+        return
+    missing = months - set(partition_months(db))
+    remember(months - missing)
+    if missing:
+        logging.warning("creating the partitions of %s, python partitions.py premake did not run", ", ".join(
+            month.strftime("%Y-%m") for month in sorted(missing)))
+        try:
+            create_months(missing, db.get_bind())
+        except DBAPIError as e:
+            raise MissingPartition(sorted(missing)) from e
+
+
+def ensure_partitions(timestamps, engine=None):
+    """
+    creates the partitions missing for the months of the timestamps, as for
+    backfilled tests, in a transaction of their own
+    """
+    months = months_of(timestamps) - _existing_months
+    if months:
+        create_months(months, engine)
+
+
+def create_months(months, engine=None):
+    """
+    creates the partitions missing for the months, in a transaction of their own.
+    Partitions created at the same time by another process are not an error.
+    """
+    engine = engine or database.engine
+    for attempt in range(2):
+        try:
+            with engine.begin() as connection:
+                create_partitions(connection, sorted(set(months) - set(partition_months(connection))))
+            break
+        except DBAPIError as e:
+            if attempt or getattr(e.orig, "pgcode", None) not in DUPLICATE_TABLE_CODES:
+                raise
+    remember(months)
+
+
+def partition_months(connection):
+    months = set()
+    for (name,) in connection.execute(PARTITIONS, {"table": models.Test.__tablename__}):
+        match = MONTH_PARTITION.search(name)
+        if match:
+            months.add(date(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+
+def export(connection, table_name, path):
+    """
+    writes the rows of table_name to a parquet file at path, returns their count
+    """
+    columns = connection.execute(COLUMNS, {"table": table_name}).fetchall()
+    types = {
+        "integer": pyarrow.int32(),
+        "bigint": pyarrow.int64(),
+        "double precision": pyarrow.float64(),
+        "boolean": pyarrow.bool_(),
+        "timestamp with time zone": pyarrow.timestamp("us", tz="UTC"),
+    }
+    schema = pyarrow.schema([(name, types.get(data_type, pyarrow.string())) for name, data_type in columns])
+    # inet, macaddr, enums and strings are archived as text
+    select = "SELECT %s FROM %s" % (", ".join(
+        '"%s"' % name if data_type in types else '"%s"::text' % name for name, data_type in columns), table_name)
+    result = connection.execution_options(stream_results=True).execute(text(select))
+    partial = path + ".partial"
+    count = 0
+    writer = pyarrow.parquet.ParquetWriter(partial, schema, compression=PARTITION_ARCHIVE_COMPRESSION)
+    try:
+        for rows in result.partitions(PARTITION_ARCHIVE_BATCH_SIZE):
+            writer.write_table(pyarrow.Table.from_pydict(
+                {name: [row[position] for row in rows] for position, name in enumerate(schema.names)}, schema=schema))
+            count += len(rows)
+    finally:
+        writer.close()
+    os.replace(partial, path)
+    return count
+
+
+def archive_month(engine, month: date):
+    """
+    exports the partitions of the month, then detaches and drops them, returns
+    the number of rows archived per table
+    """
+    if pyarrow is None:
+        raise RuntimeError("archiving partitions needs pyarrow (pip install pyarrow)")
+    counts = {}
+    # old months are not written anymore, the export does not block the api
+    for model in PARTITIONED_MODELS:
+        table_name = model.__tablename__
+        directory = os.path.join(PARTITION_ARCHIVE_DIRECTORY, table_name)
+        os.makedirs(directory, exist_ok=True)
+        # a month backfilled after its archive gets a second file
+        path = os.path.join(directory, "%04d-%02d.parquet" % (month.year, month.month))
+        copy = 0
+        while os.path.exists(path):
+            copy += 1
+            path = os.path.join(directory, "%04d-%02d.%d.parquet" % (month.year, month.month, copy))
+        with engine.begin() as connection:
+            counts[table_name] = export(connection, partition_name(table_name, month), path)
+    with engine.begin() as connection:
+        # the partitions referencing a partition go first
+        for model in reversed(PARTITIONED_MODELS):
+            table_name = model.__tablename__
+            name = partition_name(table_name, month)
+            connection.execute(text("ALTER TABLE %s DETACH PARTITION %s" % (table_name, name)))
+            connection.execute(text("DROP TABLE %s" % name))
+        # the latest results that may show archived tests are read from the test tables again
+        connection.execute(text(
+            "UPDATE %s SET protocols_test = NULL, devices_test = NULL, dns_tests = NULL, ndt_tests_ooni = NULL, "
+            "web_tests_ooni = NULL, oldest_timestamp = NULL, version = version + 1 WHERE oldest_timestamp < %s" % (
+                models.LatestResult.__tablename__, bound(add_months(month, 1)))))
+    return counts
+
+
+def archive(engine=None, months=None, today=None):
+    """
+    months: the months to archive, by default the ones older than PARTITION_RETENTION_MONTHS
+    """
+    engine = engine or database.engine
+    if months is None:
+        oldest = retention_start(today)
+        if oldest is None:
+            return {}
+        with engine.connect() as connection:
+            months = [month for month in partition_months(connection) if month < oldest]
+    archived = {}
+    for month in months:
+        archived[month] = archive_month(engine, month)
+        logging.info("archived %s: %s", month.strftime("%Y-%m"), archived[month])
+    return archived
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "maintain"
+    if pyarrow is None and (command == "archive" or command == "maintain" and PARTITION_RETENTION_MONTHS):
+        sys.exit("archiving partitions needs pyarrow (pip install pyarrow), "
+                 "or PARTITION_RETENTION_MONTHS=0 to keep every month")
+    if command in ("premake", "maintain"):
+        logging.info("partitions of %s", [month.strftime("%Y-%m") for month in premake()])
+    if command == "archive":
+        archive(months=[month_of(date.fromisoformat(month + "-01")) for month in sys.argv[2:]] or None)
+    elif command == "maintain":
+        archive()
+    elif command != "premake":
+        sys.exit("usage: python partitions.py [premake | archive [YYYY-MM ...] | maintain]")
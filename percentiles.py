@@ -0,0 +1,162 @@
+"""
+Reference distributions used to rank ndt results against other measurements.
+They start as the M-Lab deciles, and are replaced by the percentiles of the
+stored ndt_tests_ooni rows, globally and for each asn with enough samples, once
+    python percentiles.py refresh [seconds]
+has computed them into ndt_distributions, every given seconds if any, from one
+process. Workers only read that small table, when it changes. Every refresh
+gives the latest results of every client (see latest_results.py) to render again,
+so it is meant to run daily or so. They can also be loaded from an imported
+M-Lab snapshot (NDT_REFERENCE_FILE), a json file like
+{"download": [...], "upload": [...], "rtt": [...], "asns": {"<asn>": {...}}}.
+Each distribution is a sorted numpy array of quantiles, so ranking a batch of
+results is one searchsorted call per metric.
+"""
+from sqlalchemy import text
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import sys
+import time
+
+import database
+import lookups
+import models
+
+NDT_REFERENCE_FILE = os.environ.get('NDT_REFERENCE_FILE')
+NDT_REFERENCE_MIN_SAMPLES = int(os.environ.get('NDT_REFERENCE_MIN_SAMPLES', 1000))
+NDT_REFERENCE_POINTS = int(os.environ.get('NDT_REFERENCE_POINTS', 100))
+
+METRICS = {"upload": "upload", "download": "download", "rtt": "avg_rtt"}
+
+MLAB_DECILES = {
+    "download": [0.23243849257549207, 0.6875543587708922, 1.4410504358198128, 2.5799351721570947,
+                 4.2181690863027095, 8.773812503971508, 15.482419418393432, 26.208500361301887, 48.865976128894346,
+                 182.20702077771392],
+    "upload": [0.2606367586170152, 0.6115126968261643, 1.4246995691135311, 2.4488057786169932, 3.859683497799003,
+               5.912398780958386, 8.91031485283244, 15.44939531147001, 31.775679487886162, 89.76927089572779],
+    "rtt": [76.0, 149.0, 171.0, 226.0, 249.0, 262.0, 270.0, 282.0, 306.0, 839.0],
+}
+
+DISTRIBUTIONS = text("""
+SELECT GROUPING(tests.asn_id) = 1, tests.asn_id,
+       percentile_cont(CAST(:fractions AS float8[])) WITHIN GROUP (ORDER BY ndt_tests_ooni.download),
+       percentile_cont(CAST(:fractions AS float8[])) WITHIN GROUP (ORDER BY ndt_tests_ooni.upload),
+       percentile_cont(CAST(:fractions AS float8[])) WITHIN GROUP (ORDER BY ndt_tests_ooni.avg_rtt)
+FROM ndt_tests_ooni JOIN tests ON tests.id = ndt_tests_ooni.test_id AND tests.timestamp = ndt_tests_ooni.test_timestamp
+GROUP BY ROLLUP (tests.asn_id)
+HAVING count(*) >= :min_samples
+""")
+
+
+def distribution(quantiles):
+    return {metric: np.sort(np.asarray(quantiles[metric], dtype=float)) for metric in METRICS}
+
+
+def compute(db):
+    """
+    the quantiles of the stored ndt results, of every asn with NDT_REFERENCE_MIN_SAMPLES
+    of them and of all of them with asn_id lookups.NO_ASN, as rows of ndt_distributions
+    """
+    fractions = [(point + 1) / NDT_REFERENCE_POINTS for point in range(NDT_REFERENCE_POINTS)]
+    rows = []
+    for total, asn_id, download, upload, rtt in db.execute(
+            DISTRIBUTIONS, {"fractions": fractions, "min_samples": NDT_REFERENCE_MIN_SAMPLES}):
+        if asn_id is None and not total:
+            continue
+        rows.append({"asn_id": lookups.NO_ASN if total else asn_id, "download": download, "upload": upload,
+                     "rtt": rtt if rtt is not None else MLAB_DECILES["rtt"]})
+    return rows
+
+
+def refresh(db):
+    """
+    replaces the rows of ndt_distributions, in one transaction
+    """
+    try:
+        rows = compute(db)
+        db.query(models.NdtDistribution).delete(synchronize_session=False)
+        if rows:
+            db.execute(models.NdtDistribution.__table__.insert(), rows)
+        db.commit()
+        return len(rows)
+    except Exception:
+        db.rollback()
+        raise
+
+
+class NdtReference(lookups.ReferenceIndex):
+    tables = (models.NdtDistribution.__tablename__,)
+
+    def __init__(self):
+        super().__init__()
+        self.snapshot = {None: distribution(MLAB_DECILES)}
+        self.version = self.digest(self.snapshot)
+
+    def signature(self, db):
+        if NDT_REFERENCE_FILE:
+            return os.stat(NDT_REFERENCE_FILE).st_mtime
+        return super().signature(db)
+
+    def build(self, db):
+        if NDT_REFERENCE_FILE:
+            with open(NDT_REFERENCE_FILE) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            distributions = {int(asn_id): distribution(quantiles)
+                             for asn_id, quantiles in snapshot.get("asns", {}).items()}
+            distributions[None] = distribution(snapshot)
+            return distributions
+        distributions = {None: distribution(MLAB_DECILES)}
+        for row in db.query(models.NdtDistribution):
+            distributions[None if row.asn_id == lookups.NO_ASN else row.asn_id] = distribution(
+                {"download": row.download, "upload": row.upload, "rtt": row.rtt})
+        return distributions
+
+    def digest(self, snapshot):
+        content = hashlib.sha1()
+        for scope in sorted(snapshot, key=lambda asn_id: -1 if asn_id is None else asn_id):
+            content.update(repr(scope).encode())
+            for metric in METRICS:
+                content.update(snapshot[scope][metric].tobytes())
+        return content.hexdigest()[:16]
+
+    def rank(self, ndt_tests, asn_ids=None):
+        """
+        percentile rank of the download, upload and rtt of each test, against the
+        distribution of its asn when there is one and the global one otherwise.
+        """
+        snapshot = self.snapshot
+        asn_ids = asn_ids or [None] * len(ndt_tests)
+        scopes = {}
+        for position, asn_id in enumerate(asn_ids):
+            scopes.setdefault(asn_id if asn_id in snapshot else None, []).append(position)
+        ranks = [{} for _ in ndt_tests]
+        for scope, positions in scopes.items():
+            for metric, column in METRICS.items():
+                quantiles = snapshot[scope][metric]
+                values = np.array([getattr(ndt_tests[position], column) for position in positions], dtype=float)
+                points = np.minimum(100, (np.searchsorted(quantiles, values, side='left') + 1) * 100 // len(quantiles))
+                for position, value, point in zip(positions, values.tolist(), points.tolist()):
+                    ranks[position]["p_" + metric] = None if np.isnan(value) else point
+        return ranks
+
+
+reference = NdtReference()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2 or sys.argv[1] != "refresh":
+        sys.exit("usage: python percentiles.py refresh [seconds]")
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    while True:
+        db = database.SessionLocal()
+        try:
+            logging.info("%s ndt distributions computed", refresh(db))
+        finally:
+            db.close()
+        if seconds is None:
+            break
+        time.sleep(seconds)
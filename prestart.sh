@@ -0,0 +1,4 @@
+#! /usr/bin/env sh
+# run by the uvicorn-gunicorn image before starting the workers
+python /app/migrations.py upgrade
+python /app/partitions.py premake
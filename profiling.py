@@ -0,0 +1,233 @@
+"""
+Opt-in profiling of single requests. A request is profiled when it has an
+X-Profile header and the X-Admin-Token of main.is_admin, or with probability
+PROFILE_SAMPLE_RATE (0 to 1). Its response then has an X-Profile-Id header, and
+PROFILE_DIRECTORY gets
+    <id>.folded     the stacks sampled every PROFILE_INTERVAL_SECONDS, one line
+                    "thread;frame;...;frame count" per stack, as flamegraph.pl,
+                    speedscope or inferno read them
+    <id>.json       the request, its time, its time in SQL, and its statements,
+                    the SELECT statements slower than PROFILE_EXPLAIN_SECONDS with
+                    their EXPLAIN (ANALYZE, BUFFERS) plan
+Sampled threads are the one of the event loop, which runs the async handlers
+and the validation, and the ones that executed SQL for the request, as the
+threadpool threads of the sync sessions. They may run other requests at the
+same time, whose frames then show in the profile too.
+The plan is taken right after the statement, on its connection and within a
+savepoint, so the statement runs twice. Requests that are not profiled only pay
+for a header lookup, and their statements for reading a ContextVar.
+"""
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from sqlalchemy import event
+from starlette.requests import Request
+from starlette.concurrency import run_in_threadpool
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+import metrics
+
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIRECTORY = os.environ.get('PROFILE_DIRECTORY', '/tmp/profiles')
+PROFILE_INTERVAL_SECONDS = float(os.environ.get('PROFILE_INTERVAL_SECONDS', 0.005))
+PROFILE_EXPLAIN_SECONDS = float(os.environ.get('PROFILE_EXPLAIN_SECONDS', metrics.SLOW_QUERY_SECONDS))
+
+PROFILE_HEADER = b"x-profile"
+STATEMENT_MAX_LENGTH = 10000
+
+current_profile = ContextVar("current_profile", default=None)
+
+
+class Profile:
+
+    def __init__(self, scope):
+        self.id = "%s-%s" % (datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S"), uuid.uuid4().hex[:8])
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query_string = scope.get("query_string", b"").decode("latin-1")
+        self.threads = {threading.get_ident()}
+        self.samples = Counter()
+        self.statements = []
+        self.db_seconds = 0.0
+
+    def report(self, handler, status_code, seconds):
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "query_string": self.query_string,
+            "handler": handler,
+            "status": status_code,
+            "seconds": seconds,
+            "db_seconds": self.db_seconds,
+            "samples": sum(self.samples.values()),
+            "interval_seconds": PROFILE_INTERVAL_SECONDS,
+            "statements": self.statements,
+        }
+
+    def write(self, directory, handler, status_code, seconds):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, self.id + ".folded"), "w") as folded:
+            for stack, count in self.samples.most_common():
+                folded.write("%s %d\n" % (stack, count))
+        with open(os.path.join(directory, self.id + ".json"), "w") as report:
+            json.dump(self.report(handler, status_code, seconds), report, indent=2, default=str)
+
+
+def folded_stack(thread_name, frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    frames.append(thread_name)
+    return ";".join(reversed(frames))
+
+
+class Sampler:
+    """
+    a daemon thread sampling the stacks of the threads of the active profiles,
+    running while there is one
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.active = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, profile):
+        with self._lock:
+            self.active.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+                self._thread.start()
+
+    def remove(self, profile):
+        with self._lock:
+            self.active.discard(profile)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self.active:
+                    self._thread = None
+                    return
+                profiles = list(self.active)
+            frames = sys._current_frames()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for profile in profiles:
+                for ident in list(profile.threads):
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        profile.samples[folded_stack(names.get(ident, str(ident)), frame)] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+sampler = Sampler()
+
+
+def explain(connection, statement, parameters):
+    """
+    the EXPLAIN (ANALYZE, BUFFERS) of a statement, run again on its DBAPI
+    connection, without the events of the engine
+    """
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute("SAVEPOINT profile_explain")
+        try:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters)
+            return "\n".join(row[0] for row in cursor.fetchall())
+        finally:
+            # EXPLAIN ANALYZE runs the statement, nothing of it is kept
+            cursor.execute("ROLLBACK TO SAVEPOINT profile_explain")
+            cursor.execute("RELEASE SAVEPOINT profile_explain")
+    finally:
+        cursor.close()
+
+
+def instrument(engine):
+    """
+    engine: a sync Engine, for an AsyncEngine its sync_engine
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        profile = current_profile.get()
+        if profile is not None:
+            profile.threads.add(threading.get_ident())
+            conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        profile = current_profile.get()
+        if profile is None or not conn.info.get("profile_start"):
+            return
+        seconds = time.perf_counter() - conn.info["profile_start"].pop()
+        profile.db_seconds += seconds
+        entry = {"statement": statement[:STATEMENT_MAX_LENGTH], "parameters": metrics.truncate(parameters),
+                 "seconds": seconds}
+        if seconds >= PROFILE_EXPLAIN_SECONDS and not executemany and statement.lstrip()[:6].upper() == "SELECT":
+            try:
+                entry["plan"] = explain(conn, statement, parameters)
+            except Exception as e:
+                logging.error("Error explaining a profiled statement", exc_info=e)
+                entry["plan_error"] = str(e)
+        profile.statements.append(entry)
+
+    @event.listens_for(engine, "handle_error")
+    def discard_statement(exception_context):
+        starts = exception_context.connection.info.get("profile_start") if exception_context.connection else None
+        if starts:
+            starts.pop()
+
+
+class ProfilingMiddleware:
+
+    def __init__(self, app, is_admin=None):
+        self.app = app
+        self.is_admin = is_admin
+
+    def wants_profile(self, scope):
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            return True
+        return self.is_admin is not None and any(name == PROFILE_HEADER for name, _ in scope["headers"]) \
+            and self.is_admin(Request(scope))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.wants_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        profile = Profile(scope)
+        token = current_profile.set(profile)
+        status_code = 500
+
+        async def send_with_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message = dict(message, headers=list(message.get("headers", [])) + [
+                    (b"x-profile-id", profile.id.encode("latin-1"))])
+            await send(message)
+
+        sampler.add(profile)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            seconds = time.perf_counter() - start
+            sampler.remove(profile)
+            current_profile.reset(token)
+            handler = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            try:
+                await run_in_threadpool(profile.write, PROFILE_DIRECTORY, handler, status_code, seconds)
+            except Exception as e:
+                logging.error("Error writing profile %s" % profile.id, exc_info=e)
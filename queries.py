@@ -1,132 +1,125 @@
 from sqlalchemy.orm import Session
 from sqlalchemy.sql import exists
-from sqlalchemy import and_, or_, desc
+from sqlalchemy import and_, or_, desc, func, cast
+from sqlalchemy.dialects.postgresql import INET, MACADDR
 import models
 import schemas
-from bisect import bisect_left
+import lookups
+import percentiles
+import serializers
+import validation
 
 
 def get_asn_by_ip(db: Session, ip: str):
+    if lookups.asn_index.loaded:
+        return lookups.asn_index.lookup(ip)
     asn = db.query(models.Asn).join(models.LatestSubnetAsns, models.Asn.id == models.LatestSubnetAsns.asn_id).\
-        filter(models.LatestSubnetAsns.subnet.op(">>")(ip)).\
+        filter(models.LatestSubnetAsns.subnet.op(">>")(cast(ip, INET))).\
+        order_by(func.masklen(models.LatestSubnetAsns.subnet).desc()).\
         first()
     return asn
 
 
-def add_to_database(db: Session, schema_test: schemas.BaseModel):
-    db.add(schema_test)
-    db.commit()
-    db.refresh(schema_test)
+def get_manuf_entries(db: Session, devices_tests):
+    # the devices validated by validation.py already have their mac as an integer
+    mac_ints = [devices_test.mac_int if isinstance(devices_test, validation.DevicesTestRecord) else lookups.mac_to_int(devices_test.mac)
+                for devices_test in devices_tests]
+    if lookups.manuf_index.loaded:
+        return lookups.manuf_index.lookup_many(mac_ints)
+    if not mac_ints:
+        return []
+    # the same longest prefix match as the index, on the range of macs of each prefix of every mask
+    masks = [mask for (mask,) in db.query(models.MacManuf.mask).distinct() if 0 < mask <= lookups.MAC_BITS]
+    conditions = []
+    for mask in masks:
+        host_bits = lookups.MAC_BITS - mask
+        for prefix in {mac_int >> host_bits for mac_int in mac_ints}:
+            conditions.append(and_(models.MacManuf.mask == mask, models.MacManuf.mac.between(
+                cast(lookups.int_to_mac(prefix << host_bits), MACADDR),
+                cast(lookups.int_to_mac(((prefix + 1) << host_bits) - 1), MACADDR))))
+    snapshot = []
+    if conditions:
+        snapshot = lookups.manuf_snapshot(db.query(
+            models.MacManuf.mac, models.MacManuf.mask, models.MacManuf.manuf, models.MacManuf.comment).
+            filter(or_(*conditions)).order_by(models.MacManuf.mask.desc()))
+    return [lookups.lookup_manuf(snapshot, mac_int) for mac_int in mac_ints]
+
+
+def get_manufs(db: Session, devices_tests):
+    return [{"mac": devices_test.mac, "mask": devices_test.mask, "manuf": entry[1] if entry else None}
+            for devices_test, entry in zip(devices_tests, get_manuf_entries(db, devices_tests))]
+
+
+def get_only_manufs(db: Session, devices_tests):
+    return [(entry[2] or entry[1]) if entry else None for entry in get_manuf_entries(db, devices_tests)]
 
 
-def check_mac_mask_exists(db, schema_test: schemas.BaseModel):
-    return db.query(exists().where(and_(models.MacManuf.mac == schema_test.mac, models.MacManuf.mask == schema_test.mask))).scalar()
+def get_manuf(db: Session, devices_test: models.DevicesTest):
+    return get_manufs(db, [devices_test])[0]
 
 
-def create_test_base(db: Session, test_base: schemas.TestBase, ip):
-    asn = get_asn_by_ip(db, ip)
-    asn_id = asn.id if asn else None
-    db_test = models.Test(**test_base.dict(), public_ip=ip, asn_id=asn_id)
-    add_to_database(db, db_test)
-    return db_test
+def get_only_manuf(db: Session, devices_test: models.DevicesTest):
+    return get_only_manufs(db, [devices_test])[0]
 
 
-def create_specific_test(db: Session, result_test: schemas.BaseModel, model_test: models.Base, id_fk=None):
-    db_test = model_test(
-        **result_test.dict(), test_id=id_fk) if id_fk else model_test(**result_test.dict())
-    add_to_database(db, db_test)
-    return db_test
+def latest_tests(db: Session, ip, model_test: models.Base, limit=5):
+    return db.query(models.Test.id, models.Test.timestamp).filter(
+        models.Test.public_ip == cast(ip, INET), exists().where(and_(
+            model_test.test_id == models.Test.id, model_test.test_timestamp == models.Test.timestamp))).\
+        order_by(models.Test.timestamp.desc()).limit(limit).subquery()
 
 
-def get_manuf(db: Session, devices_test: models.DevicesTest):
-    if check_mac_mask_exists(db, devices_test):
-        manuf_device = db.query(models.MacManuf).filter(and_(
-            models.MacManuf.mac == devices_test.mac, models.MacManuf.mask == devices_test.mask)).first()
-    else:
-        manuf_device = schemas.MacManufOut(
-            mac=devices_test.mac, mask=devices_test.mask)
-    return manuf_device
+def get_latest_test(db: Session, ip):
+    """
+    id and timestamp of the latest test of ip, the version of its results
+    """
+    return db.query(models.Test.id, models.Test.timestamp).filter(models.Test.public_ip == cast(ip, INET)).\
+        order_by(models.Test.timestamp.desc(), models.Test.id.desc()).first()
 
 
-def get_only_manuf(db: Session, devices_test: models.DevicesTest):
-    if check_mac_mask_exists(db, devices_test):
-        mac_manuf = db.query(models.MacManuf).filter(and_(
-            models.MacManuf.mac == devices_test.mac, models.MacManuf.mask == devices_test.mask)).first()
-        manuf_device = mac_manuf.comment if mac_manuf.comment != "" else mac_manuf.manuf
-    else:
-        manuf_device = None
-    return manuf_device
+def group_by_test(rows):
+    results = {}
+    for test, timestamp in rows:
+        results.setdefault(test.test_id, {"test": [], "timestamp": timestamp})["test"].append(serializers.row(test))
+    return list(results.values())
+
+
+def latest_rows(db: Session, ip, model_test: models.Base):
+    latest = latest_tests(db, ip, model_test)
+    return db.query(model_test, latest.c.timestamp).join(latest, and_(
+        model_test.test_id == latest.c.id, model_test.test_timestamp == latest.c.timestamp)).\
+        order_by(latest.c.timestamp.desc(), model_test.test_id, model_test.id).all()
+
 
 def get_tests_with_list(db: Session, ip, model_test: models.Base):
-    tests_id_timestamp = db.query(model_test.test_id, models.Test.timestamp).distinct().join(
-        models.Test).filter(models.Test.public_ip == ip).order_by(models.Test.timestamp.desc())[:5]
-    results = []
-    for test_id_timestamp in tests_id_timestamp:
-        results.append({
-            "test": db.query(model_test).filter(model_test.test_id == test_id_timestamp[0]).all(),
-            "timestamp": test_id_timestamp[1]
-        })
-    return results
+    return group_by_test(latest_rows(db, ip, model_test))
+
+
+DEVICES_OUT_FIELDS = tuple(name for name in schemas.DevicesOut.__fields__ if name != "manuf")
 
 
 def get_devices_tests(db: Session, ip):
-    tests_id_timestamp = db.query(models.DevicesTest.test_id, models.Test.timestamp).distinct().join(
-        models.Test).filter(models.Test.public_ip == ip).order_by(models.Test.timestamp.desc())[:5]
-    results = []
-    for test_id_timestamp in tests_id_timestamp:
-        results.append({
-            "test": [schemas.DevicesOut(**devices_test.__dict__, manuf=get_only_manuf(db, devices_test)) for devices_test in db.query(models.DevicesTest).filter(models.DevicesTest.test_id == test_id_timestamp[0]).all()],
-            "timestamp": test_id_timestamp[1]
-        })
-    return results
+    rows = latest_rows(db, ip, models.DevicesTest)
+    manufs = get_only_manufs(db, [devices_test for devices_test, _ in rows])
+    results = {}
+    for (devices_test, timestamp), manuf in zip(rows, manufs):
+        results.setdefault(devices_test.test_id, {"test": [], "timestamp": timestamp})["test"].append(
+            dict(serializers.row(devices_test, DEVICES_OUT_FIELDS), manuf=manuf))
+    return list(results.values())
 
 
 def get_tests(db: Session, ip, model_test: models.Base):
     tests = db.query(model_test, models.Test.timestamp).join(models.Test).filter(
-        models.Test.public_ip == ip).order_by(models.Test.timestamp.desc())[:5]
-    return [{"test": test[0], "timestamp":test[1]} for test in tests]
-
-
-def get_ooni_web_tests(db: Session, ip):
-    tests_ooni = db.query(models.WebTestOoni, models.Test.timestamp).join(models.Test).filter(
-        models.Test.public_ip == ip).order_by(models.Test.timestamp.desc())[:5]
-    results = []
-    for test in tests_ooni:
-        tpc_connect = db.query(models.TcpConnectWebTestOoni).filter(
-            models.TcpConnectWebTestOoni.test_id == test[0].id).all()
-        results.append({
-            "test": test[0],
-            "tcp_connect": tpc_connect,
-            "timestamp": test[1]
-        })
-    return results
+        models.Test.public_ip == cast(ip, INET)).order_by(models.Test.timestamp.desc())[:5]
+    return [{"test": serializers.row(test[0]), "timestamp":test[1]} for test in tests]
 
 
 def get_ndt_test(db: Session, ip, model_test: models.NdtTestOoni):
-    tests = db.query(model_test, models.Test.timestamp).join(models.Test).filter(
-        models.Test.public_ip == ip).order_by(models.Test.timestamp.desc())[:5]
-    return [{"test": test[0], "mlab": get_mlab(test[0]), "timestamp":test[1]} for test in tests]
+    tests = db.query(model_test, models.Test.timestamp, models.Test.asn_id).join(models.Test).filter(
+        models.Test.public_ip == cast(ip, INET)).order_by(models.Test.timestamp.desc())[:5]
+    mlabs = percentiles.reference.rank([test[0] for test in tests], [test[2] for test in tests])
+    return [{"test": serializers.row(test[0]), "mlab": mlab, "timestamp":test[1]} for test, mlab in zip(tests, mlabs)]
 
 
 def get_mlab(ndt: models.NdtTestOoni):
-    download = [0.23243849257549207, 0.6875543587708922, 1.4410504358198128, 2.5799351721570947,
-                4.2181690863027095, 8.773812503971508, 15.482419418393432, 26.208500361301887, 48.865976128894346,
-                182.20702077771392]
-    min_download = 0.0
-    max_download = 695.5644904984871
-    mean_download = 16.960839419237896
-    download_rtt = [76.0, 149.0, 171.0, 226.0,
-                    249.0, 262.0, 270.0, 282.0, 306.0, 839.0]
-
-    upload = [0.2606367586170152, 0.6115126968261643, 1.4246995691135311, 2.4488057786169932, 3.859683497799003,
-              5.912398780958386, 8.91031485283244, 15.44939531147001, 31.775679487886162, 89.76927089572779]
-    min_upload = 0.0
-    max_upload = 528.015639162466
-    mean_upload = 10.976625369387257
-    upload_rtt = [90.148, 158.957, 196.166, 248.975,
-                  262.096, 278.547, 298.721, 324.653, 401.559, 1363.0]
-    return {
-        "p_upload": (bisect_left(upload, ndt.upload) + 1) * 10 if (bisect_left(upload, ndt.upload) < 10) else 100 ,
-        "p_download": (bisect_left(download, ndt.download) + 1) * 10 if (bisect_left(upload, ndt.upload) < 10) else 100 ,
-        "p_rtt": (bisect_left(download_rtt, ndt.avg_rtt) + 1) * 10 if (bisect_left(upload, ndt.upload) < 10) else 100 ,
-    }
+    return percentiles.reference.rank([ndt])[0]
@@ -0,0 +1,362 @@
+"""
+Loader of the reference tables that get_asn_by_ip and get_manuf read:
+    python reference_loader.py asns routeviews-rv2.pfx2as.gz [routeviews-rv6.pfx2as.gz ...] [--names asn.txt]
+    python reference_loader.py manuf manuf.txt
+    asns    prefix-to-AS files of CAIDA ("1.0.0.0<tab>24<tab>13335") into
+            latest_subnet_asns, and with --names a file of AS names, one
+            "13335 CLOUDFLARENET, US" (or "AS13335 ...") per line, into asns.
+            A prefix announced by several ASes ("13335_209242", "64496,64497")
+            is given to the first one. ASes above 2^31 - 1 do not fit asns.id,
+            they are private use or not assigned, their lines are skipped
+    manuf   the manuf file of Wireshark ("00:00:0C<tab>Cisco<tab>Cisco Systems, Inc",
+            "00:1B:C5:00:00:00/36<tab>..."), into macs_manuf
+Files can be gzip or bzip2 compressed (by their extension), - reads stdin.
+Lines are parsed as they are read and streamed with COPY into a shadow table,
+<table>_loading, so memory does not grow with the input, and lines that can not
+be parsed are reported without aborting the load. Once loaded, the shadow table
+keeps the first row of each primary key, gets the constraints and indexes of
+the live table, is analyzed, and then replaces it: both are renamed in one
+transaction, so readers see either the old rows or the new ones. Only the
+rename waits for the readers of the live table, for at most
+REFERENCE_SWAP_LOCK_TIMEOUT, and is retried REFERENCE_SWAP_RETRIES times.
+The swap gives the table a new relid, so lookups.ReferenceIndex reloads it at
+its next check, within REFERENCE_REFRESH_SECONDS, and python latest_results.py
+refresh renders again the sections of latest_results. The ETag of the GET /tests/
+responses has the version of the manufacturers, so cached ones are not served anymore.
+The report, printed as json, has the rows, bytes and seconds of each phase.
+"""
+import argparse
+import bz2
+import gzip
+import ipaddress
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+import database
+import models
+
+REFERENCE_COPY_BUFFER_BYTES = int(os.environ.get('REFERENCE_COPY_BUFFER_BYTES', 1 << 16))
+REFERENCE_SWAP_LOCK_TIMEOUT = os.environ.get('REFERENCE_SWAP_LOCK_TIMEOUT', '2s')
+REFERENCE_SWAP_RETRIES = int(os.environ.get('REFERENCE_SWAP_RETRIES', 5))
+REFERENCE_MAX_ERRORS = int(os.environ.get('REFERENCE_MAX_ERRORS', 1000))
+
+SHADOW_SUFFIX = "_loading"
+REPLACED_SUFFIX = "_replaced"
+MAX_ASN = 2 ** 31 - 1
+LOCK_NOT_AVAILABLE = "55P03"
+
+# the indexes of a table, with the constraint each one backs
+INDEXES = (
+    "SELECT index.relname, pg_get_indexdef(pg_index.indexrelid), pg_constraint.conname, "
+    "pg_get_constraintdef(pg_constraint.oid) FROM pg_index "
+    "JOIN pg_class index ON index.oid = pg_index.indexrelid "
+    "LEFT JOIN pg_constraint ON pg_constraint.conindid = pg_index.indexrelid AND pg_constraint.contype IN ('p', 'u', 'x') "
+    "WHERE pg_index.indrelid = CAST(%(table)s AS regclass) ORDER BY index.relname")
+INDEX_DEFINITION = re.compile(r"^CREATE (UNIQUE )?INDEX (\S+) ON (ONLY )?(\S+) ")
+
+
+def parse_prefix(line):
+    prefix, length, origins = line.split()
+    asn_id = int(re.split("[_,]", origins)[0])
+    if not 0 < asn_id <= MAX_ASN:
+        raise ValueError("AS%d does not fit asns.id" % asn_id)
+    return asn_id, str(ipaddress.ip_network("%s/%s" % (prefix, length), strict=False))
+
+
+def parse_as_name(line):
+    asn, _, name = line.strip().partition(" ")
+    asn_id = int(asn[2:] if asn[:2].upper() == "AS" else asn)
+    if not 0 < asn_id <= MAX_ASN:
+        raise ValueError("AS%d does not fit asns.id" % asn_id)
+    return asn_id, name.strip() or None
+
+
+def parse_manuf(line):
+    fields = line.rstrip("\r\n").split("\t")
+    address, _, mask = fields[0].strip().partition("/")
+    octets = re.split("[:.-]", address)
+    if not 0 < len(octets) <= 6 or not all(re.fullmatch("[0-9A-Fa-f]{2}", octet) for octet in octets):
+        raise ValueError("invalid address %s" % fields[0])
+    mask = int(mask) if mask else 8 * len(octets)
+    if not 0 < mask <= 48:
+        raise ValueError("invalid mask %s" % mask)
+    manuf = fields[1].strip() if len(fields) > 1 else ""
+    comment = fields[2].strip() if len(fields) > 2 else None
+    # older files have "Short # Long name" or "Short<tab># Long name"
+    if "#" in manuf:
+        manuf, _, comment = manuf.partition("#")
+        manuf = manuf.strip()
+    if comment is not None:
+        comment = comment.lstrip("#").strip() or None
+    if not manuf:
+        raise ValueError("no manufacturer")
+    return ":".join(octets + ["00"] * (6 - len(octets))).lower(), mask, manuf, comment
+
+
+def is_comment(line):
+    line = line.strip()
+    return not line or line.startswith("#")
+
+
+class LoadReport:
+
+    def __init__(self, table):
+        self.table = table
+        self.files = []
+        self.lines = 0
+        self.bytes = 0
+        self.rows = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self.errors = []
+        self.seconds = {}
+        self.start = time.perf_counter()
+
+    def add_error(self, path, line_number, error):
+        self.skipped += 1
+        if len(self.errors) < REFERENCE_MAX_ERRORS:
+            self.errors.append({"file": path, "line": line_number, "error": str(error)})
+
+    def timed(self, phase, start):
+        self.seconds[phase] = round(self.seconds.get(phase, 0) + time.perf_counter() - start, 3)
+
+    def dict(self):
+        copy_seconds = self.seconds.get("copy")
+        return {
+            "table": self.table,
+            "files": self.files,
+            "lines": self.lines,
+            "rows": self.rows - self.duplicates,
+            "skipped": self.skipped,
+            "duplicates": self.duplicates,
+            "seconds": self.seconds,
+            "rows_per_second": round(self.rows / copy_seconds, 1) if copy_seconds else None,
+            "megabytes_per_second": round(self.bytes / copy_seconds / 1e6, 2) if copy_seconds else None,
+            "errors": self.errors,
+        }
+
+
+def open_input(path):
+    if path == "-":
+        return sys.stdin.buffer
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    return open(path, "rb")
+
+
+def parse_files(paths, parse, report):
+    """
+    the rows of the lines of the files that parse, the others are added to the report
+    """
+    for path in paths:
+        report.files.append(path)
+        source = open_input(path)
+        try:
+            for line_number, line in enumerate(source, 1):
+                report.bytes += len(line)
+                line = line.decode("utf-8", "replace")
+                if is_comment(line):
+                    continue
+                report.lines += 1
+                try:
+                    row = parse(line)
+                except (ValueError, TypeError) as e:
+                    report.add_error(path, line_number, e)
+                    continue
+                report.rows += 1
+                yield row
+        finally:
+            if source is not sys.stdin.buffer:
+                source.close()
+
+
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class CopyStream:
+    """
+    file-like object reading rows as the text format of COPY, for cursor.copy_expert
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.buffer += ("\t".join(copy_value(value) for value in row) + "\n").encode("utf-8")
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+
+def create_shadow(cursor, table):
+    shadow = table.name + SHADOW_SUFFIX
+    # left by a load that failed
+    cursor.execute("DROP TABLE IF EXISTS %s" % shadow)
+    # no constraint nor index yet, they are built once the rows are in
+    cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)" % (shadow, table.name))
+    return shadow
+
+
+def copy_rows(cursor, shadow, table, rows):
+    columns = ", ".join(column.name for column in table.columns)
+    cursor.copy_expert("COPY %s (%s) FROM STDIN" % (shadow, columns), CopyStream(rows), size=REFERENCE_COPY_BUFFER_BYTES)
+
+
+def remove_duplicates(cursor, shadow, table):
+    """
+    keeps the first row of each primary key, returns the count of the removed ones
+    """
+    key = ", ".join(column.name for column in table.primary_key)
+    cursor.execute(
+        "DELETE FROM {shadow} WHERE ctid IN (SELECT ctid FROM (SELECT ctid, row_number() OVER "
+        "(PARTITION BY {key} ORDER BY ctid) AS number FROM {shadow}) numbered WHERE number > 1)".format(
+            shadow=shadow, key=key))
+    return cursor.rowcount
+
+
+def table_indexes(cursor, table_name):
+    cursor.execute(INDEXES, {"table": table_name})
+    return cursor.fetchall()
+
+
+def build_indexes(cursor, shadow, table):
+    """
+    the constraints and indexes of the live table on the shadow one, named with SHADOW_SUFFIX
+    """
+    for index_name, index_definition, constraint_name, constraint_definition in table_indexes(cursor, table.name):
+        if constraint_name is not None:
+            cursor.execute("ALTER TABLE %s ADD CONSTRAINT %s %s" % (
+                shadow, constraint_name + SHADOW_SUFFIX, constraint_definition))
+        else:
+            cursor.execute(INDEX_DEFINITION.sub(
+                lambda match: "CREATE %sINDEX %s ON %s " % (match.group(1) or "", index_name + SHADOW_SUFFIX, shadow),
+                index_definition))
+    cursor.execute("ANALYZE %s" % shadow)
+
+
+def swap_tables(cursor, tables):
+    """
+    replaces the live tables by their shadow ones, in the transaction of cursor
+    """
+    cursor.execute("SET LOCAL lock_timeout = %s", (REFERENCE_SWAP_LOCK_TIMEOUT,))
+    for table in tables:
+        indexes = [row[0] for row in table_indexes(cursor, table.name)]
+        cursor.execute("ALTER TABLE %s RENAME TO %s" % (table.name, table.name + REPLACED_SUFFIX))
+        for index_name in indexes:
+            # renaming the index of a constraint renames the constraint
+            cursor.execute("ALTER INDEX %s RENAME TO %s" % (index_name, index_name + REPLACED_SUFFIX))
+        cursor.execute("ALTER TABLE %s RENAME TO %s" % (table.name + SHADOW_SUFFIX, table.name))
+        for index_name in indexes:
+            cursor.execute("ALTER INDEX %s RENAME TO %s" % (index_name + SHADOW_SUFFIX, index_name))
+        cursor.execute("DROP TABLE %s" % (table.name + REPLACED_SUFFIX))
+
+
+def swap(connection, tables, retries=REFERENCE_SWAP_RETRIES):
+    for attempt in range(retries + 1):
+        cursor = connection.cursor()
+        try:
+            swap_tables(cursor, tables)
+            connection.commit()
+            return
+        except Exception as e:
+            connection.rollback()
+            if getattr(e, "pgcode", None) != LOCK_NOT_AVAILABLE or attempt == retries:
+                raise
+            logging.warning("tables %s busy, swap retried", ", ".join(table.name for table in tables))
+            time.sleep(min(2 ** attempt, 10) * 0.1)
+        finally:
+            cursor.close()
+
+
+def drop_shadows(connection, tables):
+    try:
+        cursor = connection.cursor()
+        for table in tables:
+            cursor.execute("DROP TABLE IF EXISTS %s" % (table.name + SHADOW_SUFFIX))
+        connection.commit()
+        cursor.close()
+    except Exception as e:
+        logging.error("Error dropping the shadow tables", exc_info=e)
+
+
+def load(sources, engine=None):
+    """
+    loads every source into its shadow table and swaps them all in at once
+    sources: list of (model, parse, paths)
+    returns the report of each table
+    """
+    engine = engine or database.engine
+    connection = engine.raw_connection()
+    reports = []
+    try:
+        cursor = connection.cursor()
+        try:
+            for model, parse, paths in sources:
+                table = model.__table__
+                report = LoadReport(table.name)
+                reports.append(report)
+                start = time.perf_counter()
+                shadow = create_shadow(cursor, table)
+                copy_rows(cursor, shadow, table, parse_files(paths, parse, report))
+                connection.commit()
+                report.timed("copy", start)
+                if report.rows == 0:
+                    raise ValueError("no rows for %s in %s, the table is kept" % (table.name, ", ".join(paths)))
+                start = time.perf_counter()
+                report.duplicates = remove_duplicates(cursor, shadow, table)
+                build_indexes(cursor, shadow, table)
+                connection.commit()
+                report.timed("index", start)
+        finally:
+            cursor.close()
+        start = time.perf_counter()
+        swap(connection, [model.__table__ for model, _, _ in sources])
+        for report in reports:
+            report.timed("swap", start)
+            report.seconds["total"] = round(time.perf_counter() - report.start, 3)
+    except Exception:
+        connection.rollback()
+        drop_shadows(connection, [model.__table__ for model, _, _ in sources])
+        raise
+    finally:
+        connection.close()
+    return reports
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description="load the asn and manufacturer reference tables")
+    commands = parser.add_subparsers(dest="command", required=True)
+    asns_parser = commands.add_parser("asns")
+    asns_parser.add_argument("prefixes", nargs="+", help="CAIDA prefix-to-AS files")
+    asns_parser.add_argument("--names", help="AS names file, asns is kept without it")
+    manuf_parser = commands.add_parser("manuf")
+    manuf_parser.add_argument("manuf", nargs="+", help="Wireshark manuf files")
+    return parser.parse_args(arguments)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    options = parse_arguments(sys.argv[1:])
+    if options.command == "asns":
+        sources = [(models.LatestSubnetAsns, parse_prefix, options.prefixes)]
+        if options.names:
+            sources.insert(0, (models.Asn, parse_as_name, [options.names]))
+    else:
+        sources = [(models.MacManuf, parse_manuf, options.manuf)]
+    for report in load(sources):
+        print(json.dumps(report.dict()))
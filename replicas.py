@@ -0,0 +1,241 @@
+"""
+Routing of the reads to the read replicas of DATABASE_REPLICA_URLS.
+GET handlers take their session from main.get_read_db, which gives the healthy
+replicas in turn, or the primary when
+    - the client ip posted a test in the last DB_REPLICA_STICKY_SECONDS, so it
+      reads its own writes whatever the replication lag
+    - no replica is healthy: a daemon thread checks every
+      DB_REPLICA_CHECK_SECONDS that each replica answers and has replayed the
+      WAL of the primary, or is less than DB_REPLICA_MAX_LAG_SECONDS behind it,
+      and a replica whose connection fails is left out until its next check.
+      The session of a replica gets its connection right away, so a request
+      that finds the replica down is still served by the primary
+The sessions of the POST handlers, and so every write, use the primary. With
+DB_REPLICA_STICKY_BACKEND=cookie (the default) the response to a POST has a
+replica_sticky cookie with the time until which its client reads from the
+primary, so any worker sends it there, later by WRITE_BEHIND_FLUSH_SECONDS with
+write-behind. A client can only send its own reads to the primary with it, and
+only if it stores and sends back cookies: the HTTP stacks of native mobile apps
+often do not by default, so their reads right after a POST may not see it while
+the replica is behind. Deployments serving those clients should use
+DB_REPLICA_STICKY_BACKEND=redis, which keeps the client ip on the server.
+With DB_REPLICA_STICKY_BACKEND=redis the clients that posted are kept in the
+Redis of REDIS_URL, and the write-behind flusher keeps them again once their
+results are written, however long the queue. DB_REPLICA_STICKY_BACKEND=memory
+keeps them in process, for a single worker.
+Any two PostgreSQL servers do for a test, the second one does not even have to
+be a streaming replica of the first (it is then never behind it), see test_replicas.py.
+"""
+from itertools import count
+from sqlalchemy import event, text
+import logging
+import math
+import os
+import threading
+import time
+
+import database
+import response_cache
+
+DB_REPLICA_STICKY_SECONDS = float(os.environ.get('DB_REPLICA_STICKY_SECONDS', 10))
+DB_REPLICA_STICKY_BACKEND = os.environ.get('DB_REPLICA_STICKY_BACKEND', 'cookie')
+DB_REPLICA_STICKY_MAX_CLIENTS = int(os.environ.get('DB_REPLICA_STICKY_MAX_CLIENTS', 100000))
+DB_REPLICA_MAX_LAG_SECONDS = float(os.environ.get('DB_REPLICA_MAX_LAG_SECONDS', 5))
+DB_REPLICA_CHECK_SECONDS = float(os.environ.get('DB_REPLICA_CHECK_SECONDS', 2))
+
+STICKY_COOKIE = "replica_sticky"
+
+PRIMARY_POSITION = text("SELECT pg_current_wal_lsn()::text")
+# a server that is not in recovery is never behind, a replica is behind when it
+# has not replayed the position of the primary, by the age of its last replayed transaction
+REPLICA_LAG = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN CAST(:position AS pg_lsn) IS NOT NULL AND pg_last_wal_replay_lsn() >= CAST(:position AS pg_lsn) THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 'Infinity') END")
+
+
+class Replica:
+
+    def __init__(self, name, engine, sessions, async_engine=None, async_sessions=None):
+        self.name = name
+        self.engine = engine
+        self.sessions = sessions
+        self.async_engine = async_engine
+        self.async_sessions = async_sessions
+        # left out until its first check
+        self.healthy = False
+        self.lag = None
+        self.reads = 0
+        self.failures = 0
+
+
+class ReplicaRouter:
+
+    def __init__(self, replicas, writers, sticky_cookie=False, sticky_seconds=DB_REPLICA_STICKY_SECONDS,
+                 max_lag=DB_REPLICA_MAX_LAG_SECONDS, check_seconds=DB_REPLICA_CHECK_SECONDS):
+        self.replicas = replicas
+        self.writers = writers
+        self.sticky_cookie = sticky_cookie
+        self.sticky_seconds = sticky_seconds
+        self.max_lag = max_lag
+        self.check_seconds = check_seconds
+        self.primary_reads = 0
+        self.sticky_reads = 0
+        self._turn = count()
+        self._stop = threading.Event()
+        self._thread = None
+        for replica in replicas:
+            self.watch(replica)
+
+    def watch(self, replica):
+        engines = [replica.engine] + ([replica.async_engine.sync_engine] if replica.async_engine is not None else [])
+
+        def lost_connection(exception_context):
+            if exception_context.is_disconnect:
+                self.leave_out(replica)
+
+        for engine in engines:
+            event.listen(engine, "handle_error", lost_connection)
+
+    @staticmethod
+    def leave_out(replica, error=None):
+        if replica.healthy:
+            replica.healthy = False
+            replica.failures += 1
+            logging.warning("replica %s left out after a lost connection", replica.name, exc_info=error)
+
+    def stick(self, ip, response=None, delay=0):
+        """
+        sends the reads of ip to the primary for DB_REPLICA_STICKY_SECONDS, with
+        a cookie on response or in the writers backend
+        delay: the seconds before the write reaches the primary
+        """
+        if not self.replicas:
+            return
+        if self.sticky_cookie:
+            if response is not None:
+                seconds = self.sticky_seconds + delay
+                response.set_cookie(STICKY_COOKIE, "%d" % math.ceil(time.time() + seconds),
+                                    max_age=math.ceil(seconds), httponly=True)
+        elif self.writers is not None:
+            self.writers.set("replica:sticky:%s" % ip, b"1")
+
+    async def async_stick(self, ip, response=None, delay=0):
+        await response_cache.run(self.writers, self.stick, ip, response, delay)
+
+    def is_sticky(self, ip, cookies=None):
+        if self.sticky_cookie:
+            try:
+                return float((cookies or {}).get(STICKY_COOKIE, 0)) > time.time()
+            except ValueError:
+                return False
+        return self.writers is not None and self.writers.get("replica:sticky:%s" % ip) is not None
+
+    def choose(self, ip, cookies=None):
+        """
+        the replica to read from, None for the primary
+        """
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            self.primary_reads += 1
+            return None
+        if self.is_sticky(ip, cookies):
+            self.sticky_reads += 1
+            return None
+        replica = healthy[next(self._turn) % len(healthy)]
+        replica.reads += 1
+        return replica
+
+    def session(self, ip, cookies=None):
+        replica = self.choose(ip, cookies)
+        if replica is not None:
+            db = replica.sessions()
+            try:
+                db.connection()
+                return db
+            except Exception as e:
+                db.close()
+                self.leave_out(replica, e)
+        return database.SessionLocal()
+
+    async def async_session(self, ip, cookies=None):
+        replica = await response_cache.run(self.writers, self.choose, ip, cookies)
+        if replica is not None:
+            db = replica.async_sessions()
+            try:
+                await db.connection()
+                return db
+            except Exception as e:
+                await db.close()
+                self.leave_out(replica, e)
+        return database.AsyncSessionLocal()
+
+    def check(self):
+        try:
+            with database.engine.connect() as connection:
+                position = connection.execute(PRIMARY_POSITION).scalar()
+        except Exception as e:
+            # the replicas are still compared to their own last transaction
+            logging.error("Error reading the WAL position of the primary", exc_info=e)
+            position = None
+        for replica in self.replicas:
+            try:
+                with replica.engine.connect() as connection:
+                    lag = float(connection.execute(REPLICA_LAG, {"position": position}).scalar())
+            except Exception as e:
+                if replica.healthy:
+                    replica.failures += 1
+                    logging.error("Error checking replica %s" % replica.name, exc_info=e)
+                replica.healthy = False
+                replica.lag = None
+                continue
+            replica.lag = lag
+            if replica.healthy != (lag <= self.max_lag):
+                logging.warning("replica %s %s, %.1fs behind", replica.name,
+                                "back in use" if not replica.healthy else "left out", lag)
+            replica.healthy = lag <= self.max_lag
+
+    def _run(self):
+        while not self._stop.wait(self.check_seconds):
+            self.check()
+
+    def start(self):
+        if not self.replicas:
+            return
+        self.check()
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+    def stats(self):
+        stats = {"replicas": len(self.replicas), "healthy": sum(replica.healthy for replica in self.replicas),
+                 "primary_reads": self.primary_reads, "sticky_reads": self.sticky_reads}
+        for replica in self.replicas:
+            stats["%s_reads" % replica.name] = replica.reads
+            stats["%s_failures" % replica.name] = replica.failures
+            if replica.lag is not None and replica.lag != float("inf"):
+                stats["%s_lag_seconds" % replica.name] = replica.lag
+        return stats
+
+
+def create_replicas():
+    replicas = []
+    for number, (engine, sessions) in enumerate(zip(database.replica_engines, database.ReplicaSessions)):
+        replica = Replica("replica_%d" % number, engine, sessions)
+        if database.async_replica_engines:
+            replica.async_engine = database.async_replica_engines[number]
+            replica.async_sessions = database.AsyncReplicaSessions[number]
+        replicas.append(replica)
+    return replicas
+
+
+router = ReplicaRouter(
+    create_replicas(),
+    response_cache.create_backend(DB_REPLICA_STICKY_BACKEND, DB_REPLICA_STICKY_SECONDS, DB_REPLICA_STICKY_MAX_CLIENTS,
+                                  response_cache.RESPONSE_CACHE_MAX_BYTES),
+    sticky_cookie=DB_REPLICA_STICKY_BACKEND == 'cookie')
@@ -0,0 +1,171 @@
+"""
+Read-through cache of the GET /tests/ responses, keyed by client ip and
+type_test and invalidated by every POST of that ip. Other workers do not see the
+invalidations of the in process backend, so an entry is only served for the
+ETag it was stored with, which the caller computes from the latest test.
+Responses are stored already rendered as JSON, with their ETag, in process (LRU with TTL and
+entry/size limits) or in a Redis compatible store shared by all workers, any
+client with get/set(ex=)/delete works, so tests can use a local stand-in.
+The Redis round trips are blocking, async callers make them through run, in the
+threadpool.
+"""
+from collections import OrderedDict
+from starlette.concurrency import run_in_threadpool
+import os
+import threading
+import time
+
+import models
+import serializers
+
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'memory')
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', 60))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 10000))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+
+TYPE_TESTS = [None] + list(models.TestsName)
+
+
+class MemoryBackend:
+    blocking = False
+
+    def __init__(self, ttl=RESPONSE_CACHE_TTL_SECONDS, max_entries=RESPONSE_CACHE_MAX_ENTRIES, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self.size += len(value)
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+
+    def _remove(self, key):
+        self.size -= len(self._entries.pop(key)[1])
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    """
+    Entries expire with the ttl, eviction under memory pressure is left to the
+    server maxmemory-policy (allkeys-lru).
+    """
+    blocking = True
+
+    def __init__(self, client, ttl=RESPONSE_CACHE_TTL_SECONDS, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.client = client
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl=None):
+        if len(value) <= self.max_bytes:
+            self.client.set(key, value, ex=max(1, int(self.ttl if ttl is None else ttl)))
+
+    def delete(self, *keys):
+        self.client.delete(*keys)
+
+
+class ResponseCache:
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(ip, type_test=None):
+        return "tests:%s:%s" % (ip, type_test.value if type_test else "all")
+
+    def get(self, ip, type_test=None, etag=""):
+        """
+        the body of the response, None when it is not cached or not for etag
+        """
+        if self.backend is None:
+            return None
+        value = self.backend.get(self.key(ip, type_test))
+        if value is None:
+            self.misses += 1
+            return None
+        cached_etag, body = value.split(b"\n", 1)
+        if cached_etag.decode("latin-1") != etag:
+            self.stale += 1
+            return None
+        self.hits += 1
+        return body
+
+    def set(self, ip, type_test, content, etag=""):
+        return self.set_body(ip, type_test, serializers.dumps(content), etag)
+
+    def set_body(self, ip, type_test, body, etag=""):
+        if self.backend is not None:
+            self.backend.set(self.key(ip, type_test), etag.encode("latin-1") + b"\n" + body)
+        return body
+
+    def invalidate(self, ip):
+        if self.backend is not None:
+            self.invalidations += 1
+            self.backend.delete(*[self.key(ip, type_test) for type_test in TYPE_TESTS])
+
+    def stats(self):
+        stats = {"hits": self.hits, "misses": self.misses, "stale": self.stale, "invalidations": self.invalidations}
+        if isinstance(self.backend, MemoryBackend):
+            stats.update(entries=len(self.backend), bytes=self.backend.size, evictions=self.backend.evictions)
+        return stats
+
+
+async def run(backend, function, *args):
+    """
+    function(*args), in the threadpool when backend makes network round trips
+    """
+    if getattr(backend, "blocking", False):
+        return await run_in_threadpool(function, *args)
+    return function(*args)
+
+
+def create_backend(name=RESPONSE_CACHE_BACKEND, ttl=RESPONSE_CACHE_TTL_SECONDS,
+                   max_entries=RESPONSE_CACHE_MAX_ENTRIES, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+    if name == 'memory':
+        return MemoryBackend(ttl, max_entries, max_bytes)
+    if name == 'redis':
+        import redis
+        return RedisBackend(redis.Redis.from_url(REDIS_URL), ttl, max_bytes)
+    return None
+
+
+cache = ResponseCache(create_backend())
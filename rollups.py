@@ -0,0 +1,298 @@
+"""
+Per asn and per day rollups of the test results, so the stats of an asn are read
+from a handful of rows instead of aggregating the raw tables.
+asn_rollups holds counters named after the table they count:
+    ndt_tests_ooni                      rows of the table
+    dns_tests.ad_flag:true              rows where the flag is true (or false), the
+                                        shares of a flag leave out the null ones
+    web_tests_ooni.blocking:dns         rows with that value in the column
+asn_sketches holds, for the ndt metrics, log-bucketed histograms whose quantiles
+are within ROLLUP_SKETCH_ACCURACY of the real ones (as in DDSketch), and whose
+buckets are merged by adding counts, like the counters.
+With ROLLUP_MODE=watermark (the default) they are left to a single process running
+    python rollups.py refresh [seconds]
+which rebuilds the days of the tests inserted since the last refresh, every
+given seconds if any, so the stats lag the submissions by that long. A refresh
+is not incremental: it reads again every row of each day it touches (the
+current one, usually), since the tests of the last ROLLUP_WATERMARK_OVERLAP ids
+may or may not have been counted already, so its cost grows with the tests of a
+day, not with the ones inserted since the last refresh. With
+ROLLUP_MODE=inline the rollups are updated in the same transaction that inserts
+the tests, which then wait on each other for the row locks of the counters of
+their asn and day. A day can also be rebuilt by hand:
+    python rollups.py rebuild 2021-03-01 [2021-03-02 ...]
+"""
+from datetime import date, datetime, time as day_start, timedelta, timezone
+from sqlalchemy import cast, Date, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+import enum
+import logging
+import math
+import os
+import sys
+import time
+
+import database
+import lookups
+import models
+import percentiles
+
+ROLLUP_MODE = os.environ.get('ROLLUP_MODE', 'watermark')
+ROLLUP_SKETCH_ACCURACY = float(os.environ.get('ROLLUP_SKETCH_ACCURACY', 0.01))
+# tests ids are reserved before their transaction commits, so a refresh also
+# goes back over the days of this many tests before the watermark
+ROLLUP_WATERMARK_OVERLAP = int(os.environ.get('ROLLUP_WATERMARK_OVERLAP', 10000))
+ROLLUP_BATCH_SIZE = int(os.environ.get('ROLLUP_BATCH_SIZE', 10000))
+
+GAMMA = (1 + ROLLUP_SKETCH_ACCURACY) / (1 - ROLLUP_SKETCH_ACCURACY)
+ZERO_BUCKET = -2 ** 31
+
+CATEGORIES = {
+    models.ProtocolTest: ("protocol_name", "key_management"),
+    models.DnsTest: ("rating_source_port", "rating_transaction_id"),
+    models.WebTestOoni: ("blocking", "dns_consistency"),
+}
+FLAGS = {
+    models.DnsTest: ("do_flag", "ad_flag", "rrsig"),
+    models.WebTestOoni: ("accessible",),
+}
+SKETCHES = {
+    models.NdtTestOoni: percentiles.METRICS,
+}
+ROLLUP_MODELS = (models.ProtocolTest, models.DevicesTest, models.DnsTest, models.NdtTestOoni, models.WebTestOoni)
+
+
+def sketch_bucket(value):
+    if value <= 0:
+        return ZERO_BUCKET
+    return math.ceil(math.log(value, GAMMA))
+
+
+def bucket_value(bucket):
+    if bucket == ZERO_BUCKET:
+        return 0.0
+    return 2 * GAMMA ** bucket / (GAMMA + 1)
+
+
+def quantile(buckets, fraction):
+    """
+    buckets: dict of bucket to count
+    """
+    total = sum(buckets.values())
+    if total == 0:
+        return None
+    rank = fraction * (total - 1)
+    seen = 0
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if seen > rank:
+            return bucket_value(bucket)
+
+
+def day_of(timestamp: datetime):
+    if timestamp.tzinfo is None:
+        return timestamp.date()
+    return timestamp.astimezone(timezone.utc).date()
+
+
+class Rollup:
+    """
+    counts accumulated in memory and written with one upsert per table.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.sketches = {}
+
+    def count(self, asn_id, day, name, count=1):
+        key = (asn_id, day, name)
+        self.counters[key] = self.counters.get(key, 0) + count
+
+    def add_test(self, asn_id, day):
+        self.count(asn_id or lookups.NO_ASN, day, models.Test.__tablename__)
+
+    def add(self, asn_id, day, model_test: models.Base, row: dict):
+        asn_id = asn_id or lookups.NO_ASN
+        table = model_test.__tablename__
+        self.count(asn_id, day, table)
+        for column in FLAGS.get(model_test, ()):
+            value = row.get(column)
+            if value is not None:
+                self.count(asn_id, day, "%s.%s:%s" % (table, column, "true" if value else "false"))
+        for column in CATEGORIES.get(model_test, ()):
+            value = row.get(column)
+            if value is not None:
+                value = value.value if isinstance(value, enum.Enum) else value
+                self.count(asn_id, day, "%s.%s:%s" % (table, column, value))
+        for metric, column in SKETCHES.get(model_test, {}).items():
+            value = row.get(column)
+            if value is not None:
+                key = (asn_id, day, metric, sketch_bucket(value))
+                self.sketches[key] = self.sketches.get(key, 0) + 1
+
+    def write(self, db: Session):
+        # sorted so concurrent transactions lock the rows in the same order
+        upsert(db, models.AsnRollup, ["asn_id", "day", "name"], self.counters)
+        upsert(db, models.AsnSketch, ["asn_id", "day", "metric", "bucket"], self.sketches)
+
+
+def upsert(db: Session, model: models.Base, columns, counts):
+    if not counts:
+        return
+    statement = insert(model.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=columns, set_={"count": model.__table__.c.count + statement.excluded.count})
+    db.execute(statement, [dict(zip(columns, key), count=counts[key]) for key in sorted(counts)])
+
+
+def update(db: Session, test_rows, child_rows, now: datetime):
+    """
+    test_rows and child_rows as built by ingest.insert_submissions, written in its transaction.
+    """
+    rollup = Rollup()
+    keys = {}
+    for row in test_rows:
+        keys[row["id"]] = (row["asn_id"], day_of(row.get("timestamp") or now))
+        rollup.add_test(*keys[row["id"]])
+    for model_test, rows in child_rows.items():
+        if model_test in ROLLUP_MODELS:
+            for row in rows:
+                rollup.add(*keys[row["test_id"]], model_test, row)
+    rollup.write(db)
+
+
+def utc_day(timestamp_column):
+    return cast(func.timezone('UTC', timestamp_column), Date)
+
+
+def rebuild(db: Session, day: date):
+    """
+    recomputes the rollups of a day from the raw tables, in the caller's transaction.
+    """
+    start = datetime.combine(day, day_start(), tzinfo=timezone.utc)
+    in_day = (models.Test.timestamp >= start) & (models.Test.timestamp < start + timedelta(days=1))
+    db.query(models.AsnRollup).filter(models.AsnRollup.day == day).delete(synchronize_session=False)
+    db.query(models.AsnSketch).filter(models.AsnSketch.day == day).delete(synchronize_session=False)
+    rollup = Rollup()
+    for (asn_id,) in db.query(models.Test.asn_id).filter(in_day).yield_per(ROLLUP_BATCH_SIZE):
+        rollup.add_test(asn_id, day)
+    for model_test in ROLLUP_MODELS:
+        columns = [getattr(model_test, column) for column in
+                   set(CATEGORIES.get(model_test, ()) + FLAGS.get(model_test, ()) + tuple(SKETCHES.get(model_test, {}).values()))]
+        rows = db.query(models.Test.asn_id, *columns).join(model_test).filter(in_day).yield_per(ROLLUP_BATCH_SIZE)
+        for row in rows:
+            rollup.add(row.asn_id, day, model_test, row._asdict())
+    rollup.write(db)
+
+
+def refresh(db: Session):
+    """
+    rebuilds the days of the tests inserted since the last refresh and moves the watermark.
+    """
+    try:
+        watermark = db.query(models.RollupWatermark).with_for_update().get(models.Test.__tablename__)
+        if watermark is None:
+            watermark = models.RollupWatermark(name=models.Test.__tablename__, test_id=0)
+            db.add(watermark)
+        last_id = db.query(func.max(models.Test.id)).scalar() or 0
+        days = [day for (day,) in db.query(utc_day(models.Test.timestamp)).filter(
+            models.Test.id > watermark.test_id - ROLLUP_WATERMARK_OVERLAP, models.Test.id <= last_id).distinct()]
+        for day in sorted(days):
+            rebuild(db, day)
+        watermark.test_id = max(watermark.test_id, last_id)
+        db.commit()
+        return days
+    except Exception:
+        db.rollback()
+        raise
+
+
+def get_asn_stats(db: Session, asn_id: int, since: date):
+    counters = {}
+    for name, count in db.query(models.AsnRollup.name, func.sum(models.AsnRollup.count)).filter(
+            models.AsnRollup.asn_id == asn_id, models.AsnRollup.day >= since).group_by(models.AsnRollup.name):
+        counters[name] = int(count)
+    sketches = {}
+    for metric, bucket, count in db.query(models.AsnSketch.metric, models.AsnSketch.bucket, func.sum(models.AsnSketch.count)).filter(
+            models.AsnSketch.asn_id == asn_id, models.AsnSketch.day >= since).group_by(models.AsnSketch.metric, models.AsnSketch.bucket):
+        sketches.setdefault(metric, {})[bucket] = int(count)
+    return summary(counters, sketches)
+
+
+def share(count, total):
+    return count / total if total else None
+
+
+def flag_share(counters, name):
+    """
+    the share of the rows where the flag is true among the ones where it is not null
+    """
+    true = counters.get(name + ":true", 0)
+    return share(true, true + counters.get(name + ":false", 0))
+
+
+def values_of(counters, prefix):
+    return {name[len(prefix):]: count for name, count in counters.items() if name.startswith(prefix)}
+
+
+def summary(counters, sketches):
+    ndt = models.NdtTestOoni.__tablename__
+    web = models.WebTestOoni.__tablename__
+    dns = models.DnsTest.__tablename__
+    protocol = models.ProtocolTest.__tablename__
+    blocking = values_of(counters, web + ".blocking:")
+    return {
+        "tests": counters.get(models.Test.__tablename__, 0),
+        ndt: {
+            "tests": counters.get(ndt, 0),
+            **{metric: {"p25": quantile(buckets, 0.25), "median": quantile(buckets, 0.5), "p75": quantile(buckets, 0.75)}
+               for metric, buckets in ((metric, sketches.get(metric, {})) for metric in SKETCHES[models.NdtTestOoni])},
+        },
+        web: {
+            "tests": counters.get(web, 0),
+            "blocking_share": share(sum(count for value, count in blocking.items()
+                                        if value != models.BlockingEnum.not_blocking.value), counters.get(web, 0)),
+            "blocking": blocking,
+            "accessible_share": flag_share(counters, web + ".accessible"),
+        },
+        dns: {
+            "tests": counters.get(dns, 0),
+            "dnssec_validated_share": flag_share(counters, dns + ".ad_flag"),
+            "do_flag_share": flag_share(counters, dns + ".do_flag"),
+            "rrsig_share": flag_share(counters, dns + ".rrsig"),
+            "rating_source_port": values_of(counters, dns + ".rating_source_port:"),
+            "rating_transaction_id": values_of(counters, dns + ".rating_transaction_id:"),
+        },
+        protocol: {
+            "tests": counters.get(protocol, 0),
+            "protocol_name": values_of(counters, protocol + ".protocol_name:"),
+            "key_management": values_of(counters, protocol + ".key_management:"),
+        },
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "refresh"
+    if command == "refresh":
+        seconds = float(sys.argv[2]) if len(sys.argv) > 2 else None
+        while True:
+            db = database.SessionLocal()
+            try:
+                logging.info("refreshed rollups of %s", [str(day) for day in refresh(db)])
+            finally:
+                db.close()
+            if seconds is None:
+                break
+            time.sleep(seconds)
+    elif command == "rebuild" and len(sys.argv) > 2:
+        db = database.SessionLocal()
+        try:
+            for day in sys.argv[2:]:
+                rebuild(db, date.fromisoformat(day))
+            db.commit()
+        finally:
+            db.close()
+    else:
+        sys.exit("usage: python rollups.py [refresh [seconds] | rebuild day [day ...]]")
@@ -3,7 +3,7 @@
  * the regex code for the private ip address was obtained from stackoverflow (https://stackoverflow.com/questions/2814002/private-ip-address-identifier-in-regular-expression)
 """
 from pydantic import BaseModel, PositiveInt, IPvAnyAddress, constr, conint, confloat, root_validator
-from typing import Optional, List
+from typing import Any, Optional, List
 from datetime import datetime 
 
 import models
@@ -46,6 +46,16 @@ class DevicesTest(BaseModel):
     class Config:
         orm_mode = True
 
+# the bodies of POST /tests/protocol and POST /tests/devices, validated by
+# validation.py, these only document them in the OpenAPI schema
+class ProtocolTestsBody(BaseModel):
+    test: List[ProtocolTest]
+    test_base: TestBase = TestBase()
+
+class DevicesTestsBody(BaseModel):
+    test: List[DevicesTest]
+    test_base: TestBase = TestBase()
+
 class DevicesOut(BaseModel):
     mac: constr(regex = r'^([0-9A-Fa-f]{2}[:]){5}([0-9A-Fa-f]{2})')
     mask: PositiveInt = 24
@@ -151,4 +161,12 @@ class TcpConnectWebTestOoni(BaseModel):
     status_failure_string: Optional[str]
     status_success: bool
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+class ImportRecord(BaseModel):
+    type: str
+    public_ip: IPvAnyAddress
+    timestamp: Optional[datetime]
+    test_base: TestBase = TestBase()
+    test: Any
+    tcp_connect: List[TcpConnectWebTestOoni] = []
@@ -0,0 +1,75 @@
+"""
+Serialization of trusted data, rows read from the database and schemas that
+were already validated, without going through pydantic validation or
+jsonable_encoder again.
+row projects an ORM instance into a dict of its columns (or of the fields of an
+output schema), with the attribute getters of each model built once. dumps
+renders JSON with orjson when it is installed (pip install orjson) and with the
+json module otherwise, JSONResponse uses it.
+"""
+from fastapi.responses import JSONResponse as StarletteJSONResponse
+from operator import attrgetter
+from sqlalchemy import inspect
+import enum
+import ipaddress
+import json
+
+import validation
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_getters = {}
+
+
+def projection(model, fields=None):
+    """
+    fields: names of the attributes to keep, by default the columns of the model
+    that are not marked info={'internal': True}
+    """
+    key = (model, fields)
+    if key not in _getters:
+        names = tuple(fields or (attribute.key for attribute in inspect(model).column_attrs
+                                 if not attribute.columns[0].info.get('internal')))
+        getter = attrgetter(*names)
+        _getters[key] = (names, getter if len(names) > 1 else lambda instance: (getter(instance),))
+    return _getters[key]
+
+
+def row(instance, fields=None):
+    names, getter = projection(type(instance), fields)
+    return dict(zip(names, getter(instance)))
+
+
+def values(schema):
+    """
+    field values of a validated pydantic model, what .dict() returns for a flat
+    model, or of a validation.Record
+    """
+    if isinstance(schema, validation.Record):
+        return schema.values()
+    return dict(schema.__dict__)
+
+
+def default(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, (ipaddress.IPv4Address, ipaddress.IPv6Address, ipaddress.IPv4Network, ipaddress.IPv6Network)):
+        return str(value)
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    raise TypeError("%r is not JSON serializable" % type(value))
+
+
+def dumps(content):
+    if orjson is not None:
+        return orjson.dumps(content, default=default)
+    return json.dumps(content, default=default, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+class JSONResponse(StarletteJSONResponse):
+
+    def render(self, content):
+        return dumps(content)
@@ -0,0 +1,184 @@
+"""
+admission: the token buckets of the clients, in process and in Redis (against
+fakeredis, which runs the script, when it is installed), and AdmissionMiddleware
+answering 429 and 503 with Retry-After:
+    python -m pytest test_admission.py
+"""
+import asyncio
+import os
+import types
+
+import pytest
+from starlette.testclient import TestClient
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URL', 'postgresql://localhost/wifi')
+
+import admission  # noqa: E402
+import main  # noqa: E402
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(admission, "time", types.SimpleNamespace(monotonic=lambda: clock.now, time=lambda: clock.now))
+    return clock
+
+
+def takes(buckets, clock):
+    # the waits of taking tokens at the given seconds from now
+    def take(*seconds, client="10.0.0.1"):
+        waits = []
+        for delay in seconds:
+            clock.now += delay
+            waits.append(buckets.take(client))
+        return waits
+    return take
+
+
+def check_bucket(buckets, clock):
+    take = takes(buckets, clock)
+    # the burst, then a token every 1 / rate seconds
+    assert take(0, 0, 0, 0) == [0, 0, 0, 0.5]
+    assert take(0.25, 0.25) == [0.25, 0]
+    assert take(0) == [0.5]
+    # never more than the burst
+    assert take(100, 0, 0, 0) == [0, 0, 0, 0.5]
+    # every client has its own bucket
+    assert take(0, client="10.0.0.2") == [0]
+
+
+def test_memory_buckets(clock):
+    check_bucket(admission.MemoryBuckets(rate=2, burst=3), clock)
+
+
+def test_memory_buckets_max_clients(clock):
+    buckets = admission.MemoryBuckets(rate=1, burst=1, max_clients=2)
+    for client in ("a", "b", "c"):
+        buckets.take(client)
+    assert len(buckets) == 2
+    # the oldest one was forgotten, with a full bucket
+    assert buckets.take("a") == 0
+    assert buckets.take("c") == 1
+
+
+def test_redis_buckets(clock):
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeRedis()
+    buckets = admission.RedisBuckets(client, rate=2, burst=3)
+    check_bucket(buckets, clock)
+    assert 0 < client.ttl("admission:10.0.0.1") <= 3
+
+
+class App:
+    """
+    answers once released, in chunks, keeping the requests in flight of limits at each one
+    """
+
+    def __init__(self, limits, chunks=1):
+        self.limits = limits
+        self.chunks = chunks
+        self.release = asyncio.Event()
+        self.release.set()
+        self.in_flight = []
+
+    async def __call__(self, scope, receive, send):
+        await self.release.wait()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        for chunk in range(self.chunks):
+            self.in_flight.append(self.limits.in_flight)
+            await send({"type": "http.response.body", "body": b"x", "more_body": chunk < self.chunks - 1})
+
+
+async def call(middleware, path="/tests/", client="10.0.0.1"):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await middleware({"type": "http", "method": "GET", "path": path, "headers": [], "client": (client, 5000)},
+                     receive, send)
+    return messages[0]["status"], dict(messages[0]["headers"])
+
+
+def test_rate_limited(clock):
+    limits = admission.Admission(admission.MemoryBuckets(rate=0.1, burst=1), max_concurrency=0)
+    middleware = admission.AdmissionMiddleware(App(limits), limits)
+
+    async def run():
+        return [await call(middleware) for _ in range(2)] + [await call(middleware, client="10.0.0.2")]
+
+    (first, _), (second, headers), (other, _) = asyncio.run(run())
+    assert (first, second, other) == (200, 429, 200)
+    assert headers[b"retry-after"] == b"10"
+    assert limits.stats()["rate_limited"] == 1
+
+
+def test_shed_at_max_concurrency():
+    limits = admission.Admission(None, max_concurrency=1)
+    app = App(limits)
+    middleware = admission.AdmissionMiddleware(app, limits)
+
+    async def run():
+        app.release.clear()
+        first = asyncio.ensure_future(call(middleware))
+        await asyncio.sleep(0.01)
+        second = await call(middleware)
+        app.release.set()
+        return await first, second, await call(middleware)
+
+    (first, _), (second, headers), (third, _) = asyncio.run(run())
+    assert (first, second, third) == (200, 503, 200)
+    assert headers[b"retry-after"] == b"%d" % admission.ADMISSION_RETRY_AFTER_SECONDS
+    assert limits.stats()["shed"] == 1 and limits.in_flight == 0
+
+
+def test_exempt_paths(clock):
+    limits = admission.Admission(admission.MemoryBuckets(rate=0.1, burst=1), max_concurrency=1)
+    app = App(limits)
+    middleware = admission.AdmissionMiddleware(app, limits)
+
+    async def run():
+        app.release.clear()
+        running = asyncio.ensure_future(call(middleware))
+        await asyncio.sleep(0.01)
+        app.release.set()
+        statuses = [(await call(middleware, path))[0] for path in sorted(admission.EXEMPT_PATHS) * 2]
+        await running
+        return statuses
+
+    assert asyncio.run(run()) == [200] * 6
+    assert limits.rate_limited == limits.shed == 0
+
+
+def test_released_when_streamed_response_ends():
+    limits = admission.Admission(None, max_concurrency=1)
+    app = App(limits, chunks=3)
+    middleware = admission.AdmissionMiddleware(app, limits)
+    assert asyncio.run(call(middleware))[0] == 200
+    assert app.in_flight == [1, 1, 1] and limits.in_flight == 0
+
+
+def test_released_on_error():
+    limits = admission.Admission(None, max_concurrency=1)
+
+    async def failing(scope, receive, send):
+        raise RuntimeError("failed")
+
+    middleware = admission.AdmissionMiddleware(failing, limits)
+    with pytest.raises(RuntimeError):
+        asyncio.run(call(middleware))
+    assert limits.in_flight == 0
+
+
+def test_app(clock, monkeypatch):
+    monkeypatch.setattr(admission.admission, "buckets", admission.MemoryBuckets(rate=0.5, burst=1))
+    monkeypatch.setattr(admission.admission, "rate_limited", 0)
+    client = TestClient(main.app)
+    # answered without the database
+    assert client.get("/tests/history", params={"cursor": "bad"}).status_code == 400
+    response = client.get("/tests/history", params={"cursor": "bad"})
+    assert response.status_code == 429 and response.headers["retry-after"] == "2"
+    assert client.get("/health").status_code == 200
@@ -0,0 +1,151 @@
+"""
+bulk_import.import_lines reports the lines it can not read without aborting the
+import, and iter_lines splits the request body in bounded lines:
+    python -m pytest test_bulk_import.py
+"""
+import asyncio
+import io
+import json
+import os
+
+import pytest
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URL', 'postgresql://localhost/wifi')
+
+import bulk_import  # noqa: E402
+import models  # noqa: E402
+
+PROTOCOL_LINE = json.dumps({"type": "protocol_tests", "public_ip": "200.1.2.3",
+                            "test": [{"protocol_name": "WPA2"}, {"protocol_name": "WPA3"}]}).encode()
+WEB_LINE = json.dumps({
+    "type": "web_tests_ooni", "public_ip": "2001:db8::1", "timestamp": "2020-01-02T03:04:05+00:00",
+    "test": {"report_id": "r", "url": "https://example.com", "resolver_asn": "AS1", "resolver_ip": "8.8.8.8",
+             "resolver_network_name": "n", "client_resolver": "8.8.4.4", "accessible": True},
+    "tcp_connect": [{"ip": "93.184.216.34", "port": 443, "status_success": True},
+                    {"ip": "93.184.216.35", "port": 80, "status_success": False, "status_blocked": True}],
+}).encode()
+
+
+@pytest.fixture
+def chunks(monkeypatch):
+    """
+    the chunks given to insert_chunk, which imports them without a database
+    """
+    inserted = []
+
+    def insert_chunk(db, chunk, report):
+        inserted.append([line_number for line_number, _ in chunk])
+        report.imported += len(chunk)
+
+    monkeypatch.setattr(bulk_import, "insert_chunk", insert_chunk)
+    return inserted
+
+
+def test_invalid_utf8_line(chunks):
+    lines = [PROTOCOL_LINE, b"\xff\xfe bad", PROTOCOL_LINE]
+    report = bulk_import.import_lines(None, lines)
+    assert (report.lines, report.imported, report.failed) == (3, 2, 1)
+    assert [error["line"] for error in report.errors] == [2]
+
+
+def test_mixed_lines(chunks):
+    lines = [
+        PROTOCOL_LINE,
+        b"",
+        b"not json",
+        json.dumps({"type": "unknown_tests", "public_ip": "200.1.2.3", "test": {}}).encode(),
+        json.dumps({"type": "protocol_tests", "public_ip": "not an ip", "test": []}).encode(),
+        json.dumps({"type": "dns_tests", "public_ip": "200.1.2.3", "test": {"do_flag": "maybe"}}).encode(),
+        b"   ",
+        WEB_LINE,
+    ]
+    report = bulk_import.import_lines(None, lines, chunk_size=2)
+    assert (report.lines, report.imported, report.failed) == (6, 2, 4)
+    assert [error["line"] for error in report.errors] == [3, 4, 5, 6]
+    assert "unknown test type" in report.errors[1]["error"]
+    assert report.errors[2]["error"][0]["loc"] == ("public_ip",)
+    assert chunks == [[1, 8]]
+
+
+def test_max_errors(chunks, monkeypatch):
+    monkeypatch.setattr(bulk_import, "IMPORT_MAX_ERRORS", 2)
+    report = bulk_import.import_lines(None, [b"bad"] * 5)
+    assert report.failed == 5 and len(report.errors) == 2
+
+
+def test_chunks(chunks):
+    report = bulk_import.import_lines(None, [PROTOCOL_LINE] * 5, chunk_size=2)
+    assert chunks == [[1, 2], [3, 4], [5]]
+    assert report.dict()["imported"] == 5
+
+
+def test_parse_protocol_line():
+    submission = bulk_import.parse_line(PROTOCOL_LINE)
+    assert (submission.ip, submission.model_test, submission.tcp_connect, submission.timestamp) == \
+           ("200.1.2.3", models.ProtocolTest, None, None)
+    assert [test.protocol_name for test in submission.tests] == ["WPA2", "WPA3"]
+
+
+def test_parse_web_line():
+    submission = bulk_import.parse_line(WEB_LINE)
+    assert (submission.ip, submission.model_test) == ("2001:db8::1", models.WebTestOoni)
+    assert submission.timestamp.isoformat() == "2020-01-02T03:04:05+00:00"
+    assert len(submission.tests) == 1 and submission.tests[0].accessible
+    # one list of tcp_connect per test
+    [tcp_connect] = submission.tcp_connect
+    assert [(str(entry.ip), entry.port, entry.status_success) for entry in tcp_connect] == \
+           [("93.184.216.34", 443, True), ("93.184.216.35", 80, False)]
+
+
+def test_tcp_connect_only_for_web_tests():
+    line = json.dumps({"type": "ndt_tests_ooni", "public_ip": "200.1.2.3",
+                       "test": {"report_id": "r", "download": 1.5, "upload": 0.5},
+                       "tcp_connect": [{"status_success": True}]})
+    assert bulk_import.parse_line(line).tcp_connect is None
+
+
+async def stream(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def iter_lines(*chunks, max_bytes=bulk_import.IMPORT_MAX_LINE_BYTES):
+    async def read():
+        return [line async for line in bulk_import.iter_lines(stream(*chunks), max_bytes)]
+    return asyncio.run(read())
+
+
+def test_lines_split_across_chunks():
+    body = b"\n".join([PROTOCOL_LINE, WEB_LINE, PROTOCOL_LINE])
+    for size in (1, 2, 7, 64, len(body)):
+        chunks = [body[start:start + size] for start in range(0, len(body), size)]
+        assert iter_lines(*chunks) == [PROTOCOL_LINE, WEB_LINE, PROTOCOL_LINE]
+
+
+def test_lines_at_chunk_boundaries():
+    assert iter_lines(b"a\n", b"\nb", b"", b"c\n", b"d") == [b"a", b"", b"bc", b"d"]
+    assert iter_lines(b"a\n") == [b"a"]
+    assert iter_lines() == []
+
+
+def test_lines_too_long():
+    lines = iter_lines(b"12345\n123", b"456", b"78\n1234", b"5\n", b"123456", max_bytes=5)
+    assert lines[0] == b"12345" and lines[2] == b"12345"
+    assert [type(line) for line in lines] == [bytes, bulk_import.LineTooLong, bytes, bulk_import.LineTooLong]
+
+
+def test_line_too_long_kept_out_of_memory():
+    splitter = bulk_import.LineSplitter(max_bytes=10)
+    assert [type(line) for line in splitter.feed(b"x" * 11)] == [bulk_import.LineTooLong]
+    for _ in range(100):
+        assert splitter.feed(b"x" * 100) == []
+        assert len(splitter._buffer) <= 100
+    assert splitter.feed(b"x\nok\n") == [b"ok"]
+    assert splitter.end() == []
+
+
+def test_import_line_too_long(chunks):
+    report = bulk_import.import_lines(None, bulk_import.read_lines(
+        io.BytesIO(b"\n".join([PROTOCOL_LINE, b"[" * 1000, PROTOCOL_LINE])), max_bytes=len(PROTOCOL_LINE)))
+    assert (report.lines, report.imported, report.failed) == (3, 2, 1)
+    assert report.errors == [{"line": 2, "error": "line longer than %d bytes" % len(PROTOCOL_LINE)}]
@@ -0,0 +1,153 @@
+"""
+compression: the negotiation of Accept-Encoding, the ETags with the suffix of
+their encoding matched by if_none_match, and CompressionMiddleware compressing
+whole and streamed responses (with brotli when it is installed):
+    python -m pytest test_compression.py
+"""
+import asyncio
+import os
+import zlib
+
+import pytest
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URL', 'postgresql://localhost/wifi')
+
+import compression  # noqa: E402
+
+BODY = b'{"test": "%s"}' % (b"x" * 2000)
+
+
+@pytest.fixture
+def with_brotli(monkeypatch):
+    # negotiate and if_none_match only look at the names of the encoders
+    monkeypatch.setattr(compression, "ENCODERS", {"br": None, "gzip": compression.GzipEncoder})
+
+
+@pytest.mark.parametrize("accept_encoding, encoding", [
+    ("", None), ("identity", None), ("deflate", None), ("gzip", "gzip"), ("GZip", "gzip"),
+    ("gzip;q=0", None), ("gzip; q=0.1", "gzip"), ("gzip;q=bad", None), ("*", "gzip"), ("*;q=0", None),
+    ("*, gzip;q=0", None), ("deflate, gzip;q=0.5", "gzip"), ("br", None),
+])
+def test_negotiate(accept_encoding, encoding):
+    assert compression.negotiate(accept_encoding) == encoding
+
+
+@pytest.mark.parametrize("accept_encoding, encoding", [
+    ("gzip, br", "br"), ("gzip, deflate, br", "br"), ("br;q=0.5, gzip", "gzip"), ("br;q=0, gzip;q=0.1", "gzip"),
+    ("*", "br"), ("*;q=0.5, gzip", "gzip"), ("br", "br"), ("deflate", None),
+])
+def test_negotiate_with_brotli(with_brotli, accept_encoding, encoding):
+    assert compression.negotiate(accept_encoding) == encoding
+
+
+def test_etag():
+    tag = compression.etag("basic_tests", 3, "row:7")
+    assert tag.startswith('"') and tag.endswith('"') and len(tag) == 26
+    assert compression.etag("basic_tests", 3, "row:7") == tag
+    assert compression.etag("basic_tests", 3, "row:8") != tag
+    # the parts are separated
+    assert compression.etag("a", "bc") != compression.etag("ab", "c")
+
+
+CURRENT = compression.etag("basic_tests", 3, "row:7")
+OTHER = compression.etag("basic_tests", 3, "row:6")
+
+
+@pytest.mark.parametrize("header, matched", [
+    (None, None), ("", None), (OTHER, None), (CURRENT, CURRENT), ("W/" + CURRENT, "W/" + CURRENT),
+    (CURRENT[:-1] + '-gzip"', CURRENT[:-1] + '-gzip"'), ("W/" + CURRENT[:-1] + '-gzip"', "W/" + CURRENT[:-1] + '-gzip"'),
+    (OTHER[:-1] + '-gzip"', None), (CURRENT[:-1] + '-deflate"', None), (CURRENT[:-1] + '-br"', None),
+    ("%s, %s" % (OTHER, CURRENT), CURRENT), ("%s,%s-gzip\"" % (OTHER, CURRENT[:-1]), CURRENT[:-1] + '-gzip"'),
+    ("*", CURRENT), (CURRENT[1:-1], None),
+])
+def test_if_none_match(header, matched):
+    assert compression.if_none_match(header, CURRENT) == matched
+
+
+def test_if_none_match_with_brotli(with_brotli):
+    assert compression.if_none_match(CURRENT[:-1] + '-br"', CURRENT) == CURRENT[:-1] + '-br"'
+
+
+class App:
+
+    def __init__(self, chunks, headers):
+        self.chunks = chunks
+        self.headers = headers
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": self.headers})
+        for i, chunk in enumerate(self.chunks):
+            await send({"type": "http.response.body", "body": chunk, "more_body": i < len(self.chunks) - 1})
+
+
+def json_headers(body=None, tag=None):
+    headers = [(b"content-type", b"application/json")]
+    if body is not None:
+        headers.append((b"content-length", b"%d" % len(body)))
+    if tag is not None:
+        headers.append((b"etag", tag.encode()))
+    return headers
+
+
+def call(app, accept_encoding="gzip", minimum_size=1024):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    headers = [(b"accept-encoding", accept_encoding.encode())] if accept_encoding is not None else []
+    asyncio.run(compression.CompressionMiddleware(app, minimum_size)(
+        {"type": "http", "method": "GET", "path": "/tests/", "headers": headers}, receive, send))
+    start = messages[0]
+    return {name.decode(): value.decode() for name, value in start["headers"]}, [message["body"] for message in messages[1:]]
+
+
+def test_compressed():
+    headers, chunks = call(App([BODY], json_headers(BODY, CURRENT)))
+    body = b"".join(chunks)
+    assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == BODY
+    assert headers["content-encoding"] == "gzip" and headers["vary"] == "Accept-Encoding"
+    assert headers["content-length"] == str(len(body)) and len(body) < len(BODY)
+    assert headers["etag"] == CURRENT[:-1] + '-gzip"'
+    # the tag sent back by the client matches the uncompressed one
+    assert compression.if_none_match(headers["etag"], CURRENT) == headers["etag"]
+
+
+def test_weak_etag_kept():
+    assert call(App([BODY], json_headers(BODY, "W/" + CURRENT)))[0]["etag"] == "W/" + CURRENT
+
+
+@pytest.mark.parametrize("accept_encoding, minimum_size, headers, body", [
+    (None, 1024, json_headers(BODY), BODY),
+    ("identity", 1024, json_headers(BODY), BODY),
+    ("gzip", 1024, json_headers(b"{}"), b"{}"),
+    ("gzip", -1, json_headers(BODY), BODY),
+    ("gzip", 1024, [(b"content-type", b"image/png")], BODY),
+    ("gzip", 1024, json_headers(BODY) + [(b"content-encoding", b"br")], BODY),
+])
+def test_not_compressed(accept_encoding, minimum_size, headers, body):
+    sent_headers, chunks = call(App([body], headers), accept_encoding, minimum_size)
+    assert chunks == [body]
+    assert sent_headers == {name.decode(): value.decode() for name, value in headers}
+
+
+def test_streamed():
+    chunks = [b'{"items":[', b'{"id":1}', b',{"id":2}', b'],"next_cursor":null}']
+    headers, sent = call(App(chunks, json_headers()))
+    assert headers["content-encoding"] == "gzip" and "content-length" not in headers
+    # every chunk is flushed, so it can be decoded before the next one is sent
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert [decoder.decompress(chunk) for chunk in sent] == chunks
+    assert decoder.eof
+
+
+def test_streamed_brotli():
+    brotli = pytest.importorskip("brotli")
+    chunks = [b'{"items":[', b'{"id":1}', b'],"next_cursor":null}']
+    headers, sent = call(App(chunks, json_headers()), "gzip, br")
+    assert headers["content-encoding"] == "br"
+    decoder = brotli.Decompressor()
+    assert [decoder.process(chunk) for chunk in sent] == chunks
@@ -0,0 +1,107 @@
+"""
+history: the keyset cursors, the 400 of GET /tests/history on a bad one, and the
+pages streamed from the rows of the tests, with the database calls replaced:
+    python -m pytest test_history.py
+"""
+from datetime import datetime, timedelta, timezone
+import base64
+import json
+import os
+
+import pytest
+from starlette.testclient import TestClient
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URL', 'postgresql://localhost/wifi')
+
+import history  # noqa: E402
+import main  # noqa: E402
+import models  # noqa: E402
+
+NOW = datetime(2021, 3, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+
+
+def b64(content):
+    return base64.urlsafe_b64encode(content).decode()
+
+
+@pytest.mark.parametrize("timestamp", [NOW, NOW.replace(tzinfo=None), NOW.astimezone(timezone(timedelta(hours=-3)))])
+def test_cursor_round_trip(timestamp):
+    cursor = history.encode_cursor(timestamp, 42)
+    assert history.decode_cursor(cursor) == (timestamp, 42)
+    # usable in a query string as is
+    assert set(cursor) <= set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_=")
+
+
+@pytest.mark.parametrize("cursor", [
+    "bad", "", "é", b64(b"not json"), b64(b"{}"), b64(b"[]"), b64(b'["2021-03-01T00:00:00"]'),
+    b64(b'["2021-03-01T00:00:00", 1, 2]'), b64(b'["yesterday", 1]'), b64(b'[1, 1]'),
+    b64(b'["2021-03-01T00:00:00", "one"]'), b64(b'["2021-03-01T00:00:00", null]'), b64(b"\xff\xfe"),
+])
+def test_bad_cursor(cursor):
+    with pytest.raises(ValueError):
+        history.decode_cursor(cursor)
+
+
+class Db:
+    def __init__(self):
+        self.rolled_back = False
+
+    def rollback(self):
+        self.rolled_back = True
+
+
+def items(count):
+    return [{"id": count - i, "type": "dns_tests", "timestamp": NOW - timedelta(minutes=i), "test": {}}
+            for i in range(count)]
+
+
+def streamed(monkeypatch, results, limit):
+    monkeypatch.setattr(history, "iter_items", lambda db, ip, type_test, since, until, position, limit: iter(results))
+    db = Db()
+    content = json.loads(b"".join(history.stream(db, "10.0.0.1", limit=limit)))
+    assert db.rolled_back
+    return content
+
+
+def test_stream_full_page(monkeypatch):
+    content = streamed(monkeypatch, items(3), 3)
+    assert [result["id"] for result in content["items"]] == [3, 2, 1]
+    # the position of the last test of the page
+    assert history.decode_cursor(content["next_cursor"]) == (NOW - timedelta(minutes=2), 1)
+
+
+@pytest.mark.parametrize("count", [0, 2])
+def test_stream_last_page(monkeypatch, count):
+    content = streamed(monkeypatch, items(count), 3)
+    assert len(content["items"]) == count and content["next_cursor"] is None
+
+
+def test_stream_limit_bounded(monkeypatch):
+    limits = []
+    monkeypatch.setattr(history, "iter_items",
+                        lambda db, ip, type_test, since, until, position, limit: limits.append(limit) or iter(()))
+    for limit in (0, -5, history.HISTORY_MAX_PAGE_SIZE + 1):
+        b"".join(history.stream(Db(), "10.0.0.1", limit=limit))
+    assert limits == [1, 1, history.HISTORY_MAX_PAGE_SIZE]
+
+
+def test_iter_items_groups_the_rows_of_a_test(monkeypatch):
+    earlier = NOW - timedelta(hours=1)
+    tests = [(3, NOW, 7), (2, NOW, 7), (1, earlier, None)]
+    rows = {
+        models.ProtocolTest: [("p3a", 3, NOW, 7), ("p3b", 3, NOW, 7), ("p1", 1, earlier, None)],
+        models.DnsTest: [("d2", 2, NOW, 7)],
+    }
+    monkeypatch.setattr(history, "page", lambda db, ip, model_tests, *args: tests)
+    monkeypatch.setattr(history, "tagged_rows",
+                        lambda db, model_test, tests: ((model_test, row) for row in rows[model_test]))
+    monkeypatch.setattr(history, "item", lambda db, model_test, rows: (model_test, [row[0] for row in rows]))
+    assert list(history.iter_items(None, "10.0.0.1", models.TestsName.basic_tests)) == [
+        (models.ProtocolTest, ["p3a", "p3b"]), (models.DnsTest, ["d2"]), (models.ProtocolTest, ["p1"])]
+
+
+def test_app_bad_cursor(monkeypatch):
+    monkeypatch.setattr(history, "stream", lambda *args: pytest.fail("streamed a bad cursor"))
+    response = TestClient(main.app).get("/tests/history", params={"cursor": "bad"})
+    assert response.status_code == 400 and response.json() == {"message": "Invalid cursor"}
+
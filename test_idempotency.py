@@ -0,0 +1,235 @@
+"""
+idempotency.IdempotencyMiddleware: replayed submissions, keys reused with
+another body, concurrent retries, eviction and the scope of the keys, through
+the app with its database calls counted instead of made, and through a bare app:
+    python -m pytest test_idempotency.py
+"""
+import asyncio
+import json
+import os
+import types
+
+import pytest
+from starlette.testclient import TestClient
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URL', 'postgresql://localhost/wifi')
+
+import async_queries  # noqa: E402
+import idempotency  # noqa: E402
+import main  # noqa: E402
+import response_cache  # noqa: E402
+
+DEVICES_BODY = {"test": [{"mac": "aa:bb:cc:d1:22:33", "private_ip": "192.168.1.10"},
+                         {"mac": "aa:bb:cc:d1:22:34", "mask": 28, "private_ip": "192.168.1.11"}]}
+DNS_BODY = {"dns_test": {"dns1_android": "8.8.8.8"}}
+
+
+@pytest.fixture
+def api(monkeypatch):
+    calls = {"inserted": 0, "manufs": 0}
+
+    async def insert_submissions(db, submissions, batch_size=None):
+        calls["inserted"] += len(submissions)
+
+    async def get_manufs(db, devices_tests):
+        calls["manufs"] += 1
+        return [{"mac": test.mac, "mask": test.mask, "manuf": "Manuf %d" % calls["manufs"]} for test in devices_tests]
+
+    monkeypatch.setattr(async_queries, "insert_submissions", insert_submissions)
+    monkeypatch.setattr(async_queries, "get_manufs", get_manufs)
+    monkeypatch.setattr(idempotency.cache, "backend", response_cache.MemoryBackend(ttl=60))
+    monkeypatch.setattr(idempotency.cache, "replays", 0)
+    monkeypatch.setattr(idempotency.cache, "conflicts", 0)
+    return TestClient(main.app), calls
+
+
+def test_devices_replayed(api):
+    client, calls = api
+    first = client.post("/tests/devices", json=DEVICES_BODY, headers={"Idempotency-Key": "k1"})
+    second = client.post("/tests/devices", json=DEVICES_BODY, headers={"Idempotency-Key": "k1"})
+    assert first.status_code == second.status_code == 201
+    assert second.json() == first.json() == [
+        {"mac": "aa:bb:cc:d1:22:33", "mask": 24, "manuf": "Manuf 1"},
+        {"mac": "aa:bb:cc:d1:22:34", "mask": 28, "manuf": "Manuf 1"}]
+    assert "idempotent-replayed" not in first.headers
+    assert second.headers["idempotent-replayed"] == "true"
+    assert second.headers["content-type"] == first.headers["content-type"]
+    assert (calls["inserted"], calls["manufs"]) == (1, 1)
+    assert idempotency.cache.stats()["replays"] == 1
+
+
+def test_key_reused_with_another_body(api):
+    client, calls = api
+    assert client.post("/tests/dns", json=DNS_BODY, headers={"Idempotency-Key": "k1"}).status_code == 201
+    response = client.post("/tests/dns", json={"dns_test": {"dns1_android": "1.1.1.1"}},
+                           headers={"Idempotency-Key": "k1"})
+    assert response.status_code == 422
+    assert calls["inserted"] == 1
+    assert idempotency.cache.stats()["conflicts"] == 1
+
+
+def test_without_key(api):
+    client, calls = api
+    client.post("/tests/dns", json=DNS_BODY)
+    client.post("/tests/dns", json=DNS_BODY)
+    assert calls["inserted"] == 2
+
+
+def test_key_scoped_to_the_path(api):
+    client, calls = api
+    client.post("/tests/dns", json=DNS_BODY, headers={"Idempotency-Key": "k1"})
+    response = client.post("/tests/protocol", json={"test": [{"protocol_name": "WPA2"}]},
+                           headers={"Idempotency-Key": "k1"})
+    assert response.status_code == 201 and "idempotent-replayed" not in response.headers
+    assert calls["inserted"] == 2
+
+
+def scope(path="/tests/dns", key=None, client=("10.0.0.1", 5000), method="POST"):
+    headers = [(b"content-type", b"application/json")]
+    if key is not None:
+        headers.append((idempotency.KEY_HEADER, key))
+    return {"type": "http", "method": method, "path": path, "headers": headers, "client": client}
+
+
+def test_request_key_scope():
+    body = b"{}"
+    key, digest, ttl = idempotency.request_key(scope(key=b"k1"), body)
+    assert key.startswith("idempotency:key:10.0.0.1:/tests/dns:") and ttl is None
+    assert idempotency.request_key(scope(key=b"k1"), b"{ }")[0] == key
+    assert idempotency.request_key(scope(key=b"k1"), b"{ }")[1] != digest
+    assert idempotency.request_key(scope(key=b"k2"), body)[0] != key
+    assert idempotency.request_key(scope(key=b"k1", client=("10.0.0.2", 5000)), body)[0] != key
+    assert idempotency.request_key(scope(key=b"k1", path="/tests/ooni/ndt"), body)[0] != key
+    # only the ip of the client
+    assert idempotency.request_key(scope(key=b"k1", client=("10.0.0.1", 6000)), body)[0] == key
+
+
+def test_request_key_fingerprint(monkeypatch):
+    assert idempotency.request_key(scope(), b"{}")[0] is None
+    monkeypatch.setattr(idempotency, "IDEMPOTENCY_FINGERPRINT_SECONDS", 5)
+    key, _, ttl = idempotency.request_key(scope(), b"{}")
+    assert key.startswith("idempotency:body:10.0.0.1:/tests/dns:") and ttl == 5
+
+
+class App:
+    """
+    answers the number of the call with the status when it was called, once released
+    """
+
+    def __init__(self, status=201):
+        self.calls = 0
+        self.status = status
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def __call__(self, scope, receive, send):
+        self.calls += 1
+        call, status = self.calls, self.status
+        message = await receive()
+        await self.release.wait()
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": json.dumps({"call": call, "body": message["body"].decode()}).encode()})
+
+
+async def call(middleware, body=b"{}", **options):
+    messages = []
+    received = []
+
+    async def receive():
+        if received:
+            return {"type": "http.disconnect"}
+        received.append(body)
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await middleware(scope(**options), receive, send)
+    start, body = messages[0], b"".join(message.get("body", b"") for message in messages[1:])
+    return start["status"], dict(start["headers"]), json.loads(body)
+
+
+def middleware(app, backend=None):
+    submissions = idempotency.SubmissionCache(response_cache.MemoryBackend(ttl=60) if backend is None else backend)
+    return idempotency.IdempotencyMiddleware(app, submissions), submissions
+
+
+def test_concurrent_retries_wait():
+    async def run():
+        app = App()
+        app.release.clear()
+        dedup, submissions = middleware(app)
+        calls = [asyncio.ensure_future(call(dedup, key=b"k1")) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        assert app.calls == 1 and len(submissions.in_progress) == 1
+        app.release.set()
+        return await asyncio.gather(*calls), app, submissions
+
+    results, app, submissions = asyncio.run(run())
+    assert app.calls == 1 and not submissions.in_progress
+    assert [content for _, _, content in results] == [{"call": 1, "body": "{}"}] * 3
+    assert [headers.get(b"idempotent-replayed") for _, headers, _ in results] == [None, b"true", b"true"]
+
+
+def test_failed_submission_not_kept():
+    async def run():
+        app = App(status=500)
+        dedup, submissions = middleware(app)
+        first = await call(dedup, key=b"k1")
+        app.status = 201
+        second = await call(dedup, key=b"k1")
+        third = await call(dedup, key=b"k1")
+        return first, second, third, app
+
+    first, second, third, app = asyncio.run(run())
+    assert (first[0], second[0], third[0]) == (500, 201, 201)
+    assert app.calls == 2 and third[2] == {"call": 2, "body": "{}"}
+
+
+def test_waiting_retry_runs_when_the_first_fails():
+    async def run():
+        app = App(status=500)
+        app.release.clear()
+        dedup, _ = middleware(app)
+        first = asyncio.ensure_future(call(dedup, key=b"k1"))
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(call(dedup, key=b"k1"))
+        await asyncio.sleep(0.01)
+        app.status = 201
+        app.release.set()
+        return await first, await second, app
+
+    first, second, app = asyncio.run(run())
+    assert (first[0], second[0], app.calls) == (500, 201, 2)
+
+
+def test_expired_and_evicted(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(response_cache, "time", types.SimpleNamespace(monotonic=lambda: clock.now))
+
+    async def run():
+        app = App()
+        dedup, _ = middleware(app, response_cache.MemoryBackend(ttl=10, max_entries=1))
+        await call(dedup, key=b"k1")
+        await call(dedup, key=b"k1")
+        clock.now += 11
+        await call(dedup, key=b"k1")
+        # k2 evicts k1
+        await call(dedup, key=b"k2")
+        await call(dedup, key=b"k1")
+        return app
+
+    assert asyncio.run(run()).calls == 4
+
+
+def test_other_requests_pass_through():
+    async def run():
+        app = App()
+        dedup, submissions = middleware(app)
+        await call(dedup, key=b"k1", method="PUT")
+        await call(dedup, key=b"k1", path="/tests/import")
+        return app, submissions
+
+    app, submissions = asyncio.run(run())
+    assert app.calls == 2 and submissions.stored == 0
@@ -0,0 +1,114 @@
+"""
+lookups.PrefixTable against a brute force longest prefix match, for ipv4 and
+ipv6 with and without prefixes longer than /64, and AsnIndex.lookup:
+    python -m pytest test_lookups.py
+"""
+import ipaddress
+import os
+import random
+
+import pytest
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URL', 'postgresql://localhost/wifi')
+
+import lookups  # noqa: E402
+
+
+def prefixes_of(networks):
+    return [(int(network.network_address), int(network.broadcast_address), asn_id)
+            for network, asn_id in ((ipaddress.ip_network(subnet), asn_id) for subnet, asn_id in networks)]
+
+
+def longest_match(networks, address):
+    matches = [(ipaddress.ip_network(subnet).prefixlen, asn_id) for subnet, asn_id in networks
+               if address in ipaddress.ip_network(subnet)]
+    return max(matches)[1] if matches else lookups.NO_ASN
+
+
+def table(networks, max_bits):
+    return lookups.PrefixTable(prefixes_of(networks), max_bits)
+
+
+V4 = [("10.0.0.0/8", 1), ("10.1.0.0/16", 2), ("10.1.2.0/24", 3), ("10.1.2.128/25", 4),
+      ("10.2.0.0/16", 5), ("192.168.0.0/16", 6), ("255.255.255.0/24", 7), ("0.0.0.0/32", 8)]
+
+
+@pytest.mark.parametrize("address, asn_id", [
+    ("10.0.0.1", 1), ("10.1.0.1", 2), ("10.1.2.1", 3), ("10.1.2.127", 3), ("10.1.2.128", 4), ("10.1.2.255", 4),
+    ("10.1.3.0", 2), ("10.1.255.255", 2), ("10.2.0.0", 5), ("10.3.0.0", 1), ("10.255.255.255", 1),
+    ("11.0.0.0", lookups.NO_ASN), ("9.255.255.255", lookups.NO_ASN), ("192.168.1.1", 6),
+    ("255.255.255.255", 7), ("0.0.0.0", 8), ("0.0.0.1", lookups.NO_ASN),
+])
+def test_ipv4(address, asn_id):
+    assert table(V4, 32).lookup(int(ipaddress.ip_address(address))) == asn_id
+
+
+def test_empty():
+    assert table([], 32).lookup(0) == lookups.NO_ASN
+    assert table([], 128).lookup(1) == lookups.NO_ASN
+
+
+def test_same_asn_nested_merged():
+    merged = table([("10.0.0.0/8", 1), ("10.1.0.0/16", 1), ("10.2.0.0/16", 2)], 32)
+    assert len(merged) == 4
+    assert merged.lookup(int(ipaddress.ip_address("10.1.0.1"))) == 1
+
+
+V6 = [("2001:db8::/32", 10), ("2001:db8:1::/48", 11), ("2001:db8:1:2::/64", 12), ("2800::/12", 13),
+      ("ffff:ffff:ffff:ffff::/64", 14)]
+
+
+@pytest.mark.parametrize("networks, shift", [
+    (V6, 64),
+    (V6 + [("2001:db8:1:2::100/120", 15), ("2001:db8:1:2::1/128", 16)], 0),
+])
+def test_ipv6(networks, shift):
+    prefixes = table(networks, 128)
+    assert prefixes.shift == shift
+    for address in ["2001:db8::1", "2001:db8:1::", "2001:db8:1:2::", "2001:db8:1:2::1", "2001:db8:1:2::150",
+                    "2001:db8:1:2::200", "2001:db8:1:3::", "2001:db8:ffff:ffff:ffff:ffff:ffff:ffff", "2001:db9::",
+                    "2800::", "280f:ffff::", "2810::", "::", "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff"]:
+        address = ipaddress.ip_address(address)
+        assert prefixes.lookup(int(address)) == longest_match(networks, address), address
+
+
+def random_networks(rng, version, count):
+    max_bits = 32 if version == 4 else 128
+    networks = set()
+    # nested in a few roots, so most prefixes overlap
+    roots = [rng.getrandbits(max_bits) for _ in range(3)]
+    while len(networks) < count:
+        length = rng.randint(8, max_bits)
+        address = (rng.choice(roots) ^ rng.getrandbits(max_bits - 8)) if rng.random() < 0.8 else rng.getrandbits(max_bits)
+        network = ipaddress.ip_network((address >> (max_bits - length) << (max_bits - length), length))
+        networks.add((str(network), rng.randint(1, 50)))
+    return sorted(networks), roots
+
+
+@pytest.mark.parametrize("version, seed", [(4, 1), (4, 2), (6, 3), (6, 4)])
+def test_random(version, seed):
+    rng = random.Random(seed)
+    max_bits = 32 if version == 4 else 128
+    networks, roots = random_networks(rng, version, 200)
+    prefixes = table(networks, max_bits)
+    addresses = [rng.getrandbits(max_bits) for _ in range(200)]
+    addresses += [root ^ rng.getrandbits(max_bits - 8) for root in roots for _ in range(200)]
+    # the bounds of every prefix and their neighbours
+    for subnet, _ in networks:
+        network = ipaddress.ip_network(subnet)
+        addresses += [int(network.network_address) - 1, int(network.network_address),
+                      int(network.broadcast_address), int(network.broadcast_address) + 1]
+    for address in addresses:
+        if 0 <= address < 1 << max_bits:
+            assert prefixes.lookup(address) == longest_match(networks, ipaddress.ip_address(address))
+
+
+def test_asn_index():
+    index = lookups.AsnIndex()
+    index.snapshot = {4: table(V4, 32), 6: table(V6, 128), "names": {1: "AS one", 12: "AS twelve", 3: "AS three"}}
+    assert (index.lookup("10.1.2.3").id, index.lookup("10.1.2.3").name) == (3, "AS three")
+    assert index.lookup("10.9.9.9").name == "AS one"
+    assert index.lookup("2001:db8:1:2::5").name == "AS twelve"
+    # no prefix, or an asn without a name
+    assert index.lookup("11.0.0.0") is None
+    assert index.lookup("10.1.0.1") is None
@@ -0,0 +1,288 @@
+"""
+reference_loader: the parsers of the CAIDA, AS names and Wireshark lines, the
+rows streamed to COPY, the reports of the files and the retries of the swap.
+The loads with their shadow swap against a PostgreSQL server, whose asns,
+latest_subnet_asns and macs_manuf tables they replace, are skipped unless given:
+    TEST_DATABASE_URL=postgresql://localhost/wifi_test python -m pytest test_reference_loader.py
+"""
+import bz2
+import gzip
+import os
+import types
+
+import pytest
+from sqlalchemy import create_engine, text
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URL', 'postgresql://localhost/wifi')
+
+import models  # noqa: E402
+import reference_loader  # noqa: E402
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+server = pytest.mark.skipif(not TEST_DATABASE_URL, reason="needs TEST_DATABASE_URL")
+
+
+@pytest.mark.parametrize("line, row", [
+    ("1.0.0.0\t24\t13335\n", (13335, "1.0.0.0/24")),
+    ("1.0.0.0 24 13335", (13335, "1.0.0.0/24")),
+    ("1.0.4.1\t22\t38803\n", (38803, "1.0.4.0/22")),
+    ("2001:db8::\t32\t64496\n", (64496, "2001:db8::/32")),
+    ("2001:db8:1::5\t48\t64496\n", (64496, "2001:db8:1::/48")),
+    ("1.0.0.0\t24\t13335_209242\n", (13335, "1.0.0.0/24")),
+    ("1.0.0.0\t24\t64496,64497\n", (64496, "1.0.0.0/24")),
+    ("1.0.0.0\t24\t2147483647\n", (2147483647, "1.0.0.0/24")),
+])
+def test_parse_prefix(line, row):
+    assert reference_loader.parse_prefix(line) == row
+
+
+@pytest.mark.parametrize("line", [
+    "1.0.0.0\t24\n", "1.0.0.0\t24\t13335\textra\n", "1.0.0.0\t33\t13335\n", "1.0.0\t24\t13335\n",
+    "1.0.0.0\t24\tAS13335\n", "1.0.0.0\t24\t0\n", "1.0.0.0\t24\t4200000000\n", "1.0.0.0\t24\t_13335\n",
+])
+def test_parse_prefix_invalid(line):
+    with pytest.raises(ValueError):
+        reference_loader.parse_prefix(line)
+
+
+@pytest.mark.parametrize("line, row", [
+    ("13335 CLOUDFLARENET, US\n", (13335, "CLOUDFLARENET, US")),
+    ("AS13335 CLOUDFLARENET, US\n", (13335, "CLOUDFLARENET, US")),
+    ("as64496  Documentation \n", (64496, "Documentation")),
+    ("64496\n", (64496, None)),
+])
+def test_parse_as_name(line, row):
+    assert reference_loader.parse_as_name(line) == row
+
+
+@pytest.mark.parametrize("line", ["ASX name\n", "0 reserved\n", "4200000000 private\n"])
+def test_parse_as_name_invalid(line):
+    with pytest.raises(ValueError):
+        reference_loader.parse_as_name(line)
+
+
+@pytest.mark.parametrize("line, row", [
+    ("00:00:0C\tCisco\tCisco Systems, Inc\n", ("00:00:0c:00:00:00", 24, "Cisco", "Cisco Systems, Inc")),
+    ("00:00:0C\tCisco\n", ("00:00:0c:00:00:00", 24, "Cisco", None)),
+    ("00-00-0C\tCisco\r\n", ("00:00:0c:00:00:00", 24, "Cisco", None)),
+    ("00:1B:C5:00:00:00/36\tConvergi\tConverging Systems Inc.\n",
+     ("00:1b:c5:00:00:00", 36, "Convergi", "Converging Systems Inc.")),
+    ("00:1B:C5:00:10/36\tIntellvi\n", ("00:1b:c5:00:10:00", 36, "Intellvi", None)),
+    ("FC:FE:C2\tInvensys # Invensys Controls UK Limited\n", ("fc:fe:c2:00:00:00", 24, "Invensys", "Invensys Controls UK Limited")),
+    ("FC:FE:C2\tInvensys\t# Invensys Controls UK Limited\n", ("fc:fe:c2:00:00:00", 24, "Invensys", "Invensys Controls UK Limited")),
+    ("FC:FE:C2\tInvensys\t\n", ("fc:fe:c2:00:00:00", 24, "Invensys", None)),
+    ("01:80:C2:00:00:00/48\tSpanning-tree\n", ("01:80:c2:00:00:00", 48, "Spanning-tree", None)),
+])
+def test_parse_manuf(line, row):
+    assert reference_loader.parse_manuf(line) == row
+
+
+@pytest.mark.parametrize("line", [
+    "00:00\n", "\tCisco\n", "00:00:0G\tCisco\n", "00:00:0C:00:00:00:00\tCisco\n", "000:00:0C\tCisco\n",
+    "00:00:0C/0\tCisco\n", "00:00:0C/49\tCisco\n", "00:00:0C/x\tCisco\n", "00:00:0C\t# only a comment\n",
+])
+def test_parse_manuf_invalid(line):
+    with pytest.raises(ValueError):
+        reference_loader.parse_manuf(line)
+
+
+def test_copy_stream():
+    rows = [(1, "a\tb"), (2, None), (3, "back\\slash\r\nnew line"), (4, "é")]
+    content = b"1\ta\\tb\n2\t\\N\n3\tback\\\\slash\\r\\nnew line\n4\t\xc3\xa9\n"
+    assert reference_loader.CopyStream(rows).read() == content
+    # in reads of the size asked, as copy_expert does
+    stream = reference_loader.CopyStream(rows)
+    chunks = list(iter(lambda: stream.read(5), b""))
+    assert b"".join(chunks) == content and {len(chunk) for chunk in chunks[:-1]} == {5}
+
+
+def test_parse_files(tmp_path):
+    plain = tmp_path / "prefixes.txt"
+    plain.write_bytes(b"# comment\n1.0.0.0\t24\t13335\n\nbad line\n2001:db8::\t32\t64496\n")
+    compressed = tmp_path / "prefixes.gz"
+    compressed_content = b"1.0.4.0\t22\t38803\n1.0.8.0\t21\t0\n"
+    compressed.write_bytes(gzip.compress(compressed_content))
+    bzipped = tmp_path / "prefixes.bz2"
+    bzipped_content = b"\xff\t24\t1\n1.0.16.0\t20\t64497_64498\n"
+    bzipped.write_bytes(bz2.compress(bzipped_content))
+    report = reference_loader.LoadReport("latest_subnet_asns")
+    rows = list(reference_loader.parse_files([str(plain), str(compressed), str(bzipped)],
+                                             reference_loader.parse_prefix, report))
+    assert rows == [(13335, "1.0.0.0/24"), (64496, "2001:db8::/32"), (38803, "1.0.4.0/22"), (64497, "1.0.16.0/20")]
+    assert (report.lines, report.rows, report.skipped) == (7, 4, 3)
+    assert [(error["file"], error["line"]) for error in report.errors] == \
+           [(str(plain), 4), (str(compressed), 2), (str(bzipped), 1)]
+    # of the lines read, not of the compressed files
+    assert report.bytes == len(plain.read_bytes()) + len(compressed_content) + len(bzipped_content)
+
+
+def test_errors_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(reference_loader, "REFERENCE_MAX_ERRORS", 2)
+    path = tmp_path / "manuf"
+    path.write_text("x\n" * 5)
+    report = reference_loader.LoadReport("macs_manuf")
+    assert list(reference_loader.parse_files([str(path)], reference_loader.parse_manuf, report)) == []
+    assert report.skipped == 5 and len(report.errors) == 2
+
+
+class Error(Exception):
+
+    def __init__(self, pgcode):
+        self.pgcode = pgcode
+
+
+class Cursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = connection.statements
+
+    def execute(self, statement, parameters=None):
+        self.statements.append(statement if parameters is None or statement == reference_loader.INDEXES
+                               else statement % parameters)
+        if statement.startswith("ALTER TABLE") and self.connection.failures:
+            raise Error(self.connection.failures.pop(0))
+
+    def fetchall(self):
+        return [("macs_manuf_pkey", "", "macs_manuf_pkey", "PRIMARY KEY (mac, mask)"),
+                ("macs_manuf_manuf", "CREATE INDEX macs_manuf_manuf ON public.macs_manuf USING btree (manuf)", None, None)]
+
+    def close(self):
+        pass
+
+
+class Connection:
+
+    def __init__(self, *failures):
+        self.failures = list(failures)
+        self.statements = []
+        self.commits = self.rollbacks = 0
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def test_swap_tables():
+    connection = Connection()
+    reference_loader.swap_tables(connection.cursor(), [models.MacManuf.__table__])
+    assert connection.statements == [
+        "SET LOCAL lock_timeout = 2s",
+        reference_loader.INDEXES,
+        "ALTER TABLE macs_manuf RENAME TO macs_manuf_replaced",
+        "ALTER INDEX macs_manuf_pkey RENAME TO macs_manuf_pkey_replaced",
+        "ALTER INDEX macs_manuf_manuf RENAME TO macs_manuf_manuf_replaced",
+        "ALTER TABLE macs_manuf_loading RENAME TO macs_manuf",
+        "ALTER INDEX macs_manuf_pkey_loading RENAME TO macs_manuf_pkey",
+        "ALTER INDEX macs_manuf_manuf_loading RENAME TO macs_manuf_manuf",
+        "DROP TABLE macs_manuf_replaced",
+    ]
+
+
+def test_build_indexes():
+    connection = Connection()
+    reference_loader.build_indexes(connection.cursor(), "macs_manuf_loading", models.MacManuf.__table__)
+    assert connection.statements[1:] == [
+        "ALTER TABLE macs_manuf_loading ADD CONSTRAINT macs_manuf_pkey_loading PRIMARY KEY (mac, mask)",
+        "CREATE INDEX macs_manuf_manuf_loading ON macs_manuf_loading USING btree (manuf)",
+        "ANALYZE macs_manuf_loading",
+    ]
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(reference_loader, "time", types.SimpleNamespace(sleep=sleeps.append))
+    return sleeps
+
+
+def test_swap_retried_while_locked(sleeps):
+    connection = Connection(reference_loader.LOCK_NOT_AVAILABLE, reference_loader.LOCK_NOT_AVAILABLE)
+    reference_loader.swap(connection, [models.MacManuf.__table__], retries=2)
+    assert (connection.rollbacks, connection.commits) == (2, 1)
+    assert sleeps == [0.1, 0.2]
+
+
+def test_swap_gives_up(sleeps):
+    connection = Connection(*[reference_loader.LOCK_NOT_AVAILABLE] * 3)
+    with pytest.raises(Error):
+        reference_loader.swap(connection, [models.MacManuf.__table__], retries=2)
+    assert (connection.rollbacks, connection.commits, len(sleeps)) == (3, 0, 2)
+
+
+def test_swap_other_errors_not_retried(sleeps):
+    connection = Connection("42P01")
+    with pytest.raises(Error):
+        reference_loader.swap(connection, [models.MacManuf.__table__])
+    assert (connection.rollbacks, sleeps) == (1, [])
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine(TEST_DATABASE_URL)
+    tables = [models.Asn.__table__, models.LatestSubnetAsns.__table__, models.MacManuf.__table__]
+    models.Base.metadata.create_all(engine, tables=tables)
+    yield engine
+    engine.dispose()
+
+
+def table_state(engine, table):
+    with engine.connect() as connection:
+        rows = connection.execute(text("SELECT * FROM %s ORDER BY 1, 2" % table)).fetchall()
+        constraints = {row[0] for row in connection.execute(text(
+            "SELECT conname FROM pg_constraint WHERE conrelid = CAST(:table AS regclass)"), {"table": table})}
+        leftovers = connection.execute(text(
+            "SELECT count(*) FROM pg_class WHERE relname LIKE :table || '\\_loading%' OR relname LIKE :table || '\\_replaced%'"),
+            {"table": table}).scalar()
+    return [tuple(map(str, row)) for row in rows], constraints, leftovers
+
+
+@server
+def test_load_and_swap(engine, tmp_path):
+    first = tmp_path / "first"
+    first.write_text("00:00:0C\tCisco\tCisco Systems, Inc\n00:00:0C\tDuplicate\nbad\n")
+    second = tmp_path / "second"
+    second.write_text("00:1B:C5:00:00:00/36\tConvergi\n")
+    source = [(models.MacManuf, reference_loader.parse_manuf, [str(first)])]
+    report, = reference_loader.load(source, engine)
+    assert (report.dict()["rows"], report.skipped, report.duplicates) == (1, 1, 1)
+    rows, constraints, leftovers = table_state(engine, "macs_manuf")
+    assert rows == [("00:00:0c:00:00:00", "24", "Cisco", "Cisco Systems, Inc")]
+    assert constraints == {"macs_manuf_pkey"} and leftovers == 0
+    # the rows are replaced, not added
+    reference_loader.load([(models.MacManuf, reference_loader.parse_manuf, [str(second)])], engine)
+    rows, constraints, leftovers = table_state(engine, "macs_manuf")
+    assert rows == [("00:1b:c5:00:00:00", "36", "Convergi", "None")]
+    assert constraints == {"macs_manuf_pkey"} and leftovers == 0
+
+
+@server
+def test_load_without_rows_keeps_the_table(engine, tmp_path):
+    good = tmp_path / "good"
+    good.write_text("1.0.0.0\t24\t13335\n")
+    bad = tmp_path / "bad"
+    bad.write_text("bad\n")
+    reference_loader.load([(models.LatestSubnetAsns, reference_loader.parse_prefix, [str(good)])], engine)
+    with pytest.raises(ValueError):
+        reference_loader.load([(models.LatestSubnetAsns, reference_loader.parse_prefix, [str(bad)])], engine)
+    rows, _, leftovers = table_state(engine, "latest_subnet_asns")
+    assert rows == [("13335", "1.0.0.0/24")] and leftovers == 0
+
+
+@server
+def test_tables_swapped_together(engine, tmp_path):
+    names = tmp_path / "names"
+    names.write_text("13335 CLOUDFLARENET, US\n")
+    prefixes = tmp_path / "prefixes"
+    prefixes.write_text("1.0.0.0\t24\t13335\n")
+    reports = reference_loader.load([(models.Asn, reference_loader.parse_as_name, [str(names)]),
+                                     (models.LatestSubnetAsns, reference_loader.parse_prefix, [str(prefixes)])], engine)
+    assert [report.table for report in reports] == ["asns", "latest_subnet_asns"]
+    assert table_state(engine, "asns")[0] == [("13335", "CLOUDFLARENET, US")]
+    assert table_state(engine, "latest_subnet_asns")[0] == [("13335", "1.0.0.0/24")]
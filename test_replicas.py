@@ -0,0 +1,194 @@
+"""
+replicas.ReplicaRouter: stickiness, the replicas left out when down or behind,
+and the primary when no replica is healthy. The tests against two local
+PostgreSQL servers, any two do (see replicas.py), are skipped unless given:
+    TEST_PRIMARY_URL=postgresql://localhost:5432/wifi TEST_REPLICA_URL=postgresql://localhost:5433/wifi \
+        python -m pytest test_replicas.py
+"""
+from http.cookies import SimpleCookie
+import os
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from starlette.responses import Response
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URL', 'postgresql://localhost/wifi')
+
+import database  # noqa: E402
+import replicas  # noqa: E402
+import response_cache  # noqa: E402
+
+TEST_PRIMARY_URL = os.environ.get('TEST_PRIMARY_URL')
+TEST_REPLICA_URL = os.environ.get('TEST_REPLICA_URL')
+# nothing listens on port 1
+DOWN_URL = 'postgresql://localhost:1/wifi'
+
+servers = pytest.mark.skipif(not TEST_PRIMARY_URL or not TEST_REPLICA_URL,
+                             reason="needs TEST_PRIMARY_URL and TEST_REPLICA_URL")
+
+
+class Session:
+
+    def __init__(self, replica, down=False):
+        self.replica = replica
+        self.down = down
+        self.closed = False
+
+    def connection(self):
+        if self.down:
+            raise OperationalError("SELECT 1", {}, Exception("connection refused"))
+
+    def close(self):
+        self.closed = True
+
+
+def replica(name, healthy=True, down=False, url=DOWN_URL):
+    sessions = []
+
+    def session():
+        sessions.append(Session(name, down))
+        return sessions[-1]
+
+    replica = replicas.Replica(name, create_engine(url), session)
+    replica.healthy = healthy
+    replica.opened = sessions
+    return replica
+
+
+def router(replica_list, sticky_cookie=False, **options):
+    return replicas.ReplicaRouter(replica_list, response_cache.MemoryBackend(ttl=10), sticky_cookie=sticky_cookie,
+                                  **options)
+
+
+def test_healthy_replicas_in_turn():
+    first, second, down = replica("first"), replica("second"), replica("down", healthy=False)
+    reads = router([first, down, second])
+    assert [reads.choose("10.0.0.1").name for _ in range(4)] == ["first", "second", "first", "second"]
+    assert (first.reads, second.reads, down.reads) == (2, 2, 0)
+
+
+def test_primary_without_healthy_replicas():
+    reads = router([replica("down", healthy=False)])
+    assert reads.choose("10.0.0.1") is None
+    assert reads.stats()["primary_reads"] == 1
+
+
+def test_sticky_backend():
+    reads = router([replica("first")])
+    reads.stick("10.0.0.1")
+    assert reads.choose("10.0.0.1") is None
+    assert reads.choose("10.0.0.2").name == "first"
+    assert reads.stats()["sticky_reads"] == 1
+
+
+def test_sticky_backend_expires():
+    reads = replicas.ReplicaRouter([replica("first")], response_cache.MemoryBackend(ttl=0.01))
+    reads.stick("10.0.0.1")
+    time.sleep(0.02)
+    assert reads.choose("10.0.0.1").name == "first"
+
+
+def test_sticky_cookie():
+    reads = router([replica("first")], sticky_cookie=True, sticky_seconds=10)
+    response = Response()
+    reads.stick("10.0.0.1", response, delay=5)
+    cookie = SimpleCookie(response.headers["set-cookie"])[replicas.STICKY_COOKIE]
+    assert cookie["max-age"] == "15" and cookie["httponly"]
+    cookies = {replicas.STICKY_COOKIE: cookie.value}
+    assert reads.choose("10.0.0.1", cookies) is None
+    # the cookie is what makes a client sticky, not its ip
+    assert reads.choose("10.0.0.1").name == "first"
+    assert reads.choose("10.0.0.1", {replicas.STICKY_COOKIE: "%d" % (time.time() - 1)}).name == "first"
+    assert reads.choose("10.0.0.1", {replicas.STICKY_COOKIE: "soon"}).name == "first"
+
+
+def test_no_replicas_no_cookie():
+    reads = router([], sticky_cookie=True)
+    response = Response()
+    reads.stick("10.0.0.1", response)
+    assert "set-cookie" not in response.headers
+
+
+def test_session_falls_back_to_primary():
+    down = replica("down", down=True)
+    reads = router([down])
+    db = reads.session("10.0.0.1")
+    try:
+        assert db.get_bind() is database.engine
+    finally:
+        db.close()
+    assert down.opened[0].closed
+    assert not down.healthy and down.failures == 1
+    # left out until its next check
+    assert reads.choose("10.0.0.1") is None
+
+
+def test_leave_out_counts_once():
+    down = replica("down")
+    replicas.ReplicaRouter.leave_out(down)
+    replicas.ReplicaRouter.leave_out(down)
+    assert not down.healthy and down.failures == 1
+
+
+def server_replica(name, url):
+    engine = create_engine(url)
+    return replicas.Replica(name, engine, sessionmaker(bind=engine))
+
+
+@pytest.fixture
+def primary(monkeypatch):
+    engine = create_engine(TEST_PRIMARY_URL)
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(database, "SessionLocal", sessionmaker(bind=engine))
+    yield engine
+    engine.dispose()
+
+
+@servers
+def test_check(primary):
+    up, down = server_replica("up", TEST_REPLICA_URL), server_replica("down", DOWN_URL)
+    reads = router([up, down])
+    reads.check()
+    assert up.healthy and up.lag == 0
+    assert not down.healthy and down.lag is None
+    db = reads.session("10.0.0.1")
+    try:
+        assert db.get_bind() is up.engine
+        assert db.execute(text("SELECT 1")).scalar() == 1
+    finally:
+        db.close()
+    reads.stick("10.0.0.1")
+    db = reads.session("10.0.0.1")
+    try:
+        assert db.get_bind() is primary
+    finally:
+        db.close()
+
+
+@servers
+def test_check_behind(primary):
+    behind = server_replica("behind", TEST_REPLICA_URL)
+    reads = router([behind], max_lag=-1)
+    reads.check()
+    assert not behind.healthy and behind.lag == 0
+    assert reads.choose("10.0.0.1") is None
+
+
+@servers
+def test_left_out_on_disconnect(primary):
+    up = server_replica("up", TEST_REPLICA_URL)
+    reads = router([up])
+    reads.check()
+    db = reads.session("10.0.0.1")
+    try:
+        with pytest.raises(OperationalError):
+            db.execute(text("SELECT pg_terminate_backend(pg_backend_pid())"))
+            db.execute(text("SELECT 1"))
+    finally:
+        db.close()
+    assert not up.healthy and up.failures == 1
+    reads.check()
+    assert up.healthy
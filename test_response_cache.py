@@ -0,0 +1,196 @@
+"""
+response_cache: the LRU of MemoryBackend with its TTL and limits, the counters
+of ResponseCache, RedisBackend against a local stand-in, and GET /tests/
+served from the cache until a POST of the client invalidates it:
+    python -m pytest test_response_cache.py
+"""
+import os
+import types
+
+import pytest
+from starlette.testclient import TestClient
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URL', 'postgresql://localhost/wifi')
+
+import async_queries  # noqa: E402
+import main  # noqa: E402
+import models  # noqa: E402
+import response_cache  # noqa: E402
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class Redis:
+    """
+    a local stand-in for a Redis client, with the commands RedisBackend uses
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.values = {}
+
+    def get(self, key):
+        value, expires = self.values.get(key, (None, None))
+        if expires is not None and expires <= self.clock.now:
+            del self.values[key]
+            return None
+        return value
+
+    def set(self, key, value, ex=None):
+        self.values[key] = (value, self.clock.now + ex if ex else None)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def test_memory_ttl(clock):
+    backend = response_cache.MemoryBackend(ttl=10)
+    backend.set("a", b"1")
+    backend.set("b", b"2", ttl=20)
+    clock.now += 10.5
+    assert backend.get("a") is None
+    assert backend.get("b") == b"2"
+    assert len(backend) == 1 and backend.size == 1
+
+
+def test_memory_lru_entries(clock):
+    backend = response_cache.MemoryBackend(ttl=10, max_entries=2)
+    backend.set("a", b"1")
+    backend.set("b", b"2")
+    # a is now the most recently used
+    assert backend.get("a") == b"1"
+    backend.set("c", b"3")
+    assert (backend.get("a"), backend.get("b"), backend.get("c")) == (b"1", None, b"3")
+    assert backend.evictions == 1
+
+
+def test_memory_max_bytes(clock):
+    backend = response_cache.MemoryBackend(ttl=10, max_bytes=10)
+    backend.set("a", b"1234")
+    backend.set("b", b"5678")
+    backend.set("c", b"9012")
+    assert (backend.get("a"), backend.get("b"), backend.get("c")) == (None, b"5678", b"9012")
+    assert backend.size == 8
+    # larger than the whole cache, not stored
+    backend.set("d", b"x" * 11)
+    assert backend.get("d") is None and backend.size == 8
+    # replacing an entry does not count it twice
+    backend.set("b", b"56")
+    assert backend.size == 6 and len(backend) == 2
+
+
+def test_memory_delete(clock):
+    backend = response_cache.MemoryBackend(ttl=10)
+    backend.set("a", b"1")
+    backend.delete("a", "missing")
+    assert backend.get("a") is None and backend.size == 0
+
+
+def test_counters_and_etag(clock):
+    cache = response_cache.ResponseCache(response_cache.MemoryBackend(ttl=10))
+    assert cache.get("10.0.0.1", None, '"v1"') is None
+    cache.set("10.0.0.1", None, {"dns_tests": []}, '"v1"')
+    cache.set_body("10.0.0.1", models.TestsName.basic_tests, b'{"a":1}', '"v1"')
+    assert cache.get("10.0.0.1", None, '"v1"') == b'{"dns_tests":[]}'
+    assert cache.get("10.0.0.1", models.TestsName.basic_tests, '"v1"') == b'{"a":1}'
+    # stored for another version of the results
+    assert cache.get("10.0.0.1", None, '"v2"') is None
+    assert cache.get("10.0.0.2", None, '"v1"') is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["stale"], stats["entries"]) == (2, 2, 1, 2)
+
+
+def test_invalidate_every_type_test(clock):
+    cache = response_cache.ResponseCache(response_cache.MemoryBackend(ttl=10))
+    for type_test in response_cache.TYPE_TESTS:
+        cache.set_body("10.0.0.1", type_test, b"{}")
+    cache.set_body("10.0.0.2", None, b"{}")
+    cache.invalidate("10.0.0.1")
+    assert all(cache.get("10.0.0.1", type_test) is None for type_test in response_cache.TYPE_TESTS)
+    assert cache.get("10.0.0.2") == b"{}"
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_no_backend():
+    cache = response_cache.ResponseCache(response_cache.create_backend("off"))
+    assert cache.set_body("10.0.0.1", None, b"{}") == b"{}"
+    assert cache.get("10.0.0.1") is None
+    cache.invalidate("10.0.0.1")
+    assert cache.stats() == {"hits": 0, "misses": 0, "stale": 0, "invalidations": 0}
+
+
+def test_redis_backend(clock):
+    backend = response_cache.RedisBackend(Redis(clock), ttl=10, max_bytes=10)
+    cache = response_cache.ResponseCache(backend)
+    cache.set_body("10.0.0.1", None, b"{}", '"v1"')
+    cache.set_body("10.0.0.2", None, b"x" * 20, '"v1"')
+    assert cache.get("10.0.0.1", None, '"v1"') == b"{}"
+    assert cache.get("10.0.0.2", None, '"v1"') is None
+    clock.now += 10
+    assert cache.get("10.0.0.1", None, '"v1"') is None
+    cache.set_body("10.0.0.1", None, b"{}", '"v1"')
+    cache.invalidate("10.0.0.1")
+    assert cache.get("10.0.0.1", None, '"v1"') is None
+
+
+def test_redis_backend_runs_in_threadpool():
+    assert response_cache.RedisBackend(None).blocking
+    assert not response_cache.MemoryBackend().blocking
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """
+    the app with the reads and writes of GET /tests/ and POST /tests/dns counted instead of made
+    """
+    calls = {"rendered": 0, "inserted": 0, "version": 1}
+
+    async def read_latest_results(db, ip, type_test=None):
+        return "row:%s" % calls["version"], {}
+
+    async def get_latest_results(db, ip, type_test=None, rendered=None):
+        calls["rendered"] += 1
+        return b'{"dns_tests":[]}'
+
+    async def insert_submissions(db, submissions, batch_size=None):
+        calls["inserted"] += len(submissions)
+        calls["version"] += 1
+
+    monkeypatch.setattr(async_queries, "read_latest_results", read_latest_results)
+    monkeypatch.setattr(async_queries, "get_latest_results", get_latest_results)
+    monkeypatch.setattr(async_queries, "insert_submissions", insert_submissions)
+    monkeypatch.setattr(response_cache, "cache", response_cache.ResponseCache(response_cache.MemoryBackend(ttl=60)))
+    return TestClient(main.app), calls
+
+
+def test_get_tests_read_through(api):
+    client, calls = api
+    assert client.get("/tests/").content == b'{"dns_tests":[]}'
+    assert client.get("/tests/").content == b'{"dns_tests":[]}'
+    assert calls["rendered"] == 1
+    assert response_cache.cache.stats()["hits"] == 1
+
+
+def test_post_invalidates(api):
+    client, calls = api
+    client.get("/tests/")
+    response = client.post("/tests/dns", json={"dns_test": {"dns1_android": "8.8.8.8"}})
+    assert response.status_code == 201 and calls["inserted"] == 1
+    assert response_cache.cache.stats()["invalidations"] == 1
+    client.get("/tests/")
+    assert calls["rendered"] == 2
@@ -0,0 +1,48 @@
+"""
+rollups: the counters of the test rows and the stats summarized from them:
+    python -m pytest test_rollups.py
+"""
+from datetime import date
+import os
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URL', 'postgresql://localhost/wifi')
+
+import models  # noqa: E402
+import rollups  # noqa: E402
+
+DAY = date(2021, 3, 1)
+
+
+def counters(model_test, rows):
+    rollup = rollups.Rollup()
+    for row in rows:
+        rollup.add(7, DAY, model_test, row)
+    return {name: count for (_, _, name), count in rollup.counters.items()}
+
+
+def test_flags_leave_out_null_verdicts():
+    web = counters(models.WebTestOoni, [{"accessible": True}, {"accessible": False}, {"accessible": None}, {}])
+    assert web == {"web_tests_ooni": 4, "web_tests_ooni.accessible:true": 1, "web_tests_ooni.accessible:false": 1}
+    stats = rollups.summary(web, {})["web_tests_ooni"]
+    assert stats["tests"] == 4 and stats["accessible_share"] == 0.5
+
+
+def test_flag_share_without_verdicts():
+    assert rollups.summary(counters(models.WebTestOoni, [{}]), {})["web_tests_ooni"]["accessible_share"] is None
+
+
+def test_dns_flags():
+    dns = counters(models.DnsTest, [{"do_flag": True, "ad_flag": True, "rrsig": True},
+                                    {"do_flag": True, "ad_flag": False, "rrsig": True},
+                                    {"do_flag": None, "ad_flag": None, "rrsig": None}])
+    stats = rollups.summary(dns, {})["dns_tests"]
+    assert (stats["tests"], stats["dnssec_validated_share"], stats["do_flag_share"], stats["rrsig_share"]) == \
+           (3, 0.5, 1.0, 1.0)
+
+
+def test_categories():
+    web = counters(models.WebTestOoni, [{"blocking": models.BlockingEnum.dns}, {"blocking": models.BlockingEnum.not_blocking},
+                                        {"blocking": None}])
+    stats = rollups.summary(web, {})["web_tests_ooni"]
+    assert stats["blocking"] == {"dns": 1, "not_blocking": 1}
+    assert stats["blocking_share"] == 1 / 3
@@ -0,0 +1,127 @@
+"""
+validation.read_batch against the errors and values FastAPI gives with the
+schemas.*TestsBody fields as body parameters:
+    python -m pytest test_validation.py
+"""
+import asyncio
+import json
+import os
+
+import pytest
+from pydantic import ValidationError
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URL', 'postgresql://localhost/wifi')
+
+import schemas  # noqa: E402
+import validation  # noqa: E402
+
+
+class Request:
+
+    def __init__(self, body):
+        self._body = json.dumps(body).encode()
+
+    async def body(self):
+        return self._body
+
+
+def read_batch(validate, body):
+    """
+    the errors of validation.read_batch, or the test_base and the values of the records
+    """
+    try:
+        test_base, records = asyncio.run(validation.read_batch(Request(body), validate))
+    except validation.BatchError as e:
+        return e.detail, None
+    return [], (test_base, [record.values() for record in records])
+
+
+def fastapi_body(model, body):
+    """
+    the errors of FastAPI (request_body_to_args) for body, or the test_base and the values of the tests
+    """
+    values, errors = {}, []
+    for name, model_field in model.__fields__.items():
+        value = body.get(name)
+        if value is None:
+            if model_field.required:
+                errors.append({"loc": ("body", name), "msg": "field required", "type": "value_error.missing"})
+            else:
+                values[name] = model_field.default
+            continue
+        values[name], error = model_field.validate(value, {}, loc=("body", name))
+        if error:
+            errors.extend(ValidationError([error], model).errors())
+    if errors:
+        return errors, None
+    return [], (values["test_base"], [test.dict() for test in values["test"]])
+
+
+PROTOCOL_BODIES = [
+    {},
+    {"test": []},
+    {"test": None},
+    {"test": "WPA2"},
+    {"test": {"protocol_name": "WPA2"}},
+    {"test": [{"protocol_name": "WPA2", "key_management": "PSK", "cipher": "CCMP"}, {"protocol_name": "WPA3"}]},
+    {"test": [{"protocol_name": 5, "key_management": 1.5, "cipher": None}]},
+    {"test": [{"protocol_name": True}]},
+    {"test": [{"protocol_name": None}]},
+    {"test": [{}]},
+    {"test": [{"key_management": "PSK"}, {"protocol_name": ["WPA2"]}, {"protocol_name": {"name": "WPA2"}}]},
+    {"test": [None, "WPA2", 1, [], {"protocol_name": "WPA2"}]},
+    {"test": [{"protocol_name": "WPA2"}], "test_base": {"place": "home", "username": "u"}},
+    {"test": [{"protocol_name": "WPA2"}], "test_base": None},
+    {"test": [{"protocol_name": "WPA2"}], "test_base": {"mac": "aa:bb:cc:dd:ee:ff", "mask": 0}},
+    {"test": [{"protocol_name": "WPA2"}], "test_base": "home"},
+    {"test": [{}], "test_base": {"mac": "not a mac", "mask": 24}},
+]
+
+DEVICES_BODIES = [
+    {"test": []},
+    {"test": [{"mac": "aa:bb:cc:d1:22:33", "private_ip": "192.168.1.10"}]},
+    {"test": [{"mac": "AA:BB:CC:D1:22:33", "mask": 28, "router": True, "private_ip": "10.0.0.1"}]},
+    {"test": [{"mac": "aa:bb:cc:d1:22:33:44", "private_ip": "192.168.1.10"}]},
+    {"test": [{"mac": "aa-bb-cc-d1-22-33", "private_ip": "8.8.8.8"}]},
+    {"test": [{"mac": 5, "private_ip": 10}]},
+    {"test": [{"mac": "aa:bb:cc:d1:22:33"}, {"private_ip": "10.0.0.1"}, {}]},
+    {"test": [{"mac": None, "mask": None, "router": None, "private_ip": None}]},
+    {"test": [{"mac": "aa:bb:cc:d1:22:33", "private_ip": "10.0.0.1", "mask": mask} for mask in
+              [1, "24", 24.0, 24.5, "24.5", True, False, 0, -1, "x", [], {}]]},
+    {"test": [{"mac": "aa:bb:cc:d1:22:33", "private_ip": "10.0.0.1", "router": router} for router in
+              [True, False, 0, 1, 2, -1, 1.0, 0.0, 0.5, "1", "0", "yes", "No", "on", "OFF", "t", "F", "maybe", "", [], {}]]},
+    {"test": [{"mac": "aa:bb:cc:d1:22:33", "private_ip": private_ip} for private_ip in
+              ["10.999.0.1", "10.0.0.0/8", "172.32.0.1", "192.168.1.1 ", " 192.168.1.1"]]},
+    {"test": [None, "aa:bb:cc:d1:22:33", 24, True, [], [{"mac": "aa:bb:cc:d1:22:33"}]]},
+    {"test": [{"mac": "aa:bb:cc:d1:22:33", "private_ip": "10.0.0.1"}], "test_base": {"mac": "aa:bb:cc:d1:22:33"}},
+]
+
+
+@pytest.mark.parametrize("body", PROTOCOL_BODIES)
+def test_protocol_tests(body):
+    assert read_batch(validation.validate_protocol_tests, body) == fastapi_body(schemas.ProtocolTestsBody, body)
+
+
+@pytest.mark.parametrize("body", DEVICES_BODIES)
+def test_devices_tests(body):
+    errors, values = read_batch(validation.validate_devices_tests, body)
+    expected_errors, expected_values = fastapi_body(schemas.DevicesTestsBody, body)
+    assert errors == expected_errors
+    if values is not None:
+        test_base, tests = values
+        expected_test_base, expected_tests = expected_values
+        assert test_base == expected_test_base
+        # the records have the mac as 12 hex digits, when it is only a mac
+        assert [(test["mask"], test["router"]) for test in tests] == \
+               [(test["mask"], test["router"]) for test in expected_tests]
+        assert [test["mac"] for test in tests] == \
+               ["%012x" % int(test["mac"].replace(":", ""), 16) if len(test["mac"]) == 17 else test["mac"]
+                for test in expected_tests]
+        assert [test["private_ip"] for test in tests] == [test["private_ip"] for test in expected_tests]
+
+
+def test_body_not_an_object():
+    # FastAPI reports every field as missing
+    errors, _ = read_batch(validation.validate_protocol_tests, ["WPA2"])
+    assert errors == [{"loc": ("body", "test"), "msg": "field required", "type": "value_error.missing"},
+                      {"loc": ("body", "test_base"), "msg": "field required", "type": "value_error.missing"}]
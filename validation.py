@@ -0,0 +1,225 @@
+"""
+Bulk validation of the lists of POST /tests/devices and POST /tests/protocol,
+one pass over the payload with precompiled patterns instead of a pydantic model
+per element. The checks, coercions and error messages are the ones of
+schemas.DevicesTest and schemas.ProtocolTest (pydantic 1.x), so clients see the
+same 422 responses. Devices come out with their mac as a 48 bit integer and
+their private ip packed, which is what the manufacturer lookup and the insert
+use.
+"""
+from fastapi.responses import JSONResponse
+from pydantic import ValidationError
+import json
+import re
+import socket
+
+import lookups
+import schemas
+
+MAC_PATTERN = schemas.DevicesTest.__fields__["mac"].type_.regex.pattern
+PRIVATE_IP_PATTERN = schemas.DevicesTest.__fields__["private_ip"].type_.regex.pattern
+MAC_REGEX = re.compile(MAC_PATTERN)
+PRIVATE_IP_REGEX = re.compile(PRIVATE_IP_PATTERN)
+
+BOOL_TRUE = {1, '1', 'on', 't', 'true', 'y', 'yes'}
+BOOL_FALSE = {0, '0', 'off', 'f', 'false', 'n', 'no'}
+
+
+class InvalidValue(Exception):
+
+    def __init__(self, msg, type_, ctx=None):
+        self.error = {"msg": msg, "type": type_}
+        if ctx is not None:
+            self.error["ctx"] = ctx
+
+
+class BatchError(Exception):
+
+    def __init__(self, status_code, detail):
+        self.status_code = status_code
+        self.detail = detail
+
+    def response(self):
+        return JSONResponse(status_code=self.status_code, content={"detail": self.detail})
+
+
+class Record:
+    """
+    a validated element, values() gives the columns of its row
+    """
+    __slots__ = ()
+
+    def values(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class ProtocolTestRecord(Record):
+    __slots__ = ("protocol_name", "key_management", "cipher")
+
+    def __init__(self, protocol_name, key_management, cipher):
+        self.protocol_name = protocol_name
+        self.key_management = key_management
+        self.cipher = cipher
+
+
+class DevicesTestRecord(Record):
+    __slots__ = ("mac", "mac_int", "mask", "router", "private_ip")
+
+    def __init__(self, mac, mac_int, mask, router, private_ip):
+        self.mac = mac
+        self.mac_int = mac_int
+        self.mask = mask
+        self.router = router
+        self.private_ip = private_ip
+
+    def values(self):
+        return {
+            # the pattern only checks the start, anything after the mac is left for the database to reject
+            "mac": "%012x" % self.mac_int if len(self.mac) == 17 else self.mac,
+            "mask": self.mask,
+            "router": self.router,
+            "private_ip": socket.inet_ntop(socket.AF_INET, self.private_ip) if isinstance(self.private_ip, bytes) else self.private_ip,
+        }
+
+
+def to_str(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        return str(value)
+    raise InvalidValue("str type expected", "type_error.str")
+
+
+def to_regex_str(value, regex, pattern):
+    value = to_str(value)
+    if not regex.match(value):
+        raise InvalidValue('string does not match regex "%s"' % pattern, "value_error.str.regex", {"pattern": pattern})
+    return value
+
+
+def to_positive_int(value):
+    if not isinstance(value, int) or isinstance(value, bool):
+        try:
+            value = int(value)
+        except (TypeError, ValueError, OverflowError):
+            raise InvalidValue("value is not a valid integer", "type_error.integer")
+    if value <= 0:
+        raise InvalidValue("ensure this value is greater than 0", "value_error.number.not_gt", {"limit_value": 0})
+    return value
+
+
+def to_bool(value):
+    if value is True or value is False:
+        return value
+    if isinstance(value, str):
+        value = value.lower()
+    try:
+        if value in BOOL_TRUE:
+            return True
+        if value in BOOL_FALSE:
+            return False
+    except TypeError:
+        pass
+    raise InvalidValue("value could not be parsed to a boolean", "type_error.bool")
+
+
+MISSING = object()
+
+
+def field(element, errors, loc, name, convert, *args, required=False, optional=False, default=None):
+    """
+    the converted value of element[name], or None after adding its error to errors
+    """
+    value = element.get(name, MISSING)
+    try:
+        if value is MISSING:
+            if required:
+                raise InvalidValue("field required", "value_error.missing")
+            return default
+        if value is None:
+            if not optional:
+                raise InvalidValue("none is not an allowed value", "type_error.none.not_allowed")
+            return None
+        return convert(value, *args)
+    except InvalidValue as e:
+        errors.append(dict(loc=loc + (name,), **e.error))
+        return None
+
+
+def elements(value, errors, loc):
+    if not isinstance(value, list):
+        errors.append({"loc": loc, "msg": "value is not a valid list", "type": "type_error.list"})
+        return
+    for position, element in enumerate(value):
+        if element is None:
+            errors.append({"loc": loc + (position,), "msg": "none is not an allowed value", "type": "type_error.none.not_allowed"})
+        else:
+            # with orm_mode, pydantic reads the fields of a non dict as attributes, which they do not have
+            yield loc + (position,), element if isinstance(element, dict) else {}
+
+
+def validate_protocol_tests(value, errors, loc):
+    records = []
+    for element_loc, element in elements(value, errors, loc):
+        count = len(errors)
+        protocol_name = field(element, errors, element_loc, "protocol_name", to_str, required=True)
+        key_management = field(element, errors, element_loc, "key_management", to_str, optional=True)
+        cipher = field(element, errors, element_loc, "cipher", to_str, optional=True)
+        if len(errors) == count:
+            records.append(ProtocolTestRecord(protocol_name, key_management, cipher))
+    return records
+
+
+def validate_devices_tests(value, errors, loc):
+    records = []
+    for element_loc, element in elements(value, errors, loc):
+        count = len(errors)
+        mac = field(element, errors, element_loc, "mac", to_regex_str, MAC_REGEX, MAC_PATTERN, required=True)
+        mask = field(element, errors, element_loc, "mask", to_positive_int, default=24)
+        router = field(element, errors, element_loc, "router", to_bool, default=False)
+        private_ip = field(element, errors, element_loc, "private_ip", to_regex_str,
+                           PRIVATE_IP_REGEX, PRIVATE_IP_PATTERN, required=True)
+        if len(errors) == count:
+            try:
+                private_ip = socket.inet_pton(socket.AF_INET, private_ip)
+            except OSError:
+                # matches the pattern but is not an address (10.999.0.1, 10.0.0.0/8), as before it reaches the database
+                pass
+            records.append(DevicesTestRecord(mac, lookups.mac_to_int(mac), mask, router, private_ip))
+    return records
+
+
+async def read_batch(request, validate):
+    """
+    the test_base and the validated test list of a body {"test": [...], "test_base": {...}},
+    raises BatchError with the response FastAPI would give to an invalid body.
+    """
+    body_bytes = await request.body()
+    try:
+        body = json.loads(body_bytes) if body_bytes else None
+    except json.JSONDecodeError as e:
+        raise BatchError(422, [{"loc": ("body", e.pos), "msg": str(e), "type": "value_error.jsondecode", "ctx": dict(e.__dict__)}])
+    except ValueError:
+        raise BatchError(400, "There was an error parsing the body")
+    errors = []
+    if body is not None and not isinstance(body, dict):
+        # FastAPI reports every field of a body that is not an object as missing
+        for name in ("test", "test_base"):
+            errors.append({"loc": ("body", name), "msg": "field required", "type": "value_error.missing"})
+        raise BatchError(422, errors)
+    body = body or {}
+    if body.get("test") is None:
+        # as FastAPI, a null field is a missing one
+        errors.append({"loc": ("body", "test"), "msg": "field required", "type": "value_error.missing"})
+        records = []
+    else:
+        records = validate(body["test"], errors, ("body", "test"))
+    test_base = schemas.TestBase()
+    if body.get("test_base") is not None:
+        try:
+            test_base = schemas.TestBase.validate(body["test_base"])
+        except ValidationError as e:
+            errors.extend(dict(error, loc=("body", "test_base") + tuple(error["loc"])) for error in e.errors())
+    if errors:
+        raise BatchError(422, errors)
+    return test_base, records
@@ -0,0 +1,138 @@
+"""
+Optional write-behind ingestion, enabled with WRITE_BEHIND=1.
+POST handlers put their validated submissions in a bounded in-process queue and
+answer 202 right away, a flusher thread drains the queue in batches through
+ingest.insert_submissions. When the queue is full submissions are rejected with
+503 instead of waiting, and the queue is flushed on shutdown. Submissions are
+queued with the time they were received, so their tests keep it however late
+they are flushed.
+"""
+from fastapi.responses import JSONResponse
+import logging
+import os
+import queue
+import threading
+import time
+
+import database
+import ingest
+import replicas
+import response_cache
+
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '0') == '1'
+WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get('WRITE_BEHIND_QUEUE_SIZE', 10000))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 500))
+WRITE_BEHIND_FLUSH_SECONDS = float(os.environ.get('WRITE_BEHIND_FLUSH_SECONDS', 1))
+
+
+class QueueFull(Exception):
+    pass
+
+
+def queue_full_response():
+    return JSONResponse(status_code=503, content={"message": "Too many pending results, retry later"},
+                        headers={"Retry-After": str(max(1, int(WRITE_BEHIND_FLUSH_SECONDS)))})
+
+
+class WriteBehindQueue:
+
+    def __init__(self, maxsize=WRITE_BEHIND_QUEUE_SIZE, batch_size=WRITE_BEHIND_BATCH_SIZE, flush_seconds=WRITE_BEHIND_FLUSH_SECONDS):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.flushes = 0
+        self.flushed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.flush_seconds_total = 0.0
+        self.last_flush_seconds = 0.0
+        self._queue = queue.Queue(maxsize)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def put(self, submission: ingest.Submission):
+        try:
+            self._queue.put_nowait(submission)
+        except queue.Full:
+            self.rejected += 1
+            raise QueueFull()
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _take_batch(self, timeout):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=timeout))
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _insert(self, db, submissions):
+        try:
+            ingest.insert_submissions(db, submissions)
+            return len(submissions)
+        except Exception as e:
+            if len(submissions) == 1:
+                self.failed += 1
+                logging.error("Error flushing results of %s" % submissions[0].ip, exc_info=e)
+                return 0
+        # isolates the submissions that can not be written from the rest of the batch
+        return sum(self._insert(db, [submission]) for submission in submissions)
+
+    def flush(self, submissions):
+        start = time.perf_counter()
+        db = database.SessionLocal()
+        try:
+            self.flushed += self._insert(db, submissions)
+        finally:
+            db.close()
+        for ip in {submission.ip for submission in submissions}:
+            response_cache.cache.invalidate(ip)
+            # from now on for the backends shared by the workers, the cookie is given by the handler
+            replicas.router.stick(ip)
+        self.last_flush_seconds = time.perf_counter() - start
+        self.flush_seconds_total += self.last_flush_seconds
+        self.flushes += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._take_batch(self.flush_seconds)
+            if batch:
+                try:
+                    self.flush(batch)
+                except Exception as e:
+                    self.failed += len(batch)
+                    logging.error("Error flushing pending results", exc_info=e)
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="WriteBehindQueue", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        while True:
+            batch = self._take_batch(0)
+            if not batch:
+                break
+            self.flush(batch)
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "flush_seconds_total": self.flush_seconds_total,
+            "last_flush_seconds": self.last_flush_seconds,
+        }
+
+
+pending = WriteBehindQueue() if WRITE_BEHIND else None